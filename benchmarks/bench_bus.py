@@ -0,0 +1,340 @@
+"""
+Throughput and latency benchmarks of the magic_foundation bus.
+
+Run standalone:
+
+    PYTHONPATH=./src python benchmarks/bench_bus.py --messages 100000 --output bench.json
+
+compare the stdlib event loop with uvloop:
+
+    PYTHONPATH=./src python benchmarks/bench_bus.py --loop asyncio --loop uvloop
+
+or under pytest-benchmark:
+
+    PYTHONPATH=./src python -m pytest benchmarks --benchmark-json bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+
+from magic_foundation import Container, Service, ServiceContext, __version__, default_bus, default_loop_factory, uvloop
+
+
+LOOP_FACTORIES = {
+    "asyncio": default_loop_factory,
+}
+if uvloop is not None:
+    LOOP_FACTORIES["uvloop"] = uvloop.new_event_loop
+
+
+log = logging.getLogger("benchmarks")
+
+perf_counter = time.perf_counter
+
+
+class Recorder:
+    """
+    Collect the latency of the received messages and signal when all the
+    expected messages have arrived.
+    """
+
+    def __init__(self, expected:int):
+        self.expected = expected
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def record(self, sent:float):
+        latency = perf_counter() - sent
+        with self.lock:
+            self.latencies.append(latency)
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+
+class ConsumerService(Service):
+
+    def __init__(self, name:str, queue_names:list, recorder:Recorder):
+        self.name = name
+        self.queue_names = queue_names
+        self.recorder = recorder
+
+    async def initialize(self, ctx:ServiceContext):
+        pass
+
+    async def run(self, ctx:ServiceContext):
+        async def handler(data):
+            self.recorder.record(data[1])
+
+        self.handler = handler
+
+        for queue_name in self.queue_names:
+            await ctx.subscribe(queue_name=queue_name, handler=self.handler)
+
+    async def terminate(self, ctx:ServiceContext):
+        for queue_name in self.queue_names:
+            await ctx.unsubscribe(queue_name=queue_name, handler=self.handler)
+
+
+class ProducerService(Service):
+
+    def __init__(self, name:str, queue_names:list, messages:int, ready, batch:int=64):
+        self.name = name
+        self.queue_names = queue_names
+        self.messages = messages
+        self.ready = ready
+        self.batch = batch
+        self.started = None
+
+    async def initialize(self, ctx:ServiceContext):
+        pass
+
+    async def run(self, ctx:ServiceContext):
+        while not self.ready():
+            await asyncio.sleep(0.01)
+
+        self.started = perf_counter()
+        queue_names = self.queue_names
+        for index in range(self.messages):
+            await ctx.publish(queue_name=queue_names[index % len(queue_names)], data=(index, perf_counter()))
+            if index % self.batch == 0:
+                await asyncio.sleep(0)
+
+    async def terminate(self, ctx:ServiceContext):
+        pass
+
+
+def _percentile(values:list, percentile:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percentile / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def _result(case:str, messages:int, seconds:float, latencies:list) -> dict:
+    return {
+        "case": case,
+        "messages": messages,
+        "seconds": seconds,
+        "msgs_per_sec": messages / seconds if seconds > 0 else 0.0,
+        "p50_us": _percentile(latencies, 50) * 1e6,
+        "p99_us": _percentile(latencies, 99) * 1e6,
+    }
+
+
+def _stop(threads:list):
+    loop = asyncio.new_event_loop()
+    [loop.run_until_complete(t.terminate()) for t in threads]
+    loop.close()
+    [t.join(timeout=5.0) for t in threads]
+
+
+def _subscribed(queue_names:list, subscribers:int):
+    def ready():
+        return all(len(default_bus.subscribers(queue_name)) >= subscribers for queue_name in queue_names)
+    return ready
+
+
+# event loop of the benchmarked containers
+loop_factory = default_loop_factory
+
+
+def run_bus(case:str, messages:int, consumers:int=1, topics:int=1, same_thread:bool=False, timeout:float=60.0) -> dict:
+    queue_names = [f"bench://{case}/{i}" for i in range(topics)]
+    recorder = Recorder(expected=messages * consumers)
+
+    consumer_services = [ConsumerService(f"Consumer_{i}", queue_names, recorder) for i in range(consumers)]
+    producer = ProducerService("Producer", queue_names, messages, ready=_subscribed(queue_names, consumers))
+
+    if same_thread:
+        pools = {"main": consumer_services + [producer]}
+    else:
+        pools = {f"consumer_{i}": [service] for i, service in enumerate(consumer_services)}
+        pools["producer"] = [producer]
+
+    threads = [Container(k, pools[k], loop_factory=loop_factory) for k in pools]
+
+    [t.start() for t in threads]
+    finished = recorder.done.wait(timeout=timeout)
+    seconds = perf_counter() - (producer.started or perf_counter())
+    _stop(threads)
+
+    if not finished:
+        log.error(f"[{case}] timeout received:{len(recorder.latencies)}/{recorder.expected}")
+
+    return _result(case, len(recorder.latencies), seconds, recorder.latencies)
+
+
+def bench_same_thread(messages:int) -> dict:
+    return run_bus("same_thread", messages, same_thread=True)
+
+
+def bench_cross_thread(messages:int) -> dict:
+    return run_bus("cross_thread", messages)
+
+
+def bench_fan_out(messages:int, consumers:int=4) -> dict:
+    return run_bus(f"fan_out_1_{consumers}", messages, consumers=consumers)
+
+
+def bench_many_topics(messages:int, topics:int=1000) -> dict:
+    return run_bus(f"many_topics_{topics}", messages, topics=topics)
+
+
+def bench_logging_service(messages:int, timeout:float=60.0) -> dict:
+    from magic_foundation.logging_service import LoggingService
+
+    file_path = os.path.join(tempfile.mkdtemp(), "bench.log")
+    producer = ProducerService("Producer", [f"log://{file_path}"], messages,
+                               ready=_subscribed([f"log://{file_path}"], 1))
+    producer_pool = Container("producer", [producer], loop_factory=loop_factory)
+    logging_pool = Container("logging", [LoggingService(file_path=file_path, flush_interval_sec=0.05)], loop_factory=loop_factory)
+
+    logging_pool.start()
+    producer_pool.start()
+
+    lines = 0
+    deadline = perf_counter() + timeout
+    while lines < messages and perf_counter() < deadline:
+        time.sleep(0.01)
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as f:
+                lines = sum(1 for _ in f)
+    seconds = perf_counter() - (producer.started or perf_counter())
+
+    _stop([producer_pool, logging_pool])
+    os.unlink(file_path)
+
+    return _result("logging_service", lines, seconds, [])
+
+
+def bench_websocket_echo(messages:int, port:int=18765, timeout:float=60.0) -> dict:
+    import websockets
+    from magic_foundation.websocket_service import WebSocketService
+
+    class EchoService(Service):
+
+        name = "Echo"
+
+        async def initialize(self, ctx:ServiceContext):
+            pass
+
+        async def run(self, ctx:ServiceContext):
+            async def handler(data):
+                await ctx.publish(queue_name=data.reply_to, data=data.data)
+
+            self.handler = handler
+            await ctx.subscribe(queue_name="ws://inbound/echo", handler=self.handler)
+
+        async def terminate(self, ctx:ServiceContext):
+            await ctx.unsubscribe(queue_name="ws://inbound/echo", handler=self.handler)
+
+    pool = Container("websocket", [WebSocketService(host="localhost", port=port), EchoService()], loop_factory=loop_factory)
+    pool.start()
+
+    latencies = []
+
+    async def client():
+        while not default_bus.subscribers("ws://inbound/echo"):
+            await asyncio.sleep(0.01)
+
+        async with websockets.connect(f"ws://localhost:{port}/echo") as ws:
+            started = perf_counter()
+
+            async def send():
+                for index in range(messages):
+                    await ws.send(json.dumps([index, perf_counter()]))
+
+            sender = asyncio.ensure_future(send())
+            for _ in range(messages):
+                msg = json.loads(await asyncio.wait_for(ws.recv(), timeout=timeout))
+                latencies.append(perf_counter() - msg[1])
+            await sender
+            return perf_counter() - started
+
+    loop = asyncio.new_event_loop()
+    try:
+        seconds = loop.run_until_complete(client())
+    finally:
+        loop.close()
+        _stop([pool])
+
+    return _result("websocket_echo", len(latencies), seconds, latencies)
+
+
+BENCHMARKS = {
+    "same_thread": bench_same_thread,
+    "cross_thread": bench_cross_thread,
+    "fan_out": bench_fan_out,
+    "many_topics": bench_many_topics,
+    "logging_service": bench_logging_service,
+    "websocket_echo": bench_websocket_echo,
+}
+
+
+def run(names:list, messages:int, loop:str="asyncio") -> dict:
+    global loop_factory
+    loop_factory = LOOP_FACTORIES[loop]
+
+    results = []
+    for name in names:
+        try:
+            result = BENCHMARKS[name](messages)
+        except ImportError as e:
+            log.warning(f"[{name}] skipped, missing dependency:{e}")
+            continue
+        result["loop"] = loop
+        log.info(f"[{name}][{loop}] {result['msgs_per_sec']:.0f} msgs/sec p50:{result['p50_us']:.0f}us p99:{result['p99_us']:.0f}us")
+        results.append(result)
+
+    return {
+        "version": __version__,
+        "python": sys.version,
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="magic_foundation bus benchmarks")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--loop", action="append", choices=["asyncio", "uvloop"],
+                        help="event loop of the containers, repeat it to compare the loops (default asyncio)")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run (default all): {', '.join(BENCHMARKS)}")
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+    loops = args.loop or ["asyncio"]
+    for loop in loops:
+        if loop not in LOOP_FACTORIES:
+            parser.error(f"the {loop} event loop is not installed")
+
+    reports = [run(args.benchmarks or list(BENCHMARKS), args.messages, loop=loop) for loop in loops]
+    report = dict(reports[0], results=[result for r in reports for result in r["results"]])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+pytest-benchmark entry points, every round publishes --messages messages.
+
+    PYTHONPATH=./src python -m pytest benchmarks --benchmark-json bench.json
+"""
+import pytest
+
+import bench_bus
+
+
+pytest.importorskip("pytest_benchmark")
+
+MESSAGES = 10000
+
+
+def _run(benchmark, fn, *args):
+    result = benchmark.pedantic(fn, args=(MESSAGES,) + args, rounds=3, iterations=1)
+    benchmark.extra_info.update(result)
+    assert result["messages"] > 0
+
+
+def test_same_thread(benchmark):
+    _run(benchmark, bench_bus.bench_same_thread)
+
+
+def test_cross_thread(benchmark):
+    _run(benchmark, bench_bus.bench_cross_thread)
+
+
+def test_fan_out(benchmark):
+    _run(benchmark, bench_bus.bench_fan_out)
+
+
+def test_cross_thread_uvloop(benchmark, monkeypatch):
+    uvloop = pytest.importorskip("uvloop")
+    monkeypatch.setattr(bench_bus, "loop_factory", uvloop.new_event_loop)
+    _run(benchmark, bench_bus.bench_cross_thread)
+
+
+def test_many_topics(benchmark):
+    _run(benchmark, bench_bus.bench_many_topics)
+
+
+def test_logging_service(benchmark):
+    _run(benchmark, bench_bus.bench_logging_service)
+
+
+def test_websocket_echo(benchmark):
+    pytest.importorskip("websockets")
+    _run(benchmark, bench_bus.bench_websocket_echo)
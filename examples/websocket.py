@@ -1,5 +1,4 @@
 import asyncio
-import json
 import logging
 
 from magic_foundation import Container, Service, ServiceStatus, ServiceContext, Main
@@ -25,9 +24,11 @@ class TestService(Service):
 
     async def handler(data):
       log.info(f"[{self.name}] handler inbound data:{data}")
-      req = json.loads(data)
-      res = json.dumps({"status": "OK", "timestamp": req["timestamp"]})
-      await ctx.publish(queue_name="ws://outbound/client", data=res)
+      # decoded by the json codec of the WebSocketService
+      req = data.data
+      res = {"status": "OK", "timestamp": req["timestamp"]}
+      # reply only to the connection that sent the request
+      await ctx.publish(queue_name=data.reply_to, data=res)
 
     await ctx.subscribe(queue_name="ws://inbound/client", handler=handler)
 
@@ -45,7 +46,7 @@ if __name__ == "__main__":
 
     main.service_pools = {
       "main" : [
-        WebSocketService(host="localhost", port=8765),
+        WebSocketService(host="localhost", port=8765, codec="json"),
         TestService(name="Consumer"), 
       ]
     }
@@ -1,70 +1,1221 @@
 import abc
 import asyncio
+import bisect
+import collections
+import collections.abc
 import concurrent
+import concurrent.futures
+import itertools
 import logging
+import multiprocessing
 import sys
+import time
 import traceback                     
 import threading
+import weakref
+import zlib
 
 
 from enum import Enum
 
+from magic_foundation.shared_payload import SharedPayload
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 __version__ = '0.1.6'
-__all__ = ('Main', 'Service', 'ServiceStatus', 'ServiceContext')
+__all__ = ('Balance', 'Bus', 'ConsumerGroup', 'DispatchMode', 'Histogram', 'Main', 'Offload', 'OverflowPolicy', 'Priority',
+           'RpcReply', 'RpcRequest', 'Service', 'ServiceStatus', 'ServiceContext', 'SharedPayload', 'TopicTrie', 'Tracer',
+           'default_bus', 'default_loop_factory', 'get_journal', 'get_tracer', 'set_journal', 'set_tracer', 'uvloop_factory')
 
 log = logging.getLogger(__name__)
 
 
+def default_loop_factory() -> asyncio.AbstractEventLoop:
+    return asyncio.new_event_loop()
+
+
+def uvloop_factory() -> asyncio.AbstractEventLoop:
+    """
+    A uvloop event loop when uvloop is installed, the stdlib loop otherwise.
+    """
+    if uvloop is None:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+class OverflowPolicy(Enum):
+    block = 0
+    drop_newest = 1
+    drop_oldest = 2
+    error = 3
+
+
+class Priority(Enum):
+    """
+    The lane of the inbound queue of a Container, the lower value is
+    drained first.
+    """
+    high = 0
+    normal = 1
+    low = 2
+
+
 class Queue:
-    def __init__(self, thread_id:int, loop:asyncio.AbstractEventLoop, label:str=""):
+    """
+    Inbound queue of a Container.
+
+    The queue is owned by the runloop of a single thread. Items coming from
+    the same thread are appended directly, items coming from other threads
+    are appended to a thread safe deque and the owner runloop is woken up with
+    a single call_soon_threadsafe per drain, so the publisher never waits for
+    the consumer.
+
+    When maxsize is greater than 0 the queue is bounded and the policy decides
+    what happens to the items that do not fit:
+
+        block        the publisher waits (from any thread) until there is room
+        drop_newest  the new items are discarded
+        drop_oldest  the oldest queued items are discarded
+        error        asyncio.QueueFull is raised to the publisher
+
+    With more than one lane the items are put in a lane and taken by strict
+    priority, lane 0 first. A waiting lane passed over for starvation_limit
+    consecutive takes is served first by the next one. maxsize bounds the
+    items of every lane, drop_oldest discards from the last waiting lane.
+    """
+
+    def __init__(self, thread_id:int, loop:asyncio.AbstractEventLoop, label:str="",
+                 maxsize:int=0, policy:OverflowPolicy=OverflowPolicy.block, lanes:int=1, starvation_limit:int=8):
         self.thread_id = thread_id
         self._loop = loop
-        self._queue = asyncio.Queue()
+        self._lanes = [collections.deque() for _ in range(max(lanes, 1))]
+        # the only lane of a single lane queue
+        self._items = self._lanes[0]
+        # consecutive takes a waiting lane has been passed over
+        self._passed = [0] * len(self._lanes)
+        self.starvation_limit = starvation_limit
+        self._getter = None
+        self._wakeup_pending = False
+        self._lock = threading.Lock()
+        self._putters = []
+        self._closed = False
         self.label = label
+        self.maxsize = maxsize
+        self.policy = policy
 
-    def empty(self):
-        return self._queue.empty()
-
-    def qsize(self):
-        return self._queue.qsize()
+        self.dropped_newest = 0
+        self.dropped_oldest = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.dropped_by_name = collections.Counter()
 
-    def task_done(self):
-        self._queue.task_done()
+    def empty(self):
+        return not any(self._lanes)
 
-    async def put(self, item, thread_id:int=None):
-        if thread_id is None:
-          thread_id = threading.current_thread().ident
-        
-        # required for unknow reason
-        await asyncio.sleep(0)
+    def full(self):
+        return 0 < self.maxsize <= self.qsize()
 
+    def qsize(self):
+        if len(self._lanes) == 1:
+            return len(self._items)
+        return sum(map(len, self._lanes))
+
+    def closed(self):
+        return self._closed or self._loop.is_closed()
+
+    def close(self) -> collections.Counter:
+        """
+        Stop accepting items and release the blocked publishers. Return the
+        number of discarded items per queue name.
+        """
+        self._closed = True
+        self._release_putters()
+
+        discarded = collections.Counter()
+        for lane in self._lanes:
+            items = list(lane)
+            lane.clear()
+            _release_items(items)
+            discarded.update(getattr(item, "queue_name", None) for item in items)
+        return discarded
+
+    def _wakeup(self):
+        self._wakeup_pending = False
+        getter = self._getter
+        if getter is not None and not getter.done():
+            getter.set_result(None)
+
+    def _notify(self, thread_id:int):
         if self.thread_id == thread_id:
             """
             same thread
             """
-            if self._loop.is_running():
-                self._loop.call_soon(self._queue.put_nowait, item)
-            else:
-                log.debug(f"[Queue][{self.label}] put [thread id:{thread_id}] the runloop is closed.")
-        else:
+            self._wakeup()
+        elif not self._wakeup_pending:
             """
             differents threads
             """
-            log.debug(f"[Queue][{self.label}] put 0 [thread id:{threading.current_thread().ident}]")
-            async def coro():
-              log.debug(f"[Queue][{self.label}] put 1 [thread id:{threading.current_thread().ident}]")
-              self._queue.put_nowait(item)
-              log.debug(f"[Queue][{self.label}] put 2 [thread id:{threading.current_thread().ident}]")
-
-            if self._loop.is_running():
-                future:concurrent.futures.Future = asyncio.run_coroutine_threadsafe(coro(), self._loop)
-                future.result()                
+            self._wakeup_pending = True
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup)
+            except RuntimeError:
+                log.debug(f"[Queue][{self.label}] put [thread id:{thread_id}] the runloop is closed.")
+
+    def _append(self, items, lane:int=0) -> tuple:
+        """
+        Append the items to the lane honouring maxsize and policy. Return the
+        items that did not fit and have to wait (block policy only).
+        """
+        lane_items = self._lanes[lane]
+        if self.maxsize <= 0:
+            lane_items.extend(items)
+            return ()
+
+        with self._lock:
+            free = self.maxsize - self.qsize()
+            if len(items) <= free:
+                lane_items.extend(items)
+                return ()
+
+            free = max(free, 0)
+            policy = self.policy
+
+            if policy is OverflowPolicy.block:
+                lane_items.extend(items[:free])
+                return items[free:]
+
+            if policy is OverflowPolicy.drop_newest:
+                lane_items.extend(items[:free])
+                self.dropped_newest += len(items) - free
+                self._count_dropped(items[free:])
+                _release_items(items[free:])
+                return ()
+
+            if policy is OverflowPolicy.drop_oldest:
+                lane_items.extend(items)
+                overflow = self.qsize() - self.maxsize
+                dropped = []
+                for waiting in reversed(self._lanes):
+                    while waiting and len(dropped) < overflow:
+                        dropped.append(waiting.popleft())
+                self.dropped_oldest += overflow
+                self._count_dropped(dropped)
+                _release_items(dropped)
+                return ()
+
+            self.rejected += len(items)
+            self._count_dropped(items)
+            _release_items(items)
+            raise asyncio.QueueFull(f"[Queue][{self.label}] is full maxsize:{self.maxsize}")
+
+    def _count_dropped(self, items):
+        for item in items:
+            self.dropped_by_name[getattr(item, "queue_name", None)] += 1
+
+    def stats(self) -> map:
+        return {
+            "depth": self.qsize(),
+            "lanes": [len(lane) for lane in self._lanes],
+            "maxsize": self.maxsize,
+            "policy": self.policy.name,
+            "dropped_newest": self.dropped_newest,
+            "dropped_oldest": self.dropped_oldest,
+            "rejected": self.rejected,
+            "blocked": self.blocked,
+            "dropped_by_queue": dict(self.dropped_by_name),
+        }
+
+    def _release_putters(self):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            putters = self._putters
+            self._putters = []
+
+        for loop, future in putters:
+            if loop is self._loop:
+                if not future.done():
+                    future.set_result(None)
             else:
-                log.debug(f"[Queue][{self.label}] put 4 [thread id:{threading.current_thread().ident}] the runloop is closed.")
+                try:
+                    loop.call_soon_threadsafe(_set_future_result, future)
+                except RuntimeError:
+                    pass
+
+    async def _wait_for_room(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._closed or self.qsize() < self.maxsize:
+                return
+            self._putters.append((loop, future))
+        await future
+
+    def put_nowait(self, item, thread_id:int=None, lane:int=0):
+        self.put_many_nowait((item,), thread_id=thread_id, lane=lane)
+
+    def put_many_nowait(self, items, thread_id:int=None, lane:int=0):
+        if thread_id is None:
+            thread_id = threading.get_ident()
+
+        if self.closed():
+            log.debug(f"[Queue][{self.label}] put [thread id:{thread_id}] the runloop is closed.")
+            _release_items(items)
+            return
+
+        pending = self._append(items, lane)
+        self._notify(thread_id)
+
+        if pending:
+            self.rejected += len(pending)
+            self._count_dropped(pending)
+            _release_items(pending)
+            raise asyncio.QueueFull(f"[Queue][{self.label}] is full maxsize:{self.maxsize}")
+
+    async def put(self, item, thread_id:int=None, lane:int=0):
+        await self.put_many((item,), thread_id=thread_id, lane=lane)
+
+    async def put_many(self, items, thread_id:int=None, lane:int=0):
+        if thread_id is None:
+            thread_id = threading.get_ident()
+
+        if self.closed():
+            log.debug(f"[Queue][{self.label}] put [thread id:{thread_id}] the runloop is closed.")
+            _release_items(items)
+            return
+
+        pending = self._append(items, lane)
+        self._notify(thread_id)
+
+        while pending:
+            self.blocked += 1
+            await self._wait_for_room()
+            if self.closed():
+                _release_items(pending)
+                return
+            pending = self._append(pending, lane)
+            self._notify(thread_id)
+
+    def _take(self, max_items:int) -> list:
+        lanes = self._lanes
+        if len(lanes) == 1:
+            items = self._items
+            return [items.popleft() for _ in range(min(len(items), max_items))]
+
+        passed = self._passed
+        starved = [i for i in range(len(lanes)) if passed[i] >= self.starvation_limit]
+        batch = []
+        taken = set()
+        for i in starved + [i for i in range(len(lanes)) if i not in starved]:
+            items = lanes[i]
+            n = min(len(items), max_items - len(batch))
+            if n > 0:
+                batch.extend(items.popleft() for _ in range(n))
+                taken.add(i)
+
+        for i, items in enumerate(lanes):
+            passed[i] = passed[i] + 1 if items and i not in taken else 0
+        return batch
+
+    def get_nowait(self):
+        item = self._take(1)[0]
+        self._release_putters()
+        return item
+
+    async def _wait(self):
+        while not any(self._lanes):
+            self._getter = self._loop.create_future()
+            try:
+                await self._getter
+            finally:
+                self._getter = None
+
+    async def get(self):
+        await self._wait()
+        return self.get_nowait()
+
+    async def get_many(self, max_items:int):
+        """
+        Wait for at least one item and return up to max_items of them.
+        """
+        await self._wait()
+        batch = self._take(max_items)
+        self._release_putters()
+        return batch
+
+
+def _release_items(items):
+    """
+    Release the SharedPayload carried by items (events or data) that will
+    never be dispatched.
+    """
+    for item in items:
+        data = getattr(item, "data", item)
+        if isinstance(data, SharedPayload):
+            data.release()
+
+
+class ConflatingQueue:
+    """
+    Last value wins queue of the events of a conflating subscription, owned
+    by the runloop of a single thread.
+
+    key maps an event to its conflation key: a new event replaces the pending
+    event with the same key in place, keeping its position, so a slow
+    consumer holds at most one event per key and only handles the newest.
+    """
+
+    def __init__(self, key, loop:asyncio.AbstractEventLoop, label:str=""):
+        self.key = key
+        self._loop = loop
+        # key -> event, in arrival order of the first pending event of the key
+        self._items = collections.OrderedDict()
+        self._getter = None
+        self._closed = False
+        self.label = label
+
+        self.coalesced = 0
+
+    def qsize(self):
+        return len(self._items)
+
+    def close(self) -> collections.Counter:
+        self._closed = True
+        items, self._items = self._items, collections.OrderedDict()
+        _release_items(items.values())
+        return collections.Counter(event.queue_name for event in items.values())
+
+    def put_nowait(self, event) -> bool:
+        """
+        Queue the event, return True when it replaced a pending event.
+        """
+        if self._closed:
+            _release_items((event,))
+            return False
+
+        try:
+            key = self.key(event)
+        except Exception as e:
+            log.error(f"[ConflatingQueue][{self.label}] key ERROR type:{type(e)} error:{e}")
+            # not conflated
+            key = event
+
+        replaced = self._items.get(key)
+        self._items[key] = event
+        if replaced is not None:
+            self.coalesced += 1
+            _release_items((replaced,))
+            return True
+
+        getter = self._getter
+        if getter is not None and not getter.done():
+            getter.set_result(None)
+        return False
 
     async def get(self):
-        return await self._queue.get()
+        while not self._items:
+            self._getter = self._loop.create_future()
+            try:
+                await self._getter
+            finally:
+                self._getter = None
+        return self._items.popitem(last=False)[1]
+
+
+def _set_future_result(future:asyncio.Future, result=None):
+    if not future.done():
+        future.set_result(result)
+
+
+class TopicTrie:
+    """
+    Index of the pattern subscriptions.
+
+    A pattern is split in segments on "/": the segment "*" matches exactly
+    one segment of the queue name, the trailing segment "**" matches any
+    number of remaining segments (prefix subscription).
+
+        ws://inbound/*     matches ws://inbound/client
+        log://**           matches log://logging_out.log and log:///tmp/a.log
+
+    Matching a queue name costs O(number of segments) and does not depend on
+    the number of subscriptions.
+    """
+
+    WILDCARD = "*"
+    PREFIX = "**"
+
+    class Node:
+        __slots__ = ('children', 'value')
+
+        def __init__(self):
+            self.children = {}
+            self.value = None
+
+    def __init__(self):
+        self.root = TopicTrie.Node()
+
+    @staticmethod
+    def is_pattern(queue_name:str) -> bool:
+        return TopicTrie.WILDCARD in queue_name.split("/") or queue_name.endswith("/" + TopicTrie.PREFIX)
+
+    def insert(self, pattern:str, value):
+        node = self.root
+        for segment in pattern.split("/"):
+            node = node.children.setdefault(segment, TopicTrie.Node())
+        node.value = value
+
+    def remove(self, pattern:str):
+        path = [self.root]
+        segments = pattern.split("/")
+        for segment in segments:
+            node = path[-1].children.get(segment)
+            if node is None:
+                return
+            path.append(node)
+
+        path[-1].value = None
+        for i in range(len(segments), 0, -1):
+            node = path[i]
+            if node.value is not None or node.children:
+                break
+            del path[i - 1].children[segments[i - 1]]
+
+    def match(self, queue_name:str) -> list:
+        values = []
+        nodes = [self.root]
+        for segment in queue_name.split("/"):
+            next_nodes = []
+            for node in nodes:
+                prefix = node.children.get(TopicTrie.PREFIX)
+                if prefix is not None and prefix.value is not None:
+                    values.append(prefix.value)
+                child = node.children.get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                child = node.children.get(TopicTrie.WILDCARD)
+                if child is not None:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return values
+
+        for node in nodes:
+            if node.value is not None:
+                values.append(node.value)
+            prefix = node.children.get(TopicTrie.PREFIX)
+            if prefix is not None and prefix.value is not None:
+                values.append(prefix.value)
+        return values
+
+
+class Histogram:
+    """
+    Histogram of durations with power of two buckets in microseconds: the
+    bucket i counts the observations shorter than 2**i us.
+    """
+
+    BUCKETS = 28
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds:float):
+        i = int(seconds * 1e6).bit_length()
+        if i >= Histogram.BUCKETS:
+            i = Histogram.BUCKETS - 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q:float) -> float:
+        """
+        Upper bound in seconds of the bucket holding the quantile q.
+        """
+        rank = q * self.count
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= rank and total > 0:
+                return (1 << i) / 1e6
+        return 0.0
+
+    def snapshot(self) -> map:
+        buckets = []
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            buckets.append(((1 << i) / 1e6, total))
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class Metrics:
+    """
+    Counters of a Container. They are updated only by the container thread
+    (plain dict increments) and read as copies by stats(). The handler times
+    are measured for one event in sample_every, the histograms count the
+    sampled events.
+    """
+
+    def __init__(self, sample_every:int=16):
+        self.sample_every = max(sample_every, 1)
+        self._countdown = 1
+        self.published = collections.Counter()
+        self.delivered = collections.Counter()
+        # events replaced by a newer one in a conflating subscription
+        self.coalesced = collections.Counter()
+        self.handlers = {}
+        self.loop_lag = Histogram()
+        self.loop_lag_last = 0.0
+        self.loop_lag_max = 0.0
+
+    def sampled(self) -> bool:
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self.sample_every
+        return True
+
+    def handler(self, queue_name:str) -> Histogram:
+        histogram = self.handlers.get(queue_name)
+        if histogram is None:
+            histogram = self.handlers[queue_name] = Histogram()
+        return histogram
+
+    def observe_loop_lag(self, seconds:float):
+        self.loop_lag_last = seconds
+        if seconds > self.loop_lag_max:
+            self.loop_lag_max = seconds
+        self.loop_lag.observe(seconds)
+
+    def stats(self) -> map:
+        return {
+            "published": dict(self.published),
+            "delivered": dict(self.delivered),
+            "coalesced": dict(self.coalesced),
+            "handlers": {queue_name: histogram.snapshot() for queue_name, histogram in list(self.handlers.items())},
+            "loop_lag": {
+                "last": self.loop_lag_last,
+                "max": self.loop_lag_max,
+                "histogram": self.loop_lag.snapshot(),
+            },
+        }
+
+
+class Tracer:
+    """
+    Tracing hooks of the bus, install an instance with set_tracer(). When no
+    tracer is installed the hot paths pay a single global check.
+
+    Every hook is called on the thread where the step happens, the token
+    returned by dispatch_start is handed back to dispatch_end.
+    """
+
+    def publish(self, event, thread_id:int):
+        """an event has been published by thread_id"""
+
+    def enqueue(self, event, thread_id:int, target_thread_id:int):
+        """the event has been queued for target_thread_id"""
+
+    def dequeue(self, event, thread_id:int):
+        """the event has been taken from the inbound queue of thread_id"""
+
+    def dispatch_start(self, event, handler, thread_id:int):
+        """the handler is about to process the event"""
+
+    def dispatch_end(self, event, handler, thread_id:int, token, error:Exception=None):
+        """the handler has processed the event"""
+
+
+_tracer:Tracer = None
+
+
+def set_tracer(tracer:Tracer):
+    """
+    Install the tracer (None to remove it).
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+# the journal of the selected queues (magic_foundation.journal.Journal)
+_journal = None
+
+
+def set_journal(journal):
+    """
+    Install the journal (None to remove it), the events published to its
+    queues are appended before being delivered and can be replayed with
+    subscribe(..., from_offset=...) or from_time=...
+    """
+    global _journal
+    _journal = journal
+
+
+def get_journal():
+    return _journal
+
+
+def _trace_done(tracer:Tracer, event, handler, thread_id:int, token):
+    def done(task:asyncio.Task):
+        error = task.exception() if not task.cancelled() else None
+        tracer.dispatch_end(event, handler, thread_id, token, error)
+    return done
+
+
+class DispatchMode(Enum):
+    spawn = 0
+    inline = 1
+    pool = 2
+
+
+class Offload(Enum):
+    thread = 0
+    process = 1
+
+
+class Balance(Enum):
+    round_robin = 0
+    least_depth = 1
+    hash = 2
+
+
+class ConsumerGroup:
+    """
+    The member containers of a consumer group of a queue, every event is
+    delivered to a single member chosen by balance:
+
+        round_robin  in turn
+        least_depth  the member with the fewest events in its inbound queue
+        hash         consistent hashing of key(data): the events with the
+                     same key go to the same member, in order, as long as
+                     the members don't change
+
+    The members subscribe to member_queue_name, the events are queued to
+    the chosen member under that name. A group is never changed, the Bus
+    builds a new one for every member added or removed: the routes already
+    read by the publishers keep their members.
+    """
+
+    REPLICAS = 64
+
+    def __init__(self, queue_name:str, name:str, balance:Balance=Balance.round_robin, key=None,
+                 members:map=None, turn=None):
+        if balance is Balance.hash and key is None:
+            raise ValueError(f"the consumer group {name} balanced by hash requires a key function")
+        self.queue_name = queue_name
+        self.name = name
+        self.balance = balance
+        self.key = key
+        self.member_queue_name = f"{queue_name}#{name}"
+        # thread_id -> Queue
+        self.members = dict(members or {})
+        self._queues = tuple(self.members.values())
+        # the round robin turn goes on across the versions of the group
+        self._turn = turn if turn is not None else itertools.count()
+        self._ring = ([], [])
+        if balance is Balance.hash:
+            ring = sorted((ConsumerGroup._hash(f"{thread_id}:{i}"), queue)
+                          for thread_id, queue in self.members.items() for i in range(self.REPLICAS))
+            self._ring = ([h for h, _ in ring], [queue for _, queue in ring])
+
+    def __repr__(self):
+        return f"ConsumerGroup(name:{self.name} queue_name:{self.queue_name} balance:{self.balance.name} members:{len(self.members)})"
+
+    @staticmethod
+    def _hash(value) -> int:
+        return zlib.crc32(str(value).encode("utf-8"))
+
+    def with_member(self, thread_id:int, queue:Queue):
+        """
+        A copy of the group with the member thread_id added.
+        """
+        members = dict(self.members)
+        members[thread_id] = queue
+        return ConsumerGroup(self.queue_name, self.name, self.balance, self.key, members, self._turn)
+
+    def without_member(self, thread_id:int):
+        """
+        A copy of the group with the member thread_id removed.
+        """
+        members = {t: queue for t, queue in self.members.items() if t != thread_id}
+        return ConsumerGroup(self.queue_name, self.name, self.balance, self.key, members, self._turn)
+
+    def select(self, data) -> Queue:
+        """
+        The queue of the member receiving data, None when the group is empty.
+        """
+        queues = self._queues
+        if len(queues) == 1:
+            return queues[0]
+        if not queues:
+            return None
+        if self.balance is Balance.round_robin:
+            return queues[next(self._turn) % len(queues)]
+        if self.balance is Balance.least_depth:
+            return min(queues, key=Queue.qsize)
+        hashes, ring_queues = self._ring
+        i = bisect.bisect(hashes, ConsumerGroup._hash(self.key(data))) % len(hashes)
+        return ring_queues[i]
+
+
+class _ShardedMap(collections.abc.Mapping):
+    """
+    Immutable map split in about sqrt(len) dict shards: updated() returns a
+    copy sharing every shard but the ones of the changed keys, a change of a
+    large Bus table copies O(sqrt(len)) entries.
+    """
+
+    REMOVED = object()
+
+    __slots__ = ('_shards', '_mask', '_len')
+
+    def __init__(self, items:map=None):
+        items = items or {}
+        bits = 3
+        while 1 << (2 * bits) < len(items):
+            bits += 1
+        self._mask = (1 << bits) - 1
+        self._shards = [{} for _ in range(self._mask + 1)]
+        for key, value in items.items():
+            self._shards[hash(key) & self._mask][key] = value
+        self._len = len(items)
+
+    def __getitem__(self, key):
+        return self._shards[hash(key) & self._mask][key]
+
+    def get(self, key, default=None):
+        return self._shards[hash(key) & self._mask].get(key, default)
+
+    def __contains__(self, key):
+        return key in self._shards[hash(key) & self._mask]
+
+    def __iter__(self):
+        for shard in self._shards:
+            yield from shard
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return f"_ShardedMap({dict(self.items())})"
+
+    def updated(self, changes:map):
+        """
+        A copy with the keys of changes set to their value, or removed when
+        the value is REMOVED.
+        """
+        shards = list(self._shards)
+        size = self._len
+        copied = set()
+        for key, value in changes.items():
+            i = hash(key) & self._mask
+            if i not in copied:
+                shards[i] = dict(shards[i])
+                copied.add(i)
+            shard = shards[i]
+            if value is _ShardedMap.REMOVED:
+                if shard.pop(key, _ShardedMap.REMOVED) is not _ShardedMap.REMOVED:
+                    size -= 1
+            else:
+                size += key not in shard
+                shard[key] = value
+
+        copy = _ShardedMap.__new__(_ShardedMap)
+        copy._shards, copy._mask, copy._len = shards, self._mask, size
+        if size > 4 * len(shards) ** 2:
+            # grown four times, more shards
+            return _ShardedMap(dict(copy.items()))
+        return copy
+
+
+class Bus:
+    """
+    Routing table of a set of containers, every Main has its own and the
+    containers created without one share default_bus.
+
+    The subscriptions are changed under a lock and published as a new
+    immutable Snapshot, the publishers and the inbound handlers read the
+    current snapshot without locking: a queue name resolves to a Route
+    with a single dict lookup.
+
+    set_priority() selects the inbound lane of the events of a queue name or
+    pattern, the exact name wins over the patterns, the most urgent matching
+    pattern wins over the others.
+    """
+
+    class Route:
+        """
+        The prebuilt delivery of a queue name: targets is a tuple of
+        (thread_id, inbound queue), handlers maps a thread_id to the tuple of
+        its subscriptions, groups is a tuple of ConsumerGroup, priority is
+        the default Priority of its events.
+        """
+
+        __slots__ = ('targets', 'handlers', 'groups', 'priority')
+
+        def __init__(self, targets:tuple, handlers:map, groups:tuple, priority:Priority=Priority.normal):
+            self.targets = targets
+            self.handlers = handlers
+            self.groups = groups
+            self.priority = priority
+
+    class Snapshot:
+        """
+        Built from the previous snapshot and the queue names (or patterns)
+        changed. The table shares its unchanged shards with the previous
+        one, the routes of the changed names are rebuilt and the others are
+        taken on first use from the routes of the previous snapshot or, when
+        not changed since, from the base routes of an older one. A changed
+        pattern rebuilds the trie and drops the routes it matches.
+        """
+
+        ROUTES_CACHE_SIZE = 4096
+
+        def __init__(self, table:map, groups:map, priorities:map=None, previous=None, changed=()):
+            # queue_name -> {thread_id: (inbound queue, subscriptions)}
+            self.table = table if isinstance(table, _ShardedMap) else _ShardedMap(table)
+            # queue_name -> {group name: ConsumerGroup}
+            self.groups = groups
+            # queue_name or pattern -> Priority
+            self.priorities = priorities or {}
+            if previous is not None and previous.priorities is self.priorities:
+                self.priority_patterns = previous.priority_patterns
+            else:
+                self.priority_patterns = TopicTrie()
+                for queue_name, priority in self.priorities.items():
+                    if TopicTrie.is_pattern(queue_name):
+                        self.priority_patterns.insert(queue_name, priority)
+            if previous is not None and previous.groups is groups:
+                self.member_groups = previous.member_groups
+            else:
+                self.member_groups = {group.member_queue_name: group
+                                      for named in groups.values() for group in named.values()}
+
+            changed_patterns = [queue_name for queue_name in changed if TopicTrie.is_pattern(queue_name)]
+            # pattern -> {thread_id: (inbound queue, subscriptions)}
+            if previous is None:
+                self.pattern_table = {queue_name: entries for queue_name, entries in self.table.items()
+                                      if TopicTrie.is_pattern(queue_name)}
+            else:
+                self.pattern_table = previous.pattern_table
+                if changed_patterns:
+                    self.pattern_table = dict(self.pattern_table)
+                    for queue_name in changed_patterns:
+                        if queue_name in self.table:
+                            self.pattern_table[queue_name] = self.table[queue_name]
+                        else:
+                            self.pattern_table.pop(queue_name, None)
+            if previous is not None and not changed_patterns:
+                # a change of exact names only
+                self.patterns = previous.patterns
+            else:
+                self.patterns = TopicTrie()
+                for queue_name, entries in self.pattern_table.items():
+                    self.patterns.insert(queue_name, entries)
+
+            # the routes built by this snapshot, the routes of the previous one
+            # and the base routes with the names changed since (stale)
+            self.routes = {}
+            if previous is None:
+                self._previous_routes = {}
+                self._base = {}
+                self._stale = frozenset()
+                self._affected = frozenset()
+                names = [queue_name for queue_name in list(self.table) + list(groups) if not TopicTrie.is_pattern(queue_name)]
+            else:
+                affected = set(queue_name for queue_name in changed if not TopicTrie.is_pattern(queue_name))
+                stale = previous._stale | affected
+                if changed_patterns or len(stale) ** 2 > len(previous._base):
+                    # a new base every sqrt(len) changes
+                    base = {queue_name: route for queue_name, route in previous._base.items()
+                            if queue_name not in previous._stale}
+                    base.update(previous.routes)
+                    for pattern in changed_patterns:
+                        matcher = TopicTrie()
+                        matcher.insert(pattern, pattern)
+                        affected.update(queue_name for queue_name in base if matcher.match(queue_name))
+                    for queue_name in affected:
+                        base.pop(queue_name, None)
+                    self._previous_routes = {}
+                    self._base = base
+                    self._stale = frozenset()
+                else:
+                    self._previous_routes = previous.routes
+                    self._base = previous._base
+                    self._stale = stale
+                self._affected = affected
+                names = [queue_name for queue_name in affected if queue_name in self.table or queue_name in groups]
+            for queue_name in names:
+                self.routes[queue_name] = self._build(queue_name)
+            self._routes_size = len(self._base) + len(self._previous_routes) + len(self.routes) + self.ROUTES_CACHE_SIZE
+
+        def _build(self, queue_name:str):
+            sources = []
+            if queue_name in self.table:
+                sources.append(self.table[queue_name])
+            for entries in self.patterns.match(queue_name):
+                if not any(entries is source for source in sources):
+                    sources.append(entries)
+
+            queues = {}
+            handlers = {}
+            for entries in sources:
+                for thread_id, (queue, subscriptions) in entries.items():
+                    queues.setdefault(thread_id, queue)
+                    handlers[thread_id] = handlers.get(thread_id, ()) + subscriptions
+
+            groups = tuple(self.groups.get(queue_name, {}).values())
+            return Bus.Route(tuple(queues.items()), handlers, groups, self._priority(queue_name))
+
+        def _priority(self, queue_name:str) -> Priority:
+            priority = self.priorities.get(queue_name)
+            if priority is None:
+                patterns = self.priority_patterns.match(queue_name)
+                priority = min(patterns, key=lambda p: p.value) if patterns else Priority.normal
+            return priority
+
+        def _resolve(self, queue_name:str):
+            route = None
+            if queue_name not in self._affected:
+                route = self._previous_routes.get(queue_name)
+                if route is None and queue_name not in self._stale:
+                    route = self._base.get(queue_name)
+            if route is None:
+                route = self._build(queue_name)
+            if len(self.routes) < self._routes_size:
+                self.routes[queue_name] = route
+            return route
+
+        def route(self, queue_name:str):
+            route = self.routes.get(queue_name)
+            if route is None:
+                # inherited or, without exact subscriptions, built once per snapshot
+                route = self._resolve(queue_name)
+            return route
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.snapshot = Bus.Snapshot({}, {})
+
+    def set_priority(self, queue_name:str, priority:Priority):
+        """
+        Select the inbound lane of the events of queue_name (exact name or
+        pattern), None restores Priority.normal.
+        """
+        with self._lock:
+            snapshot = self.snapshot
+            priorities = dict(snapshot.priorities)
+            if priority is None:
+                priorities.pop(queue_name, None)
+            else:
+                priorities[queue_name] = priority
+            self.snapshot = Bus.Snapshot(snapshot.table, snapshot.groups, priorities, snapshot, (queue_name,))
+
+    def route(self, queue_name:str):
+        return self.snapshot.route(queue_name)
+
+    def subscribers(self, queue_name:str) -> map:
+        """
+        The {thread_id: (inbound queue, subscriptions)} subscribed to exactly queue_name.
+        """
+        return self.snapshot.table.get(queue_name, {})
+
+    def thread_subscriptions(self, thread_id:int) -> list:
+        """
+        The (queue_name, subscription) of the thread.
+        """
+        return [(queue_name, subscription) for queue_name, entries in self.snapshot.table.items()
+                if thread_id in entries for subscription in entries[thread_id][1]]
+
+    def subscribe(self, queue_name:str, thread_id:int, queue:Queue, subscription,
+                  group:str=None, balance:Balance=Balance.round_robin, key=None) -> str:
+        """
+        Add the subscription of the thread, joining the consumer group when
+        group is given, and return the name of the subscribed queue.
+        """
+        with self._lock:
+            snapshot = self.snapshot
+            groups = snapshot.groups
+            changed = [queue_name]
+            if group is not None:
+                named = dict(groups.get(queue_name, {}))
+                consumer_group = named.get(group)
+                if consumer_group is None:
+                    consumer_group = ConsumerGroup(queue_name, group, balance=balance, key=key)
+                elif consumer_group.balance is not balance:
+                    raise ValueError(f"the consumer group {group} of {queue_name} is balanced by {consumer_group.balance.name}")
+                consumer_group = named[group] = consumer_group.with_member(thread_id, queue)
+                groups = dict(groups)
+                groups[queue_name] = named
+                queue_name = consumer_group.member_queue_name
+                changed.append(queue_name)
+
+            entries = dict(snapshot.table.get(queue_name, {}))
+            _, subscriptions = entries.get(thread_id, (queue, ()))
+            entries[thread_id] = (queue, subscriptions + (subscription,))
+            table = snapshot.table.updated({queue_name: entries})
+
+            self.snapshot = Bus.Snapshot(table, groups, snapshot.priorities, snapshot, changed)
+        return queue_name
+
+    def unsubscribe(self, queue_name:str, thread_id:int, handler):
+        """
+        Remove the subscription of the handler of the thread, to queue_name
+        or to one of its consumer groups, and return it (None if missing).
+        """
+        with self._lock:
+            snapshot = self.snapshot
+            names = [queue_name] + [group.member_queue_name for group in snapshot.groups.get(queue_name, {}).values()]
+            for name in names:
+                _, subscriptions = snapshot.table.get(name, {}).get(thread_id, (None, ()))
+                for subscription in subscriptions:
+                    if subscription.handler == handler:
+                        self._remove(snapshot, name, thread_id, subscription)
+                        return subscription
+        return None
+
+    def remove_thread(self, thread_id:int) -> list:
+        """
+        Remove every subscription and consumer group membership of the
+        thread and return the removed subscriptions.
+        """
+        with self._lock:
+            snapshot = self.snapshot
+            removed = []
+            changed = []
+            table = {}
+            for queue_name, entries in snapshot.table.items():
+                if thread_id in entries:
+                    removed.extend(entries[thread_id][1])
+                    changed.append(queue_name)
+                    entries = {t: entry for t, entry in entries.items() if t != thread_id}
+                if entries:
+                    table[queue_name] = entries
+
+            groups = {}
+            for queue_name, named in snapshot.groups.items():
+                kept = {}
+                for name, consumer_group in named.items():
+                    if thread_id in consumer_group.members:
+                        consumer_group = consumer_group.without_member(thread_id)
+                        changed.append(queue_name)
+                    if consumer_group.members:
+                        kept[name] = consumer_group
+                if kept:
+                    groups[queue_name] = kept
+
+            if removed:
+                self.snapshot = Bus.Snapshot(table, groups, snapshot.priorities, snapshot, changed)
+        return removed
+
+    def _remove(self, snapshot, queue_name:str, thread_id:int, subscription):
+        entries = dict(snapshot.table[queue_name])
+        queue, subscriptions = entries[thread_id]
+        subscriptions = tuple(s for s in subscriptions if s is not subscription)
+        if subscriptions:
+            entries[thread_id] = (queue, subscriptions)
+        else:
+            del entries[thread_id]
+        table = snapshot.table.updated({queue_name: entries or _ShardedMap.REMOVED})
+
+        groups = snapshot.groups
+        changed = [queue_name]
+        consumer_group = snapshot.member_groups.get(queue_name)
+        if consumer_group is not None and not subscriptions:
+            changed.append(consumer_group.queue_name)
+            consumer_group = consumer_group.without_member(thread_id)
+            groups = dict(groups)
+            named = groups[consumer_group.queue_name] = dict(groups[consumer_group.queue_name])
+            if consumer_group.members:
+                named[consumer_group.name] = consumer_group
+            else:
+                del named[consumer_group.name]
+                if not named:
+                    del groups[consumer_group.queue_name]
+
+        self.snapshot = Bus.Snapshot(table, groups, snapshot.priorities, snapshot, changed)
+
+
+# the routing table of the containers created without a bus
+default_bus = Bus()
+
+
+class RpcRequest:
+    """
+    Envelope of a ctx.request(): the reply is published to reply_to, a queue
+    subscribed only by the caller's container.
+    """
+
+    __slots__ = ('data', 'reply_to', 'correlation_id')
+
+    def __init__(self, data, reply_to:str, correlation_id:int):
+        self.data = data
+        self.reply_to = reply_to
+        self.correlation_id = correlation_id
+
+    def __getstate__(self):
+        return (self.data, self.reply_to, self.correlation_id)
+
+    def __setstate__(self, state):
+        self.data, self.reply_to, self.correlation_id = state
+
+
+class RpcReply:
+
+    __slots__ = ('correlation_id', 'result', 'error')
+
+    def __init__(self, correlation_id:int, result=None, error:Exception=None):
+        self.correlation_id = correlation_id
+        self.result = result
+        self.error = error
+
+    def __getstate__(self):
+        return (self.correlation_id, self.result, self.error)
+
+    def __setstate__(self, state):
+        self.correlation_id, self.result, self.error = state
+
+
+# the reply queue of the callers of this process -> their Container
+_rpc_callers = weakref.WeakValueDictionary()
+
+
+def _rpc_resolve(reply_to:str, replies) -> bool:
+    """
+    Hand the replies directly to the caller waiting on reply_to when it runs
+    in this process, without going through its inbound queue: a caller
+    awaiting request() in an inline handler blocks its inbound dispatching.
+    Return False when the caller is not in this process.
+    """
+    caller = _rpc_callers.get(reply_to)
+    if caller is None:
+        return False
+    try:
+        for reply in replies:
+            caller.loop.call_soon_threadsafe(caller._rpc_complete, reply)
+    except RuntimeError:
+        log.debug(f"[rpc] reply_to:{reply_to} the runloop of the caller is closed.")
+    return True
 
 
 class ServiceStatus(Enum):
@@ -82,22 +1233,89 @@ class ServiceContext():
         self.loop = loop
         self.container = container
 
-    async def publish(self, queue_name:str, data:map):
+    async def publish(self, queue_name:str, data:map, priority:Priority=None):
         if self.loop.is_running():    
-            await self.container.publish(queue_name=queue_name, data=data)
-        
-    async def subscribe(self, queue_name:str, handler):
+            await self.container.publish(queue_name=queue_name, data=data, priority=priority)
+
+    async def publish_many(self, queue_name:str, items:list, priority:Priority=None):
+        if self.loop.is_running():
+            await self.container.publish_many(queue_name=queue_name, items=items, priority=priority)
+
+    async def subscribe(self, queue_name:str, handler, **options):
+        """
+        Subscribe the handler to the queue_name (exact name or pattern).
+
+        options:
+            mode         DispatchMode.spawn (default), DispatchMode.inline or DispatchMode.pool
+            workers      number of worker Tasks of the pool mode
+            maxsize      capacity of the private queue of the pool mode (0 unbounded)
+            policy       OverflowPolicy of the private queue of the pool mode
+            from_offset  replay the journal of the queue from this offset, then deliver the live events
+            from_time    replay the journal of the queue from this timestamp (time.time())
+            group        join the consumer group: every event is delivered to a single member container
+            balance      Balance of the group, round_robin (default), least_depth or hash
+            key          function of the data hashed by the Balance.hash groups
+            offload      run the handler, a plain function (not a coroutine function),
+                         on the Offload.thread or Offload.process pool of the container
+            conflate     True or a key function of the data, last value wins: a new
+                         event replaces the pending event with the same key (the
+                         queue name with True), the workers handle only the newest
+        """
         if self.loop.is_running():
-            await self.container.subscribe(queue_name=queue_name, handler=handler)
+            await self.container.subscribe(queue_name=queue_name, handler=handler, **options)
 
     async def unsubscribe(self, queue_name:str, handler):
         if self.loop.is_running():
             await self.container.unsubscribe(queue_name=queue_name, handler=handler)
 
+    def set_priority(self, queue_name:str, priority:Priority):
+        """
+        Select the inbound lane of the events published to queue_name (exact
+        name or pattern) when the publisher does not give a priority.
+        """
+        self.container.bus.set_priority(queue_name, priority)
+
+    async def request(self, queue_name:str, data, timeout:float=5.0):
+        """
+        Publish data to the queue_name served with serve() and wait for the
+        reply of the server. Raise asyncio.TimeoutError when no reply arrives
+        within timeout seconds, or the exception raised by the server handler.
+        """
+        return await self.container.request(queue_name=queue_name, data=data, timeout=timeout)
+
+    async def run_blocking(self, fn, *args, offload:Offload=Offload.thread):
+        """
+        Run fn(*args) on the thread (or process) pool of the container and
+        return its result.
+        """
+        return await self.container.run_blocking(fn, *args, offload=offload)
+
+    async def serve(self, queue_name:str, handler, **options):
+        """
+        Subscribe the handler to the queue_name, its return value is sent back
+        to the container of the caller of request(). The options are the
+        subscribe() ones.
+        """
+        if self.loop.is_running():
+            await self.container.serve(queue_name=queue_name, handler=handler, **options)
+
+    async def unserve(self, queue_name:str, handler):
+        if self.loop.is_running():
+            await self.container.unserve(queue_name=queue_name, handler=handler)
+
     async def dump_queue_tree(self):
         if self.loop.is_running():
             await self.container.dump_queue_tree()
 
+    def stats(self, all_containers:bool=False):
+        """
+        Runtime statistics of this container, or a list with the statistics of
+        every running container when all_containers is True.
+        """
+        if all_containers:
+            return [container.stats() for container in list(Container.running)]
+        return self.container.stats()
+
 
 class Service(object):
     __metaclass__ = abc.ABCMeta
@@ -150,28 +1368,198 @@ class Service(object):
 
 class Container(threading.Thread):
 
-    class QRef:
-        def __init__(self, queue_ref):
-            self.queue = queue_ref
-            self.handlers = []
-
     class Event:
-        def __init__(self, queue_name:str, data):
+        __slots__ = ('queue_name', 'data', 'trace', 'offset', 'priority')
+
+        def __init__(self, queue_name:str, data, offset:int=None, priority:Priority=Priority.normal):
             self.queue_name = queue_name
             self.data = data 
+            self.trace = None
+            # journal offset of the event
+            self.offset = offset
+            # inbound lane of the event
+            self.priority = priority
+
+    class Subscription:
+        """
+        A handler subscribed to a queue and the way its events are dispatched:
+
+            spawn   a new Task for every event (no ordering, no limit)
+            inline  the handler is awaited by the inbound handler, events are
+                    processed in order and no Task is created
+            pool    `workers` long lived worker Tasks consume a private queue
+                    bounded by `maxsize` and `policy`
+
+        A conflating subscription (conflate is a key function of the data, or
+        True for one event per queue name) is dispatched by `workers` worker
+        Tasks from a ConflatingQueue: while an event waits, a newer event of
+        the same queue name and key replaces it.
+
+        While a subscription replays the journal the live events are skipped,
+        then only the events past the last replayed offset are delivered.
+        """
+
+        def __init__(self, handler, mode:DispatchMode=DispatchMode.spawn, workers:int=1,
+                     maxsize:int=0, policy:OverflowPolicy=OverflowPolicy.block, offload:Offload=None,
+                     conflate=None):
+            self.handler = handler
+            self.offload = offload
+            self.conflate = conflate
+            # the coroutine function called for every event
+            self.invoke = handler
+            self.mode = mode
+            self.workers = workers
+            self.maxsize = maxsize
+            self.policy = policy
+            self.queue = None
+            self.tasks = []
+            # worker index -> queue name of the event being handled
+            self.active = {}
+            self._idle = None
+            self.replaying = False
+            self.replayed = None
+
+        def __repr__(self):
+            if self.conflate is not None:
+                return f"{self.handler} mode:conflate"
+            return f"{self.handler} mode:{self.mode.name}"
+
+        def _conflation_key(self):
+            conflate = self.conflate
+            if conflate is True:
+                return lambda event: event.queue_name
+            return lambda event: (event.queue_name, conflate(event.data))
+
+        def admit(self, event) -> bool:
+            return not self.replaying and (event.offset is None or event.offset > self.replayed)
+
+        def start(self, container):
+            if self.offload is not None:
+                handler, offload = self.handler, self.offload
+
+                async def invoke(data):
+                    return await container.run_blocking(handler, data, offload=offload)
+
+                self.invoke = invoke
+
+            label = f"{container.thread_id}:{self.handler}"
+            if self.conflate is not None:
+                self.queue = ConflatingQueue(self._conflation_key(), loop=container.loop, label=label)
+            elif self.mode is DispatchMode.pool:
+                self.queue = Queue(thread_id=container.thread_id, loop=container.loop, label=label,
+                                   maxsize=self.maxsize, policy=self.policy)
+            else:
+                return
+
+            async def worker(index:int):
+                metrics = container.metrics
+                active = self.active
+                while True:
+                    event = await self.queue.get()
+                    data = event.data
+                    active[index] = event.queue_name
+                    tracer = _tracer
+                    if tracer is not None:
+                        token = tracer.dispatch_start(event, self.handler, container.thread_id)
+                    error = None
+                    started = time.perf_counter() if metrics is not None and metrics.sampled() else None
+                    try:
+                        await self.invoke(data=data)
+                    except Exception as e:
+                        error = e
+                        log.error(f"[{container.name}][{container.k}] worker handler:{self.handler} Exception type:{type(e)} error:{e}")
+                    finally:
+                        if tracer is not None:
+                            tracer.dispatch_end(event, self.handler, container.thread_id, token, error)
+                        if started is not None:
+                            metrics.handler(event.queue_name).observe(time.perf_counter() - started)
+                        if isinstance(data, SharedPayload):
+                            data.release()
+                        del active[index]
+                        idle = self._idle
+                        if idle is not None and not idle.done() and self.idle():
+                            idle.set_result(None)
+
+            self.tasks = [asyncio.ensure_future(worker(i), loop=container.loop) for i in range(max(self.workers, 1))]
+
+        def idle(self) -> bool:
+            """
+            No event queued or being handled by the workers.
+            """
+            return not self.active and (self.queue is None or self.queue.qsize() == 0)
+
+        async def wait_idle(self):
+            while not self.idle():
+                self._idle = asyncio.get_running_loop().create_future()
+                try:
+                    await self._idle
+                finally:
+                    self._idle = None
+
+        def stop(self) -> collections.Counter:
+            """
+            Cancel the workers, return the number of discarded events per
+            queue name, the events being handled included.
+            """
+            for task in self.tasks:
+                task.cancel()
+            self.tasks = []
+            discarded = collections.Counter(self.active.values())
+            if self.queue is not None:
+                discarded.update(self.queue.close())
+            return discarded
 
 
     name = "Container"
 
     
-    def __init__(self, k, services):
+    def __init__(self, k, services, batch_size:int=256, maxsize:int=0, policy:OverflowPolicy=OverflowPolicy.block,
+                 metrics:bool=True, handler_sample:int=16, loop_lag_interval:float=0.5, loop_factory=None,
+                 thread_workers:int=None, process_workers:int=None, bus:Bus=None, starvation_limit:int=8):
         self.k = k
         self.services = services
+        self.bus = bus if bus is not None else default_bus
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.policy = policy
+        self.starvation_limit = starvation_limit
+        self.metrics = Metrics(sample_every=handler_sample) if metrics else None
+        self.loop_lag_interval = loop_lag_interval
+        self.loop_factory = loop_factory or default_loop_factory
+        # Offload -> executor, created on first use and shut down with the container
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.executors = {}
         self.thread_id = None
         self.loop = None
         self.start_task = None
+        self.inbound_task = None
+        self.loop_lag_task = None
+
+        self.rpc_ids = itertools.count(1)
+        self.rpc_pending = {}
+        self.rpc_reply_to = None
+        self.rpc_servers = {}
 
         self.q_inbound = None
+
+        # shutdown: the drain timeout requested by terminate(), the drain
+        # waiter, whether a batch is being dispatched, the events discarded
+        # per queue name and the report
+        # resolved when the thread completes
+        self._shutdown_request = None
+        self._shutdown_task = None
+        self._drained = None
+        self._dispatching = False
+        # the routes of the container when it left the bus and the subscriptions removed
+        self._routes = None
+        self._detached = []
+        # spawned handler Task -> queue name of its event
+        self._spawned = {}
+        self.discarded = collections.Counter()
+        # events rejected by the full queue of a pool subscription
+        self.rejected = collections.Counter()
+        self.stopped = concurrent.futures.Future()
         threading.Thread.__init__(self)        
 
     def run(self):
@@ -182,64 +1570,286 @@ class Container(threading.Thread):
         async def inbound_handler():
             log.debug(f"[{self.name}][{self.k}] inbound_handler 1 [thread id:{self.thread_id}]")
             await asyncio.sleep(0)
+            # counted once per event, the handler times are sampled in _dispatch
+            delivered = self.metrics.delivered if self.metrics is not None else None
             running = True
             while running:
                 try:
-                    log.debug(f"[{self.name}][{self.k}] inbound_handler 2 [thread id:{self.thread_id}]")
-                    event:Container.Event = await self.q_inbound.get()
-                    self.q_inbound.task_done()
-
-                    queue_name = event.queue_name
-                    if queue_name in self.queues:
-                      if self.thread_id in self.queues[queue_name]:
-                        for handler in self.queues[queue_name][self.thread_id].handlers:
-                          asyncio.ensure_future(handler(data=event.data), loop=self.loop)
-
-                    log.debug(f"[{self.name}][{self.k}] inbound_handler 3 [thread id:{self.thread_id}] event:{event}")
+                    events = await self.q_inbound.get_many(self.batch_size)
+                    tracer = _tracer
+
+                    self._dispatching = True
+                    try:
+                        for index, event in enumerate(events):
+                            if tracer is not None:
+                                tracer.dequeue(event, self.thread_id)
+
+                            subscriptions = (self._routes or self.bus.snapshot).route(event.queue_name).handlers.get(self.thread_id, ())
+
+                            if isinstance(event.data, SharedPayload):
+                                event.data.transfer(len(subscriptions))
+
+                            if delivered is not None:
+                                delivered[event.queue_name] += len(subscriptions)
+
+                            for subscription in subscriptions:
+                                if subscription.replayed is not None and not subscription.admit(event):
+                                    if isinstance(event.data, SharedPayload):
+                                        event.data.release()
+                                    continue
+                                await self._dispatch(subscription, event)
+                    except asyncio.CancelledError:
+                        # stopped in the middle of the batch
+                        self.discarded.update(pending.queue_name for pending in events[index + 1:])
+                        raise
+                    self._dispatching = False
+
+                    drained = self._drained
+                    if drained is not None and self.q_inbound.empty() and not drained.done():
+                        drained.set_result(None)
                 except concurrent.futures.CancelledError as e:
                     log.debug(f"[{self.name}][{self.k}] inbound_handler 4 [thread id:{self.thread_id}] has been cancelled")
                     running = False
                 except Exception as e:
                     log.error(f"[{self.name}][{self.k}] inbound_handler 5 [thread id:{self.thread_id}] Exception type:{type(e)} error:{e}")
                     running = False
-                    if True:
-                      traceback.print_exc(file=sys.stdout)
         
         try:
-            self.loop = asyncio.new_event_loop()
+            self.loop = self.loop_factory()
             asyncio.set_event_loop(self.loop)
 
-            self.q_inbound = Queue(thread_id=self.thread_id, loop=self.loop, label=f"{self.thread_id}")
+            self.q_inbound = Queue(thread_id=self.thread_id, loop=self.loop, label=f"{self.thread_id}",
+                                   maxsize=self.maxsize, policy=self.policy,
+                                   lanes=len(Priority), starvation_limit=self.starvation_limit)
             self.ctx = ServiceContext(thread_id=self.thread_id, loop=self.loop, container=self)   
 
             self.loop.run_until_complete(self._services_start())
 
             self.inbound_task:asyncio.Task = asyncio.ensure_future(inbound_handler(), loop=self.loop)
+            if self.metrics is not None and self.loop_lag_interval > 0:
+                self.loop_lag_task = asyncio.ensure_future(self._loop_lag_handler(), loop=self.loop)
+
+            Container.running.add(self)
+
+            # terminate() called while starting
+            if self._shutdown_request is not None:
+                self._begin_shutdown()
 
             self.loop.run_forever()
         except Exception as e:
             log.error(f"[{self.k}][Container] starting exception:{e}")
         finally:
+            Container.running.discard(self)
+
             if self.inbound_task is not None and not self.inbound_task.cancelled():
               self.inbound_task.cancel()   
+            if self.loop_lag_task is not None:
+              self.loop_lag_task.cancel()
             
             log.debug(f"[{self.k}][Container] ------ terminate services ------")
             self.loop.run_until_complete(self._services_stop())
+            # the subscriptions left by the services are not routed to the closed queue
+            subscriptions = self._detached + self.bus.remove_thread(self.thread_id)
+            cancelled = [task for subscription in subscriptions for task in subscription.tasks] + list(self._spawned)
+            # the handlers still running are counted with the queued events
+            for task, queue_name in list(self._spawned.items()):
+                task.cancel()
+                self.discarded[queue_name] += 1
+            for subscription in subscriptions:
+                self.discarded.update(subscription.stop())
+            if cancelled:
+                # they release their payloads
+                self.loop.run_until_complete(asyncio.wait(cancelled, timeout=1.0))
+            if self.q_inbound is not None:
+                self.discarded.update(self.q_inbound.close())
+            self._shutdown_executors()
             self.loop.close()
-
-    async def terminate(self):
+            self._set_stopped()
+
+    async def _dispatch(self, subscription, event):
+        mode = subscription.mode
+        data = event.data
+        metrics = self.metrics
+        tracer = _tracer
+        if subscription.conflate is not None:
+            if subscription.queue.put_nowait(event) and metrics is not None:
+                metrics.coalesced[event.queue_name] += 1
+        elif mode is DispatchMode.spawn:
+            if tracer is not None:
+                token = tracer.dispatch_start(event, subscription.handler, self.thread_id)
+            task = asyncio.ensure_future(subscription.invoke(data=data), loop=self.loop)
+            self._spawned[task] = event.queue_name
+            task.add_done_callback(self._spawn_done)
+            if tracer is not None:
+                task.add_done_callback(_trace_done(tracer, event, subscription.handler, self.thread_id, token))
+            if metrics is not None and metrics.sampled():
+                histogram = metrics.handler(event.queue_name)
+                started = time.perf_counter()
+                task.add_done_callback(lambda _: histogram.observe(time.perf_counter() - started))
+            if isinstance(data, SharedPayload):
+                task.add_done_callback(lambda _: data.release())
+        elif mode is DispatchMode.inline:
+            if tracer is not None:
+                token = tracer.dispatch_start(event, subscription.handler, self.thread_id)
+            error = None
+            started = time.perf_counter() if metrics is not None and metrics.sampled() else None
+            try:
+                await subscription.invoke(data=data)
+            except Exception as e:
+                error = e
+                log.error(f"[{self.name}][{self.k}] inline handler:{subscription.handler} Exception type:{type(e)} error:{e}")
+            finally:
+                if tracer is not None:
+                    tracer.dispatch_end(event, subscription.handler, self.thread_id, token, error)
+                if started is not None:
+                    metrics.handler(event.queue_name).observe(time.perf_counter() - started)
+                if isinstance(data, SharedPayload):
+                    data.release()
+        else:
+            try:
+                await subscription.queue.put(event)
+            except asyncio.QueueFull:
+                # the full queue released the event, the other subscriptions still get it
+                self.rejected[event.queue_name] += 1
+                log.warning(f"[{self.name}][{self.k}] pool handler:{subscription.handler} queue is full, event of {event.queue_name} dropped")
+
+    def _executor(self, offload:Offload) -> concurrent.futures.Executor:
+        executor = self.executors.get(offload)
+        if executor is None:
+            if offload is Offload.process:
+                # spawn: forking a multithreaded process is unsafe
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.process_workers,
+                                                                  mp_context=multiprocessing.get_context("spawn"))
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_workers,
+                                                                 thread_name_prefix=f"{self.name}:{self.k}")
+            self.executors[offload] = executor
+        return executor
+
+    def _shutdown_executors(self):
+        for offload, executor in list(self.executors.items()):
+            log.debug(f"[{self.k}][Container] shutdown the {offload.name} executor")
+            executor.shutdown(wait=True)
+        self.executors = {}
+
+    async def run_blocking(self, fn, *args, offload:Offload=Offload.thread):
+        return await self.loop.run_in_executor(self._executor(offload), fn, *args)
+
+    async def _loop_lag_handler(self):
+        interval = self.loop_lag_interval
+        while True:
+            scheduled = self.loop.time() + interval
+            await asyncio.sleep(interval)
+            self.metrics.observe_loop_lag(max(self.loop.time() - scheduled, 0.0))
+
+    def stats(self) -> map:
+        stats = {
+            "container": self.k,
+            "thread_id": self.thread_id,
+            "inbound": self.q_inbound.stats() if self.q_inbound is not None else None,
+            "rejected_by_queue": dict(self.rejected),
+        }
+        if self.metrics is not None:
+            stats.update(self.metrics.stats())
+        return stats
+
+    def _set_stopped(self):
+        dropped = sum(self.discarded.values())
+        if dropped:
+            log.warning(f"[{self.k}][Container] stopped dropping {dropped} events {dict(self.discarded)}")
+        if not self.stopped.done():
+            self.stopped.set_result({
+                "container": self.k,
+                "dropped": dropped,
+                "dropped_by_queue": dict(self.discarded),
+            })
+
+    def _begin_shutdown(self):
+        # while starting the shutdown begins once the inbound handler runs
+        if self._shutdown_task is None and self.inbound_task is not None:
+            self._shutdown_task = asyncio.ensure_future(self._shutdown(self._shutdown_request), loop=self.loop)
+
+    def _detach(self):
+        """
+        Remove the subscriptions of this container from the bus: the new
+        events go to the other containers, the events already queued are
+        still dispatched with the routes the container had.
+        """
+        if self._routes is None:
+            self._routes = self.bus.snapshot
+            self._detached.extend(self.bus.remove_thread(self.thread_id))
+
+    def _spawn_done(self, task):
+        self._spawned.pop(task, None)
+
+    def _idle(self) -> bool:
+        return (not self._dispatching and self.q_inbound.empty() and not self._spawned
+                and all(subscription.idle() for subscription in self._detached))
+
+    async def _drain(self):
+        """
+        Wait for the inbound queue, the subscription queues and the spawned
+        handlers to be done, the handlers can queue more events.
+        """
+        while not self._idle():
+            if self._dispatching or not self.q_inbound.empty():
+                self._drained = self.loop.create_future()
+                try:
+                    await self._drained
+                finally:
+                    self._drained = None
+            elif self._spawned:
+                await asyncio.wait(list(self._spawned))
+            else:
+                for subscription in self._detached:
+                    await subscription.wait_idle()
+
+    async def _shutdown(self, drain_timeout:float):
+        self._detach()
+        if drain_timeout and self.q_inbound is not None and not self._idle():
+            try:
+                await asyncio.wait_for(self._drain(), timeout=drain_timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"[{self.k}][Container] drain timeout after {drain_timeout}s depth:{self.q_inbound.qsize()} "
+                            f"handlers:{len(self._spawned)}")
+
+        if self.inbound_task is not None:
+            self.inbound_task.cancel()
+        self.loop.stop()
+
+    async def terminate(self, drain_timeout:float=None, timeout:float=10.0) -> map:
+        """
+        Stop the container and wait, at most timeout seconds, for its thread
+        to complete. With drain_timeout the events already in the inbound
+        queue are dispatched first, until it is empty or drain_timeout
+        seconds have passed. Return the shutdown report: the events
+        discarded, per queue name, and whether the thread completed in time.
+        It can be called from any thread.
+        """
         log.debug(f"[{self.k}][Container] terminate")
+        started = time.monotonic()
+        if self.ident is None:
+            # never started
+            self._set_stopped()
+        elif not self.stopped.done():
+            self._shutdown_request = drain_timeout or 0
+            loop = self.loop
+            if loop is not None:
+                try:
+                    loop.call_soon_threadsafe(self._begin_shutdown)
+                except RuntimeError:
+                    # the loop is already closed
+                    pass
+
+        report = {"container": self.k, "dropped": 0, "dropped_by_queue": {}}
         try:
-            if self.inbound_task is not None and not self.inbound_task.cancelled():
-              self.inbound_task.cancel()            
-            
-            if self.loop is not None and self.loop.is_running():
-                self.loop.call_soon_threadsafe(self.loop.stop)
-                await asyncio.sleep(0.5)
-        except Exception as e:
-            log.error(f"[{self.k}][Container] terminate exception:{e}")
-        finally:
-            log.debug(f"[{self.k}][Container] terminate finally loop is running:{self.loop.is_running()}")
+            report = dict(await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(self.stopped)), timeout=timeout))
+            report["timed_out"] = False
+        except asyncio.TimeoutError:
+            log.error(f"[{self.k}][Container] terminate the container did not stop within {timeout}s")
+            report["timed_out"] = True
+        report["seconds"] = time.monotonic() - started
+        return report
 
     async def _services_start(self):
         self.start_task = asyncio.gather(
@@ -248,60 +1858,305 @@ class Container(threading.Thread):
         )
         return self.start_task
 
+    async def _in_loop(self, coro):
+        """
+        Run coro in the loop of this container and wait for its result from
+        the loop of the caller.
+        """
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def add_service(self, service:Service):
+        """
+        Start service in this running container, it can be called from any
+        thread.
+        """
+        async def start():
+            self.services.append(service)
+            asyncio.ensure_future(service.start(ctx=self.ctx), loop=self.loop)
+
+        await self._in_loop(start())
+
+    async def remove_service(self, service:Service):
+        """
+        Stop service and remove it from this running container, the service
+        terminate unsubscribes its handlers. It can be called from any thread.
+        """
+        async def stop():
+            self.services.remove(service)
+            await service.stop(ctx=self.ctx)
+
+        await self._in_loop(stop())
+
     async def _services_stop(self):
         await asyncio.gather(
             *map(lambda instance: instance.stop(ctx=self.ctx), reversed(self.services)),
             return_exceptions=True
         )
 
+        if self.rpc_reply_to is not None:
+            _rpc_callers.pop(self.rpc_reply_to, None)
+            await self.unsubscribe(queue_name=self.rpc_reply_to, handler=self._rpc_reply_handler)
+
     # static
-    queues = {}
+    running = weakref.WeakSet()
 
-    async def publish(self, queue_name: str, data: map):    
-        log.debug(f"[{self.name}] publish name:{queue_name} data:{data}")
+    async def publish(self, queue_name: str, data: map, priority:Priority=None):    
+        if self.metrics is not None:
+            self.metrics.published[queue_name] += 1
 
-        if queue_name in self.queues:
-            for thread_id in self.queues[queue_name]:
-                await self.queues[queue_name][thread_id].queue.put(Container.Event(queue_name, data))
-                 
-    async def subscribe(self, queue_name: str, handler) -> map:
-        log.debug(f"[{self.name}] subscribe name:{queue_name}")
-        if queue_name not in self.queues:
-            self.queues[queue_name] = {}
+        # journaled before the route is read: a subscriber missing from the
+        # route replays the offset
+        offset = None
+        journal = _journal
+        if journal is not None and journal.journaled(queue_name):
+            offset = journal.append(queue_name, data)
+
+        route = self.bus.snapshot.route(queue_name)
+        if priority is None:
+            priority = route.priority
+        lane = priority.value
 
-        if self.thread_id not in self.queues[queue_name]:
-            self.queues[queue_name][self.thread_id] = Container.QRef(queue_ref=self.q_inbound)
+        targets = route.targets
+        groups = route.groups
 
-        self.queues[queue_name][self.thread_id].handlers.append(handler)
+        if isinstance(data, SharedPayload):
+            data.transfer(len(targets) + len(groups))
 
-    async def unsubscribe(self, queue_name: str, handler) -> map:
+        reached = 0
+        try:
+            if targets:
+                event = Container.Event(queue_name, data, offset, priority)
+                tracer = _tracer
+                if tracer is None:
+                    for _, queue in targets:
+                        reached += 1
+                        await queue.put(event, lane=lane)
+                else:
+                    thread_id = threading.get_ident()
+                    tracer.publish(event, thread_id)
+                    for target_thread_id, queue in targets:
+                        tracer.enqueue(event, thread_id, target_thread_id)
+                        reached += 1
+                        await queue.put(event, lane=lane)
+
+            for group in groups:
+                reached += 1
+                queue = group.select(data)
+                if queue is None:
+                    # emptied since the route was read
+                    if isinstance(data, SharedPayload):
+                        data.release()
+                    continue
+                await queue.put(Container.Event(group.member_queue_name, data, offset, priority), lane=lane)
+        except asyncio.QueueFull:
+            # the full queue released its reference, the queues not reached never get theirs
+            if isinstance(data, SharedPayload):
+                for _ in range(len(targets) + len(groups) - reached):
+                    data.release()
+            raise
+
+    async def publish_many(self, queue_name: str, items: list, priority:Priority=None):
+        if self.metrics is not None:
+            self.metrics.published[queue_name] += len(items)
+
+        # journaled before the route is read, see publish
+        offsets = None
+        journal = _journal
+        if journal is not None and journal.journaled(queue_name):
+            offsets = journal.append_many(queue_name, items)
+
+        route = self.bus.snapshot.route(queue_name)
+        if priority is None:
+            priority = route.priority
+        lane = priority.value
+
+        targets = route.targets
+        groups = route.groups
+
+        for data in items:
+            if isinstance(data, SharedPayload):
+                data.transfer(len(targets) + len(groups))
+
+        # (target thread id, queue, events), the thread id is None for a group member
+        deliveries = []
+        if targets:
+            if offsets is None:
+                events = [Container.Event(queue_name, data, None, priority) for data in items]
+            else:
+                events = [Container.Event(queue_name, data, offset, priority) for data, offset in zip(items, offsets)]
+            deliveries.extend((target_thread_id, queue, events) for target_thread_id, queue in targets)
+
+        for group in groups:
+            batches = Container._group_batches(group, items, offsets, priority)
+            deliveries.extend((None, queue, events) for queue, events in batches.items())
+
+        tracer = _tracer
+        if tracer is not None and targets:
+            thread_id = threading.get_ident()
+            for event in deliveries[0][2]:
+                tracer.publish(event, thread_id)
+
+        for i, (target_thread_id, queue, events) in enumerate(deliveries):
+            if tracer is not None and target_thread_id is not None:
+                for event in events:
+                    tracer.enqueue(event, thread_id, target_thread_id)
+            try:
+                await queue.put_many(events, lane=lane)
+            except asyncio.QueueFull:
+                # the full queue released its references, the queues not reached never get theirs
+                for _, _, unreached in deliveries[i + 1:]:
+                    _release_items(unreached)
+                raise
+
+    @staticmethod
+    def _group_batches(group:ConsumerGroup, items:list, offsets:list, priority:Priority) -> map:
+        """
+        The events of items per queue of the member of the group chosen for
+        them. The items of a group emptied since the route was read are
+        released.
+        """
+        batches = {}
+        for i, data in enumerate(items):
+            queue = group.select(data)
+            if queue is None:
+                _release_items((data,))
+                continue
+            event = Container.Event(group.member_queue_name, data, offsets[i] if offsets is not None else None, priority)
+            batches.setdefault(queue, []).append(event)
+        return batches
+
+    async def subscribe(self, queue_name: str, handler, **options) -> map:
+        log.debug(f"[{self.name}] subscribe name:{queue_name}")
+        from_offset = options.pop("from_offset", None)
+        from_time = options.pop("from_time", None)
+        replay = from_offset is not None or from_time is not None
+        if replay and (_journal is None or TopicTrie.is_pattern(queue_name) or not _journal.journaled(queue_name)):
+            raise ValueError(f"the queue {queue_name} is not journaled, it cannot be replayed")
+
+        group = options.pop("group", None)
+        balance = options.pop("balance", Balance.round_robin)
+        key = options.pop("key", None)
+        if group is not None and (replay or TopicTrie.is_pattern(queue_name)):
+            raise ValueError(f"the consumer group {group} of {queue_name} cannot be a pattern or replay the journal")
+        if options.get("offload") is not None and asyncio.iscoroutinefunction(handler):
+            raise ValueError(f"the handler {handler} of {queue_name} is a coroutine function, it cannot be offloaded")
+
+        subscription = Container.Subscription(handler, **options)
+        if replay:
+            subscription.replaying = True
+            subscription.replayed = -1
+
+        # a group member subscribes to the queue of the group
+        queue_name = self.bus.subscribe(queue_name, self.thread_id, self.q_inbound, subscription,
+                                        group=group, balance=balance, key=key)
+
+        subscription.start(self)
+        if replay:
+            reader = _journal.reader(queue_name, from_offset=from_offset, from_time=from_time)
+            subscription.tasks.append(asyncio.ensure_future(self._replay(queue_name, subscription, reader), loop=self.loop))
+
+    async def _replay(self, queue_name: str, subscription, reader):
+        """
+        Deliver the journaled events to the subscription a batch at a time,
+        then switch it to the live events. The end of the journal is checked
+        and the subscription switched without yielding: every live event
+        skipped so far was journaled before and has been replayed.
+        """
+        log.debug(f"[{self.name}][{self.k}] replay name:{queue_name} from offset:{reader.next_offset}")
+        try:
+            while True:
+                records = reader.read(self.batch_size)
+                if not records:
+                    subscription.replayed = reader.next_offset - 1
+                    subscription.replaying = False
+                    break
+
+                for offset, _, data in records:
+                    try:
+                        await subscription.invoke(data=data)
+                    except Exception as e:
+                        log.error(f"[{self.name}][{self.k}] replay handler:{subscription.handler} offset:{offset} Exception type:{type(e)} error:{e}")
+                    subscription.replayed = offset
+                await asyncio.sleep(0)
+        finally:
+            reader.close()
+
+        log.debug(f"[{self.name}][{self.k}] replay name:{queue_name} live from offset:{subscription.replayed + 1}")
+
+    async def unsubscribe(self, queue_name: str, handler) -> bool:
         log.debug(f"[{self.name}] unsubscribe name:{queue_name}")
 
-        if queue_name in self.queues:
-            
-            qref_to_remove = []
+        subscription = self.bus.unsubscribe(queue_name, self.thread_id, handler)
+        if subscription is None:
+            return False
 
-            for thread_id in self.queues[queue_name]:
-                q_ref = self.queues[queue_name][thread_id]
-                
-                if handler in q_ref.handlers: 
-                    q_ref.handlers.remove(handler)
+        self.discarded.update(subscription.stop())
+        return True
+
+    async def _rpc_reply_handler(self, data:RpcReply):
+        self._rpc_complete(data)
 
-                if len(q_ref.handlers) == 0:
-                    qref_to_remove.append(thread_id)
+    def _rpc_complete(self, data:RpcReply):
+        future = self.rpc_pending.pop(data.correlation_id, None)
+        if future is None or future.done():
+            # expired or already answered
+            return
+        if data.error is not None:
+            future.set_exception(data.error)
+        else:
+            future.set_result(data.result)
 
-            for thread_id in qref_to_remove:
-                del self.queues[queue_name][thread_id]
+    async def request(self, queue_name: str, data, timeout: float=5.0):
+        if self.rpc_reply_to is None:
+            self.rpc_reply_to = f"rpc://reply/{self.k}/{self.thread_id}"
+            _rpc_callers[self.rpc_reply_to] = self
+            await self.subscribe(queue_name=self.rpc_reply_to, handler=self._rpc_reply_handler, mode=DispatchMode.inline)
+
+        correlation_id = next(self.rpc_ids)
+        future = self.loop.create_future()
+        self.rpc_pending[correlation_id] = future
+        try:
+            await self.publish(queue_name=queue_name, data=RpcRequest(data, self.rpc_reply_to, correlation_id))
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self.rpc_pending.pop(correlation_id, None)
+
+    async def serve(self, queue_name: str, handler, **options):
+        offload = options.pop("offload", None)
+        if offload is not None and asyncio.iscoroutinefunction(handler):
+            raise ValueError(f"the handler {handler} of {queue_name} is a coroutine function, it cannot be offloaded")
+
+        async def server(data:RpcRequest):
+            try:
+                if offload is not None:
+                    result = await self.run_blocking(handler, data.data, offload=offload)
+                else:
+                    result = await handler(data=data.data)
+                reply = RpcReply(data.correlation_id, result=result)
+            except Exception as e:
+                reply = RpcReply(data.correlation_id, error=e)
+            if not _rpc_resolve(data.reply_to, (reply,)):
+                # the caller is in another process, the replies skip its data backlog
+                await self.publish(queue_name=data.reply_to, data=reply, priority=Priority.high)
+
+        self.rpc_servers[(queue_name, handler)] = server
+        await self.subscribe(queue_name=queue_name, handler=server, **options)
+
+    async def unserve(self, queue_name: str, handler):
+        server = self.rpc_servers.pop((queue_name, handler), None)
+        if server is not None:
+            await self.unsubscribe(queue_name=queue_name, handler=server)
 
     async def dump_queue_tree(self):
         log.info(f"|========================================================")
-        for queue_name in self.queues:
+        for queue_name, entries in self.bus.snapshot.table.items():
             log.info(f"|-- {queue_name}")
-            for thread_id in self.queues[queue_name]:
+            for thread_id, (_, subscriptions) in entries.items():
                 log.info(f"|  |-- {thread_id}")
-                q_ref = self.queues[queue_name][thread_id]
-                for handler in q_ref.handlers:
-                    log.info(f"|     |-- {handler}")
+                for subscription in subscriptions:
+                    log.info(f"|     |-- {subscription}")
         log.info(f"|========================================================")
 
 
@@ -315,26 +2170,238 @@ class Main:
           Main()
       return Main.__instance
 
+    @staticmethod
+    def reset():
+      """
+      Drop the instance, the next instance() creates a new Main (e.g. one
+      per test). The instance must not be running.
+      """
+      if Main.__instance is not None and Main.__instance._running:
+          raise Exception("Main is running, stop it before the reset!")
+      Main.__instance = None
+
     def __init__(self):
         if Main.__instance is not None:
             raise Exception("Main class is a singleton!")
         else:
             Main.__instance = self
 
+        self._lock = threading.RLock()
+        self._running = False
+        self._stop_event = threading.Event()
+        # name -> WorkerPool
+        self.worker_pools = {}
+        # routing table of the pools
+        self.bus = Bus()
+
     service_pools = None        
+
+    # optional Container arguments per pool e.g. {"workers": {"maxsize": 1000, "policy": OverflowPolicy.drop_oldest}}
+    # the option "process": True runs the pool in a separate OS process
+    pool_options = None
+
+    # event loop factory of every pool (e.g. uvloop_factory), a pool can override it with the "loop_factory" option
+    loop_factory = None
     
     loop = None
 
+    # routing table of the pools, a new Bus when None
+    bus:Bus = None
+
+    # on shutdown every pool dispatches its queued events for up to
+    # drain_timeout seconds (None drops them at once) and is waited for up
+    # to shutdown_timeout seconds, all the pools in parallel
+    drain_timeout = None
+    shutdown_timeout = 10.0
+
+    # per pool report of the last shutdown, see Container.terminate()
+    shutdown_report = None
+
+    class WorkerPool:
+        """
+        Identical pools, the replicas, built by factory() (a new list of
+        services for every replica) and named {name}:{index}.
+        """
+
+        def __init__(self, name:str, factory, options:map):
+            self.name = name
+            self.factory = factory
+            self.options = options
+            self.keys = []
+            self._indexes = itertools.count()
+
+        def next_key(self) -> str:
+            return f"{self.name}:{next(self._indexes)}"
+
+    def _create_container(self, k):
+        options = dict((self.pool_options or {}).get(k, {}))
+        if self.loop_factory is not None:
+            options.setdefault("loop_factory", self.loop_factory)
+        options.setdefault("bus", self.bus)
+        if options.pop("process", False):
+            from magic_foundation.process_container import ProcessContainer
+            return ProcessContainer(k, self.service_pools[k], **options)
+        return Container(k, self.service_pools[k], **options)
+
+    containers = ()
+
+    def container(self, k) -> Container:
+        for container in list(self.containers):
+            if container.k == k:
+                return container
+        return None
+
+    def stats(self) -> map:
+        return {container.k: container.stats() for container in list(self.containers)}
+
+    def add_pool(self, k, services:list, **options) -> Container:
+        """
+        Add the pool k running services, with the pool options. Before run()
+        the pool is only registered, while running its container is started
+        and returned. It can be called from any thread.
+        """
+        with self._lock:
+            if self.service_pools is None:
+                self.service_pools = {}
+            if self.pool_options is None:
+                self.pool_options = {}
+            if k in self.service_pools:
+                raise ValueError(f"the pool {k} already exists")
+            self.service_pools[k] = services
+            if options:
+                self.pool_options[k] = options
+            if not self._running:
+                return None
+
+            container = self._create_container(k)
+            self.containers = list(self.containers) + [container]
+        log.debug(f"[main] add pool:{k}")
+        container.start()
+        return container
+
+    async def remove_pool(self, k, timeout:float=5.0) -> bool:
+        """
+        Stop the pool k and forget it: its subscriptions are removed from
+        the bus first, so the new events go to the other members of its
+        consumer groups, then the events already queued are dispatched for
+        up to timeout seconds and its services are terminated.
+        """
+        with self._lock:
+            if self.service_pools is None or k not in self.service_pools:
+                return False
+            del self.service_pools[k]
+            (self.pool_options or {}).pop(k, None)
+            container = self.container(k)
+            self.containers = [c for c in self.containers if c is not container]
+
+        log.debug(f"[main] remove pool:{k}")
+        if container is not None:
+            await container.terminate(drain_timeout=timeout, timeout=timeout + self.shutdown_timeout)
+            await asyncio.get_running_loop().run_in_executor(None, container.join, timeout)
+        return True
+
+    async def add_service(self, k, service:Service):
+        """
+        Start service in the running pool k.
+        """
+        container = self.container(k)
+        if container is None:
+            raise ValueError(f"the pool {k} is not running")
+        await container.add_service(service)
+
+    async def remove_service(self, k, service:Service):
+        """
+        Stop service and remove it from the running pool k.
+        """
+        container = self.container(k)
+        if container is None:
+            raise ValueError(f"the pool {k} is not running")
+        await container.remove_service(service)
+
+    def add_worker_pool(self, name:str, factory, replicas:int=1, **options) -> WorkerPool:
+        """
+        Add a worker pool of replicas pools built by factory(), resized with
+        scale_pool() or by an AutoscalerService. The replicas usually share
+        the work with a consumer group subscription.
+        """
+        with self._lock:
+            if name in self.worker_pools:
+                raise ValueError(f"the worker pool {name} already exists")
+            pool = self.worker_pools[name] = Main.WorkerPool(name, factory, options)
+            for _ in range(replicas):
+                self._add_replica(pool)
+        return pool
+
+    def _add_replica(self, pool:WorkerPool):
+        k = pool.next_key()
+        pool.keys.append(k)
+        self.add_pool(k, pool.factory(), **pool.options)
+
+    def pool_containers(self, name:str) -> list:
+        """
+        The running containers of the worker pool name.
+        """
+        pool = self.worker_pools[name]
+        return [container for container in (self.container(k) for k in list(pool.keys)) if container is not None]
+
+    async def scale_pool(self, name:str, replicas:int, timeout:float=5.0):
+        """
+        Resize the worker pool name to replicas pools, the newest replicas
+        are removed first.
+        """
+        pool = self.worker_pools[name]
+        with self._lock:
+            while len(pool.keys) < replicas:
+                self._add_replica(pool)
+            removed = []
+            while len(pool.keys) > max(replicas, 0):
+                removed.append(pool.keys.pop())
+
+        log.debug(f"[main] scale worker pool:{name} replicas:{replicas}")
+        await asyncio.gather(*[self.remove_pool(k, timeout=timeout) for k in removed])
+
+    def stop(self):
+        """
+        Make run() terminate every pool and return, from any thread.
+        """
+        self._stop_event.set()
+
+    def _join(self):
+        # the pools can be added and removed while running
+        while not self._stop_event.is_set():
+            if not any(container.is_alive() for container in list(self.containers)):
+                return
+            self._stop_event.wait(timeout=0.2)
+
+    async def _terminate_all(self, containers:list) -> list:
+        reports = await asyncio.gather(*[container.terminate(drain_timeout=self.drain_timeout,
+                                                             timeout=self.shutdown_timeout)
+                                         for container in containers])
+        dropped = sum(report["dropped"] for report in reports)
+        timed_out = [report["container"] for report in reports if report["timed_out"]]
+        if dropped or timed_out:
+            log.warning(f"[main] shutdown dropped:{dropped} timed out:{timed_out}")
+        return reports
+
     def run(self):
-        self.loop = asyncio.get_event_loop()
+        self.loop = (self.loop_factory or default_loop_factory)()
+        if self.bus is None:
+            self.bus = Bus()
         try:
-            threads = [Container(k, self.service_pools[k]) for k in self.service_pools]
+            with self._lock:
+                self._running = True
+                threads = self.containers = [self._create_container(k) for k in self.service_pools]
             [t.start() for t in threads]
-            [t.join() for t in threads]
+            self._join()
         except KeyboardInterrupt:
             log.debug(f"[main] KeyboardInterrupt")
         except RuntimeError:
             log.error(f"[main] RuntimeError")
         finally:
-            [self.loop.run_until_complete(t.terminate()) for t in threads]
+            with self._lock:
+                self._running = False
+                threads = list(self.containers)
+            self.shutdown_report = self.loop.run_until_complete(self._terminate_all(threads))
             self.loop.close()
+            # the next run() waits for its own stop()
+            self._stop_event.clear()
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import math
+import time
+
+
+from magic_foundation import Service, ServiceStatus, ServiceContext
+
+
+__all__ = ('AutoscalerService',)
+
+log = logging.getLogger(__name__)
+
+
+class AutoscalerService(Service):
+    """
+    Grow or shrink a worker pool of Main between min_replicas and
+    max_replicas.
+
+    Every interval_sec the inbound queue depth and the mean handler latency
+    of the replicas are compared to target_depth (events per replica) and
+    target_latency (seconds, optional): the pool is resized in proportion to
+    the largest ratio, the changes within tolerance are ignored. The pool
+    grows at once and shrinks only when no larger size was wanted during the
+    last cooldown_sec.
+    """
+
+    def __init__(self, main, pool:str, min_replicas:int=1, max_replicas:int=4, target_depth:int=1000,
+                 target_latency:float=None, interval_sec:float=1.0, cooldown_sec:float=30.0, tolerance:float=0.1):
+        self.name = f"AutoscalerService:{pool}"
+        self.main = main
+        self.pool = pool
+        self.min_replicas = min_replicas
+        self.max_replicas = max_replicas
+        self.target_depth = target_depth
+        self.target_latency = target_latency
+        self.interval_sec = interval_sec
+        self.cooldown_sec = cooldown_sec
+        self.tolerance = tolerance
+        self.task = None
+
+        # container -> (handled events, handler seconds) at the last sample
+        self._handled = {}
+        # (time, wanted replicas) within the cooldown
+        self._wanted = []
+
+        self.scale_ups = 0
+        self.scale_downs = 0
+
+    async def initialize(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] initialize")
+
+    async def run(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] run")
+
+        self.task = asyncio.ensure_future(self._scale_handler())
+
+    async def _scale_handler(self):
+        while self.status is ServiceStatus.running:
+            await asyncio.sleep(self.interval_sec)
+            try:
+                await self.scale()
+            except Exception as e:
+                log.error(f"[{self.name}] scale ERROR type:{type(e)} error:{e}")
+
+    def sample(self, stats:list) -> tuple:
+        """
+        The mean inbound depth and the mean handler latency (None when no
+        event was handled) of the replicas since the last sample.
+        """
+        depth = sum((s.get("inbound") or {}).get("depth", 0) for s in stats) / max(len(stats), 1)
+
+        handled, seconds = 0, 0.0
+        last = {}
+        for s in stats:
+            count = sum(h["count"] for h in s.get("handlers", {}).values())
+            total = sum(h["sum"] for h in s.get("handlers", {}).values())
+            previous_count, previous_total = self._handled.get(s["container"], (0, 0.0))
+            handled += count - previous_count
+            seconds += total - previous_total
+            last[s["container"]] = (count, total)
+        self._handled = last
+
+        return depth, (seconds / handled if handled > 0 else None)
+
+    def desired(self, replicas:int, depth:float, latency:float=None, now:float=None) -> int:
+        """
+        The number of replicas wanted for the sampled depth and latency.
+        """
+        now = time.monotonic() if now is None else now
+
+        ratio = depth / self.target_depth
+        if self.target_latency is not None and latency is not None:
+            ratio = max(ratio, latency / self.target_latency)
+
+        wanted = replicas
+        if abs(ratio - 1.0) > self.tolerance:
+            wanted = math.ceil(replicas * ratio)
+        wanted = min(max(wanted, self.min_replicas), self.max_replicas)
+
+        self._wanted = [(t, n) for t, n in self._wanted if now - t < self.cooldown_sec] + [(now, wanted)]
+        if wanted < replicas:
+            # shrink to the largest size wanted during the cooldown
+            wanted = min(max(n for _, n in self._wanted), replicas)
+        return wanted
+
+    async def scale(self):
+        containers = self.main.pool_containers(self.pool)
+        replicas = len(containers)
+        depth, latency = self.sample([container.stats() for container in containers])
+        wanted = self.desired(replicas, depth, latency)
+        if wanted == replicas:
+            return
+
+        log.info(f"[{self.name}] scale replicas:{replicas} -> {wanted} depth:{depth:.0f} latency:{latency}")
+        if wanted > replicas:
+            self.scale_ups += 1
+        else:
+            self.scale_downs += 1
+        await self.main.scale_pool(self.pool, wanted)
+
+    async def terminate(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] terminate")
+
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,435 @@
+import bisect
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+from enum import Enum
+from magic_foundation import SharedPayload, TopicTrie
+
+
+__all__ = ('Journal', 'JournalReader', 'SyncPolicy')
+
+log = logging.getLogger(__name__)
+
+
+# offset, timestamp, body length, body crc32
+RECORD = struct.Struct("<QdII")
+# offset, timestamp, position in the segment
+INDEX_ENTRY = struct.Struct("<QdQ")
+
+
+class SyncPolicy(Enum):
+    """
+    When the journal fsyncs the segments, the records written since the last
+    fsync are in the page cache only and lost if the machine crashes.
+    """
+    # never, left to the OS
+    never = 0
+    # a segment when it is rolled and on close
+    segment = 1
+    # also the active segment every sync_interval seconds, in a background thread
+    interval = 2
+    # also every append, on the publishing thread
+    always = 3
+
+
+class _Segment:
+    """
+    An append-only file of records starting at base_offset and its sparse
+    index, kept in memory and in the .index file next to it.
+    """
+
+    def __init__(self, directory:str, base_offset:int):
+        self.base_offset = base_offset
+        self.path = os.path.join(directory, f"{base_offset:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}.index")
+        self.size = 0
+        self.offsets = []
+        self.timestamps = []
+        self.positions = []
+        self.file = None
+        self.index_file = None
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        for i in range(len(data) // INDEX_ENTRY.size):
+            offset, timestamp, position = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+            self.offsets.append(offset)
+            self.timestamps.append(timestamp)
+            self.positions.append(position)
+
+    def add_index(self, offset:int, timestamp:float, position:int):
+        self.offsets.append(offset)
+        self.timestamps.append(timestamp)
+        self.positions.append(position)
+        self.index_file.write(INDEX_ENTRY.pack(offset, timestamp, position))
+
+    def open(self):
+        self.file = open(self.path, "ab", buffering=0)
+        self.index_file = open(self.index_path, "ab", buffering=0)
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    def close(self):
+        for f in (self.file, self.index_file):
+            if f is not None:
+                f.close()
+        self.file = None
+        self.index_file = None
+
+    def seek_offset(self, offset:int) -> tuple:
+        """
+        The (offset, position) of the closest indexed record at or before offset.
+        """
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        if i < 0:
+            return self.base_offset, 0
+        return self.offsets[i], self.positions[i]
+
+    def seek_time(self, timestamp:float) -> tuple:
+        i = bisect.bisect_left(self.timestamps, timestamp) - 1
+        if i < 0:
+            return self.base_offset, 0
+        return self.offsets[i], self.positions[i]
+
+
+def _scan(buffer, position:int, end:int):
+    """
+    Yield the (offset, timestamp, body, next position) of the valid records
+    of buffer between position and end.
+    """
+    while position + RECORD.size <= end:
+        offset, timestamp, length, crc = RECORD.unpack_from(buffer, position)
+        start = position + RECORD.size
+        if start + length > end:
+            return
+        body = buffer[start:start + length]
+        if zlib.crc32(body) != crc:
+            return
+        position = start + length
+        yield offset, timestamp, body, position
+
+
+class _Log:
+    """
+    The journal of a single queue: a directory of segments.
+    """
+
+    def __init__(self, directory:str, segment_bytes:int, index_interval:int, sync:SyncPolicy):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.sync_policy = sync
+        self.lock = threading.Lock()
+        self.segments = []
+        self.next_offset = 0
+        self.dirty = False
+        self._indexed_at = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        base_offsets = sorted(int(name[:-len(".log")]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for base_offset in base_offsets:
+            segment = _Segment(self.directory, base_offset)
+            segment.load_index()
+            segment.size = os.path.getsize(segment.path)
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(_Segment(self.directory, 0))
+        active = self.segments[-1]
+
+        # find the end of the last complete record, a torn write is truncated
+        if active.offsets:
+            self.next_offset, position = active.offsets[-1], active.positions[-1]
+        else:
+            self.next_offset, position = active.base_offset, 0
+        if active.size > 0:
+            with open(active.path, "rb") as f:
+                data = f.read()
+            for offset, _, _, end in _scan(data, position, len(data)):
+                self.next_offset, position = offset + 1, end
+            if position < active.size:
+                log.warning(f"[Journal] truncate {active.path} at {position} of {active.size} bytes")
+                os.truncate(active.path, position)
+                active.size = position
+                while active.positions and active.positions[-1] >= position:
+                    active.offsets.pop()
+                    active.timestamps.pop()
+                    active.positions.pop()
+                with open(active.index_path, "wb") as f:
+                    for entry in zip(active.offsets, active.timestamps, active.positions):
+                        f.write(INDEX_ENTRY.pack(*entry))
+
+        self._indexed_at = active.positions[-1] if active.positions else -self.index_interval
+        active.open()
+
+    def _roll(self, base_offset:int) -> _Segment:
+        segment = self.segments[-1]
+        if self.sync_policy is not SyncPolicy.never:
+            segment.sync()
+        segment.close()
+        segment = _Segment(self.directory, base_offset)
+        segment.open()
+        self.segments.append(segment)
+        self._indexed_at = -self.index_interval
+        return segment
+
+    def append(self, bodies:list) -> int:
+        """
+        Append the bodies with a single write per segment and return the
+        offset of the first one.
+        """
+        timestamp = time.time()
+        with self.lock:
+            first = offset = self.next_offset
+            segment = self.segments[-1]
+            position = segment.size
+            chunk = []
+            for body in bodies:
+                if position > 0 and position + RECORD.size + len(body) > self.segment_bytes:
+                    # the segment is complete before the next one exists, see JournalReader.read
+                    segment.file.write(b"".join(chunk))
+                    segment.size = position
+                    chunk = []
+                    segment = self._roll(offset)
+                    position = 0
+
+                if position - self._indexed_at >= self.index_interval:
+                    segment.add_index(offset, timestamp, position)
+                    self._indexed_at = position
+
+                chunk.append(RECORD.pack(offset, timestamp, len(body), zlib.crc32(body)))
+                chunk.append(body)
+                position += RECORD.size + len(body)
+                offset += 1
+
+            segment.file.write(b"".join(chunk))
+            segment.size = position
+            self.next_offset = offset
+            if self.sync_policy is SyncPolicy.always:
+                os.fsync(segment.file.fileno())
+            else:
+                self.dirty = True
+        return first
+
+    def sync(self):
+        """
+        fsync the active segment if written since the last sync. The fsync
+        runs on a duplicate of the descriptor out of the lock, so the appends
+        are not blocked meanwhile.
+        """
+        with self.lock:
+            segment = self.segments[-1]
+            if not self.dirty or segment.file is None:
+                return
+            self.dirty = False
+            fd = os.dup(segment.file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def segment_for_offset(self, offset:int) -> int:
+        base_offsets = [segment.base_offset for segment in self.segments]
+        return max(bisect.bisect_right(base_offsets, offset) - 1, 0)
+
+    def segment_for_time(self, timestamp:float) -> int:
+        first_timestamps = [segment.timestamps[0] if segment.timestamps else float("inf") for segment in self.segments]
+        return max(bisect.bisect_left(first_timestamps, timestamp) - 1, 0)
+
+    def close(self):
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.file is not None and self.sync_policy is not SyncPolicy.never:
+                segment.sync()
+            segment.close()
+
+
+class JournalReader:
+    """
+    Stream the records of a queue journal from an offset or a timestamp. The
+    segments are memory mapped and read a batch at a time, the records
+    appended while reading are returned as well.
+    """
+
+    def __init__(self, log_:_Log, from_offset:int=None, from_time:float=None):
+        self.log = log_
+        self.from_offset = max(from_offset or 0, 0)
+        self.from_time = from_time
+        self._mmap = None
+        self._mapped = 0
+
+        if from_time is not None:
+            self.segment = log_.segment_for_time(from_time)
+            self.next_offset, self.position = log_.segments[self.segment].seek_time(from_time)
+        else:
+            self.segment = log_.segment_for_offset(self.from_offset)
+            self.next_offset, self.position = log_.segments[self.segment].seek_offset(self.from_offset)
+
+    def _remap(self, segment:_Segment) -> bool:
+        size = segment.size
+        if size <= self._mapped:
+            return False
+        self.close()
+        with open(segment.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self._mapped = size
+        return True
+
+    def read(self, n:int) -> list:
+        """
+        Up to n (offset, timestamp, data) records, an empty list at the end
+        of the journal.
+        """
+        records = []
+        while True:
+            if self._mmap is not None:
+                for offset, timestamp, body, position in _scan(self._mmap, self.position, self._mapped):
+                    self.position = position
+                    self.next_offset = offset + 1
+                    if offset < self.from_offset:
+                        continue
+                    if self.from_time is not None:
+                        if timestamp < self.from_time:
+                            continue
+                        self.from_time = None
+                    records.append((offset, timestamp, pickle.loads(body)))
+                    if len(records) >= n:
+                        return records
+
+            # end of the mapping: the segment has grown, or is complete when
+            # a newer one exists (checked first, the writer rolls after the
+            # last write to the segment)
+            segments = self.log.segments
+            last = self.segment + 1 >= len(segments)
+            if self._remap(segments[self.segment]):
+                continue
+            if last:
+                return records
+            self.close()
+            self.segment += 1
+            self.position = 0
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._mapped = 0
+
+
+class Journal:
+    """
+    Append-only journal of the events published to the selected queue names
+    (exact names or patterns).
+
+    Every journaled queue has its own directory of segments of up to
+    segment_bytes, each record gets a sequential offset and a timestamp, a
+    sparse index entry is written every index_interval bytes. Install it with
+    set_journal() and replay a queue with
+    ctx.subscribe(..., from_offset=...) or from_time=...
+
+    The records are pickled and written to the page cache by the publishing
+    thread, publish_many writes a batch at once. How much survives a machine
+    crash depends on sync (see SyncPolicy), by default at most the last
+    sync_interval seconds are lost.
+    """
+
+    def __init__(self, directory:str, queue_names:list, segment_bytes:int=64 * 1024 * 1024, index_interval:int=4096,
+                 sync:SyncPolicy=SyncPolicy.interval, sync_interval:float=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.exact = set()
+        self.patterns = TopicTrie()
+        for queue_name in queue_names:
+            if TopicTrie.is_pattern(queue_name):
+                self.patterns.insert(queue_name, True)
+            else:
+                self.exact.add(queue_name)
+        self._journaled = {}
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._syncer = None
+        if sync is SyncPolicy.interval:
+            self._syncer = threading.Thread(target=self._sync_loop, name="journal-sync", daemon=True)
+            self._syncer.start()
+
+    def journaled(self, queue_name:str) -> bool:
+        journaled = self._journaled.get(queue_name)
+        if journaled is None:
+            journaled = self._journaled[queue_name] = queue_name in self.exact or bool(self.patterns.match(queue_name))
+        return journaled
+
+    def _log(self, queue_name:str) -> _Log:
+        log_ = self._logs.get(queue_name)
+        if log_ is None:
+            with self._lock:
+                log_ = self._logs.get(queue_name)
+                if log_ is None:
+                    directory = os.path.join(self.directory, urllib.parse.quote(queue_name, safe=""))
+                    log_ = self._logs[queue_name] = _Log(directory, self.segment_bytes, self.index_interval, self.sync)
+        return log_
+
+    def append(self, queue_name:str, data) -> int:
+        """
+        Append data to the journal of queue_name and return its offset.
+        """
+        return self._log(queue_name).append([self._body(data)])
+
+    def append_many(self, queue_name:str, items:list) -> list:
+        """
+        Append the items to the journal of queue_name with a single write
+        and return their offsets.
+        """
+        first = self._log(queue_name).append([self._body(data) for data in items])
+        return list(range(first, first + len(items)))
+
+    @staticmethod
+    def _body(data) -> bytes:
+        if isinstance(data, SharedPayload):
+            data = data.tobytes()
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def end_offset(self, queue_name:str) -> int:
+        """
+        The offset the next event of queue_name will get.
+        """
+        return self._log(queue_name).next_offset
+
+    def reader(self, queue_name:str, from_offset:int=None, from_time:float=None) -> JournalReader:
+        return JournalReader(self._log(queue_name), from_offset=from_offset, from_time=from_time)
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        fsync the records appended since the last flush.
+        """
+        for log_ in list(self._logs.values()):
+            log_.sync()
+
+    def close(self):
+        self._closed.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        for log_ in list(self._logs.values()):
+            log_.close()
@@ -1,11 +1,17 @@
-import aiofiles
 import asyncio
+import concurrent.futures
 import datetime
+import glob
+import gzip
 import json
 import logging
+import os
+import re
+import shutil
+import time
 
 
-from magic_foundation import Service, ServiceStatus, ServiceContext
+from magic_foundation import DispatchMode, Service, ServiceStatus, ServiceContext
 
 
 __all__ = ('LoggingService')
@@ -14,37 +20,231 @@ log = logging.getLogger(__name__)
 
 
 class LoggingService(Service):
-
-    def __init__(self, file_path:str, flush_interval_sec=5.0):
+    """
+    Append the messages published to log://{file_path} as JSON lines.
+
+    The messages are serialized in the loop, in order, into a batch buffer
+    written with a single write in the default executor when it reaches
+    flush_size bytes or every flush_interval_sec. The buffer is drained in
+    terminate. A failed write is retried every flush_interval_sec, meanwhile
+    the messages beyond max_buffer bytes are dropped.
+
+    The file is rotated, between two batches, once it exceeds max_bytes or
+    is older than rotate_interval_sec: it is renamed {file_path}.{timestamp}
+    and gzip compressed by a background thread, only the newest backup_count
+    rotated files are kept.
+    """
+
+    def __init__(self, file_path:str, flush_interval_sec=5.0, flush_size:int=64 * 1024, max_buffer:int=16 * 1024 * 1024,
+                 max_bytes:int=None, rotate_interval_sec:float=None, backup_count:int=None, compress:bool=True):
         self.name = f"LoggingService:{file_path}"
         self.file_path = file_path
         self.flush_interval_sec = flush_interval_sec
+        self.flush_size = flush_size
+        self.max_buffer = max_buffer
+        self.max_bytes = max_bytes
+        self.rotate_interval_sec = rotate_interval_sec
+        self.backup_count = backup_count
+        self.compress = compress
         self.queue_name = f"log://{self.file_path}"
+        self.file = None
+        self.file_size = 0
+        # bytes of the last batch not written
+        self.unwritten = 0
+        self.opened_at = None
+        self.compressor = None
+        self.handler = None
+
+        self.buffer = []
+        self.buffered = 0
+        self.flush_event = None
+        self.flush_task = None
+
+        self.lines = 0
+        self.flushes = 0
+        self.rotations = 0
+        self.write_errors = 0
+        self.dropped = 0
 
     async def initialize(self, ctx:ServiceContext):
         log.info(f"[{self.name}] initialize")
 
-        self.writer = await aiofiles.open(self.file_path, mode='a', encoding="utf-8", newline='\n')
+        self._open()
+        self.flush_event = asyncio.Event()
+        if self.compress and (self.max_bytes is not None or self.rotate_interval_sec is not None):
+            self.compressor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
 
     async def run(self, ctx:ServiceContext):
         log.info(f"[{self.name}] run")
 
         async def handler(data:map):
-            await self.writer.write(f"{json.dumps(data)}\n")
+            line = f"{json.dumps(data)}\n".encode("utf-8")
+            if self.buffered + len(line) > self.max_buffer:
+                # the writes are failing
+                self.dropped += 1
+                return
+            self.buffer.append(line)
+            self.buffered += len(line)
+            if self.buffered >= self.flush_size:
+                self.flush_event.set()
 
         self.handler = handler
 
-        await ctx.subscribe(queue_name=self.queue_name, handler=self.handler)
-        
+        # inline: the lines are buffered in publishing order without a Task per message
+        await ctx.subscribe(queue_name=self.queue_name, handler=self.handler, mode=DispatchMode.inline)
+
+        self.flush_task = asyncio.ensure_future(self._flush_handler())
+
+    async def _flush_handler(self):
         while self.status is ServiceStatus.running:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), timeout=self.flush_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+
             log.debug(f"[{self.name}] run flush the {self.file_path} file")
-            await self.writer.flush()
-            await asyncio.sleep(self.flush_interval_sec)        
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"[{self.name}] flush ERROR type:{type(e)} error:{e} buffered:{self.buffered} dropped:{self.dropped}")
+                # the batch is kept, retry later
+                await asyncio.sleep(self.flush_interval_sec)
+
+    async def flush(self):
+        """
+        Write the buffered lines. The flushes are made by a single task, or
+        by terminate once it is stopped, so the lines are never reordered.
+        When the write fails the lines are put back in front of the buffer
+        and the error is raised.
+        """
+        if not self.buffer:
+            return
+
+        lines, self.buffer, self.buffered = self.buffer, [], 0
+        chunk = b"".join(lines)
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, chunk)
+        except Exception:
+            self.write_errors += 1
+            # the part of the batch not written
+            rest = chunk[len(chunk) - self.unwritten:]
+            self.buffer = [rest] + self.buffer
+            self.buffered += len(rest)
+            raise
+
+        self.lines += len(lines)
+        self.flushes += 1
+
+    def _open(self):
+        self.file = open(self.file_path, mode="ab", buffering=0)
+        self.file_size = os.fstat(self.file.fileno()).st_size
+        self.opened_at = time.time()
+
+    def _write(self, chunk:bytes):
+        self.unwritten = len(chunk)
+        if self.file.closed:
+            # a rotation failed
+            self._open()
+        if self._should_rotate(len(chunk)):
+            self._rotate()
+
+        view = memoryview(chunk)
+        try:
+            while view:
+                view = view[self.file.write(view):]
+        finally:
+            self.file_size += len(chunk) - len(view)
+            self.unwritten = len(view)
+
+    def _should_rotate(self, size:int) -> bool:
+        if self.file_size == 0:
+            return False
+        if self.max_bytes is not None and self.file_size + size > self.max_bytes:
+            return True
+        if self.rotate_interval_sec is not None and time.time() - self.opened_at >= self.rotate_interval_sec:
+            return True
+        return False
+
+    def _rotate(self):
+        """
+        Called by the writer between two batches: a batch is never split
+        across two files.
+        """
+        self.file.close()
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        rotated_path = f"{self.file_path}.{timestamp}"
+        os.replace(self.file_path, rotated_path)
+        self._open()
+        self.rotations += 1
+
+        log.debug(f"[{self.name}] rotate {self.file_path} to {rotated_path}")
+
+        if self.compressor is not None:
+            self.compressor.submit(self._compress, rotated_path)
+        else:
+            self._apply_retention()
+
+    def _compress(self, rotated_path:str):
+        try:
+            tmp_path = f"{rotated_path}.gz.tmp"
+            with open(rotated_path, "rb") as f_in, gzip.open(tmp_path, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(tmp_path, f"{rotated_path}.gz")
+            os.unlink(rotated_path)
+        except FileNotFoundError:
+            # already removed by the retention
+            pass
+        except Exception as e:
+            log.error(f"[{self.name}] compress {rotated_path} ERROR type:{type(e)} error:{e}")
+
+        self._apply_retention()
+
+    def rotated_files(self) -> list:
+        """
+        The rotated files, oldest first: only {file_path}.{timestamp} and
+        {file_path}.{timestamp}.gz, not the other files sharing the prefix.
+        """
+        rotated = re.compile(re.escape(self.file_path) + r"\.\d{8}-\d{6}-\d{6}(\.gz)?")
+        paths = glob.glob(f"{glob.escape(self.file_path)}.*")
+        return sorted(path for path in paths if rotated.fullmatch(path))
+
+    def _apply_retention(self):
+        if self.backup_count is None:
+            return
+
+        rotated = self.rotated_files()
+        for path in rotated[:max(len(rotated) - self.backup_count, 0)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
     async def terminate(self, ctx:ServiceContext):
         log.info(f"[{self.name}] terminate")
 
-        if self.writer is not None:
-            await self.writer.flush()
-
-        await ctx.unsubscribe(queue_name=self.queue_name, handler=self.handler)
\ No newline at end of file
+        if self.handler is not None:
+            await ctx.unsubscribe(queue_name=self.queue_name, handler=self.handler)
+
+        if self.flush_task is not None:
+            self.flush_event.set()
+            try:
+                await self.flush_task
+            except Exception as e:
+                log.error(f"[{self.name}] terminate flush ERROR type:{type(e)} error:{e}")
+
+        if self.file is not None:
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"[{self.name}] terminate flush ERROR type:{type(e)} error:{e} lost:{len(self.buffer)} lines")
+            self.file.close()
+            self.file = None
+
+        if self.compressor is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.compressor.shutdown)
+            self.compressor = None
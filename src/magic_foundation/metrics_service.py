@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+
+
+from magic_foundation import Service, ServiceStatus, ServiceContext
+
+
+__all__ = ('MetricsService',)
+
+log = logging.getLogger(__name__)
+
+
+def _labels(**labels) -> str:
+    values = ",".join(f'{k}="{str(v)}"'.replace("\n", " ") for k, v in labels.items())
+    return f"{{{values}}}"
+
+
+def prometheus_text(stats:list) -> str:
+    """
+    Render the statistics of the containers in the Prometheus text format.
+    """
+    lines = []
+
+    def metric(name:str, kind:str, help:str):
+        lines.append(f"# HELP magic_foundation_{name} {help}")
+        lines.append(f"# TYPE magic_foundation_{name} {kind}")
+
+    metric("published_total", "counter", "Messages published per container and queue.")
+    for s in stats:
+        for queue_name, n in s.get("published", {}).items():
+            lines.append(f"magic_foundation_published_total{_labels(container=s['container'], queue=queue_name)} {n}")
+
+    metric("delivered_total", "counter", "Messages delivered to handlers per container and queue.")
+    for s in stats:
+        for queue_name, n in s.get("delivered", {}).items():
+            lines.append(f"magic_foundation_delivered_total{_labels(container=s['container'], queue=queue_name)} {n}")
+
+    metric("coalesced_total", "counter", "Messages replaced by a newer one in a conflating subscription per container and queue.")
+    for s in stats:
+        for queue_name, n in s.get("coalesced", {}).items():
+            lines.append(f"magic_foundation_coalesced_total{_labels(container=s['container'], queue=queue_name)} {n}")
+
+    metric("dropped_total", "counter", "Messages dropped by the inbound queue per container and policy.")
+    for s in stats:
+        inbound = s.get("inbound") or {}
+        for reason in ("dropped_newest", "dropped_oldest", "rejected"):
+            lines.append(f"magic_foundation_dropped_total{_labels(container=s['container'], reason=reason)} {inbound.get(reason, 0)}")
+
+    metric("queue_dropped_total", "counter", "Messages dropped by the inbound queue or the queue of a pool subscription per container and queue.")
+    for s in stats:
+        dropped = collections.Counter((s.get("inbound") or {}).get("dropped_by_queue", {}))
+        dropped.update(s.get("rejected_by_queue", {}))
+        for queue_name, n in dropped.items():
+            lines.append(f"magic_foundation_queue_dropped_total{_labels(container=s['container'], queue=queue_name)} {n}")
+
+    metric("inbound_depth", "gauge", "Messages waiting in the inbound queue.")
+    for s in stats:
+        inbound = s.get("inbound") or {}
+        lines.append(f"magic_foundation_inbound_depth{_labels(container=s['container'])} {inbound.get('depth', 0)}")
+
+    metric("loop_lag_seconds", "gauge", "Last measured event loop lag.")
+    for s in stats:
+        loop_lag = s.get("loop_lag") or {}
+        lines.append(f"magic_foundation_loop_lag_seconds{_labels(container=s['container'])} {loop_lag.get('last', 0.0)}")
+
+    metric("handler_seconds", "histogram", "Handler execution time per container and queue, of the sampled messages.")
+    for s in stats:
+        for queue_name, histogram in s.get("handlers", {}).items():
+            for le, n in histogram["buckets"]:
+                lines.append(f"magic_foundation_handler_seconds_bucket{_labels(container=s['container'], queue=queue_name, le=le)} {n}")
+            lines.append(f"magic_foundation_handler_seconds_bucket{_labels(container=s['container'], queue=queue_name, le='+Inf')} {histogram['count']}")
+            lines.append(f"magic_foundation_handler_seconds_sum{_labels(container=s['container'], queue=queue_name)} {histogram['sum']}")
+            lines.append(f"magic_foundation_handler_seconds_count{_labels(container=s['container'], queue=queue_name)} {histogram['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsService(Service):
+    """
+    Export the statistics of every running container, in the Prometheus text
+    format on http://host:port/metrics and/or as a JSON file rewritten every
+    interval_sec.
+    """
+
+    def __init__(self, host:str="127.0.0.1", port:int=None, file_path:str=None, interval_sec:float=10.0):
+        self.name = f"MetricsService:{host}:{port}:{file_path}"
+        self.host = host
+        self.port = port
+        self.file_path = file_path
+        self.interval_sec = interval_sec
+        self.server = None
+
+    async def initialize(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] initialize")
+
+    async def run(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] run")
+
+        if self.port is not None:
+            async def handler(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+                try:
+                    request = await reader.readline()
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+
+                    if request.split(b" ")[1:2] == [b"/metrics"]:
+                        status, body = "200 OK", prometheus_text(ctx.stats(all_containers=True))
+                    else:
+                        status, body = "404 Not Found", ""
+
+                    body = body.encode("utf-8")
+                    writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode("utf-8") + body)
+                    await writer.drain()
+                except Exception as e:
+                    log.error(f"[{self.name}] handler ERROR type:{type(e)} error:{e}")
+                finally:
+                    writer.close()
+
+            self.server = await asyncio.start_server(handler, host=self.host, port=self.port)
+
+            log.info(f"[{self.name}] run serving on port:{self.port}")
+
+        while self.file_path is not None and self.status is ServiceStatus.running:
+            self.dump(ctx)
+            await asyncio.sleep(self.interval_sec)
+
+    def dump(self, ctx:ServiceContext):
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(ctx.stats(all_containers=True), f)
+        os.replace(tmp_path, self.file_path)
+
+    async def terminate(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] terminate")
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+        if self.file_path is not None:
+            self.dump(ctx)
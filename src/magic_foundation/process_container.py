@@ -0,0 +1,357 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+
+
+from magic_foundation import Container, Priority, Queue, _release_items, _rpc_resolve, get_journal, set_journal
+from magic_foundation.shared_payload import SharedPayload
+
+
+__all__ = ('ProcessContainer',)
+
+log = logging.getLogger(__name__)
+
+
+class PipeBridge:
+    """
+    Full duplex link over a multiprocessing Connection.
+
+    A reader thread receives the messages and hands them to a Queue owned
+    by a runloop, a writer thread sends the messages queued by send(), so the
+    runloop never blocks on the pipe.
+    """
+
+    def __init__(self, conn, inbound:Queue, label:str=""):
+        self.conn = conn
+        self.inbound = inbound
+        self.label = label
+        self._outbound = queue.SimpleQueue()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+
+    def start(self):
+        self._reader.start()
+        self._writer.start()
+
+    def send(self, message:tuple):
+        self._outbound.put(message)
+
+    def close(self, timeout:float=1.0):
+        self._outbound.put(None)
+        self._writer.join(timeout=timeout)
+
+    def _read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            self.inbound.put_nowait(message)
+        self.inbound.put_nowait(("closed",))
+
+    def _write(self):
+        while True:
+            message = self._outbound.get()
+            if message is None:
+                break
+            try:
+                self.conn.send(message)
+            except (BrokenPipeError, OSError) as e:
+                log.debug(f"[PipeBridge][{self.label}] send error:{e}")
+                break
+
+
+def _publish_groups(items):
+    """
+    Group the (queue_name, priority, data) items by consecutive queue_name
+    and priority.
+    """
+    for (queue_name, priority), group in itertools.groupby(items, key=lambda item: item[:2]):
+        yield queue_name, priority, [data for _, _, data in group]
+
+
+class _ChildContainer(Container):
+    """
+    The Container running in the child process: local publish and subscribe
+    are mirrored to the parent ProcessContainer through the pipe.
+    """
+
+    name = "ChildContainer"
+
+    def __init__(self, k, services, conn, **options):
+        Container.__init__(self, k, services, **options)
+        self.conn = conn
+        self.bridge = None
+        self.bridge_task = None
+        self._outbox = []
+
+    async def _services_start(self):
+        self.q_bridge = Queue(thread_id=self.thread_id, loop=self.loop, label=f"{self.thread_id}:bridge")
+        self.bridge = PipeBridge(self.conn, self.q_bridge, label=f"{self.k}")
+        self.bridge.start()
+        self.bridge_task = asyncio.ensure_future(self._bridge_handler(), loop=self.loop)
+
+        return await Container._services_start(self)
+
+    async def _services_stop(self):
+        await Container._services_stop(self)
+
+        self._flush()
+        if self.bridge_task is not None:
+            self.bridge_task.cancel()
+
+    async def _bridge_handler(self):
+        while True:
+            messages = await self.q_bridge.get_many(self.batch_size)
+            for message in messages:
+                command = message[0]
+                if command == "events":
+                    for queue_name, priority, items in _publish_groups(message[1]):
+                        if _rpc_resolve(queue_name, items):
+                            continue
+                        await Container.publish_many(self, queue_name=queue_name, items=items, priority=priority)
+                elif command == "stop":
+                    # drain the inbound queue as requested by the parent
+                    self._shutdown_request = message[1] or 0
+                    self._begin_shutdown()
+                    return
+                elif command == "closed":
+                    self.loop.stop()
+                    return
+
+    def _forward(self, items):
+        if not self._outbox:
+            self.loop.call_soon(self._flush)
+        self._outbox.extend(items)
+
+    def _flush(self):
+        if self._outbox:
+            outbox, self._outbox = self._outbox, []
+            self.bridge.send(("publish", outbox))
+
+    async def publish(self, queue_name: str, data: map, priority:Priority=None):
+        # one more reference for the parent process
+        if isinstance(data, SharedPayload):
+            data.retain()
+        await Container.publish(self, queue_name=queue_name, data=data, priority=priority)
+        self._forward(((queue_name, priority, data),))
+
+    async def publish_many(self, queue_name: str, items: list, priority:Priority=None):
+        for data in items:
+            if isinstance(data, SharedPayload):
+                data.retain()
+        await Container.publish_many(self, queue_name=queue_name, items=items, priority=priority)
+        self._forward([(queue_name, priority, data) for data in items])
+
+    async def subscribe(self, queue_name: str, handler, **options) -> map:
+        await Container.subscribe(self, queue_name=queue_name, handler=handler, **options)
+        # the parent joins the consumer group on behalf of the child (the key must be picklable)
+        group_options = {name: options[name] for name in ("group", "balance", "key") if name in options}
+        self.bridge.send(("subscribe", queue_name, group_options))
+
+    async def unsubscribe(self, queue_name: str, handler) -> bool:
+        removed = await Container.unsubscribe(self, queue_name=queue_name, handler=handler)
+        if removed:
+            self.bridge.send(("unsubscribe", queue_name))
+        return removed
+
+
+def _child_main(k, services, conn, options:dict):
+    # the parent coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the events published in the child are journaled by the parent
+    set_journal(None)
+
+    container = _ChildContainer(k, services, conn, **options)
+    container.start()
+    container.join()
+
+    if container.bridge is not None:
+        container.bridge.close()
+    conn.close()
+
+
+class ProcessContainer(Container):
+    """
+    Run the services of a pool in a separate OS process.
+
+    In the parent process the ProcessContainer is a thread standing in for
+    the child on the bus: the subscriptions made in the child are registered
+    here and the matching events are forwarded in batches through a pipe,
+    the events published in the child are published here to every other
+    container. The services and the messages must be picklable.
+    """
+
+    name = "ProcessContainer"
+
+    def __init__(self, k, services, start_method:str="spawn", join_timeout:float=5.0, **options):
+        Container.__init__(self, k, services, **options)
+        # the child process routes its own containers
+        options.pop("bus", None)
+        self.options = options
+        self.start_method = start_method
+        self.join_timeout = join_timeout
+        self.process = None
+        self.bridge = None
+        self.inbound_task = None
+        self.bridge_task = None
+
+    async def _forward(self, data):
+        """ placeholder handler, the events are forwarded by the outbound handler """
+
+    def run(self):
+        self.thread_id = self.ident
+
+        log.debug(f"[{self.name}][{self.k}] starting [thread id:{self.thread_id}]")
+
+        try:
+            self.loop = self.loop_factory()
+            asyncio.set_event_loop(self.loop)
+
+            self.q_inbound = Queue(thread_id=self.thread_id, loop=self.loop, label=f"{self.thread_id}",
+                                   maxsize=self.maxsize, policy=self.policy,
+                                   lanes=len(Priority), starvation_limit=self.starvation_limit)
+            self.q_bridge = Queue(thread_id=self.thread_id, loop=self.loop, label=f"{self.thread_id}:bridge")
+
+            context = multiprocessing.get_context(self.start_method)
+            conn, child_conn = context.Pipe()
+            self.process = context.Process(target=_child_main, args=(self.k, self.services, child_conn, self.options),
+                                           name=f"{self.name}:{self.k}", daemon=True)
+            self.process.start()
+            child_conn.close()
+
+            self.bridge = PipeBridge(conn, self.q_bridge, label=f"{self.k}")
+            self.bridge.start()
+
+            self.inbound_task = asyncio.ensure_future(self._outbound_handler(), loop=self.loop)
+            self.bridge_task = asyncio.ensure_future(self._bridge_handler(), loop=self.loop)
+
+            # terminate() called while starting
+            if self._shutdown_request is not None:
+                self._begin_shutdown()
+
+            self.loop.run_forever()
+        except Exception as e:
+            log.error(f"[{self.k}][{self.name}] starting exception:{e}")
+        finally:
+            for task in (self.inbound_task, self.bridge_task):
+                if task is not None and not task.done():
+                    task.cancel()
+
+            self.loop.run_until_complete(self._unsubscribe_all())
+            if self.bridge is not None:
+                self.bridge.close()
+            # the events not yet forwarded to the child
+            self.discarded.update(self.q_inbound.close())
+            self.loop.close()
+            self._set_stopped()
+
+    async def _outbound_handler(self):
+        while True:
+            events = await self.q_inbound.get_many(self.batch_size)
+            self.bridge.send(("events", [(event.queue_name, event.priority, event.data) for event in events]))
+
+    async def _bridge_handler(self):
+        while True:
+            messages = await self.q_bridge.get_many(self.batch_size)
+            for message in messages:
+                command = message[0]
+                if command == "publish":
+                    for queue_name, priority, items in _publish_groups(message[1]):
+                        # the replies to a caller of this process
+                        if _rpc_resolve(queue_name, items):
+                            continue
+                        await self._publish_to_others(queue_name, items, priority)
+                elif command == "subscribe":
+                    await Container.subscribe(self, queue_name=message[1], handler=self._forward, **message[2])
+                elif command == "unsubscribe":
+                    await Container.unsubscribe(self, queue_name=message[1], handler=self._forward)
+                elif command == "closed":
+                    log.debug(f"[{self.k}][{self.name}] the child process is closed")
+                    self.loop.stop()
+                    return
+
+    async def _publish_to_others(self, queue_name: str, items: list, priority:Priority=None):
+        """
+        Publish the events of the child process to every container but
+        this one, the child has already delivered them locally.
+        """
+        # journaled before the route is read, see Container.publish
+        offsets = None
+        journal = get_journal()
+        if journal is not None and journal.journaled(queue_name):
+            offsets = [journal.append(queue_name, data) for data in items]
+
+        route = self.bus.snapshot.route(queue_name)
+        if priority is None:
+            priority = route.priority
+
+        targets = [queue for thread_id, queue in route.targets if thread_id != self.thread_id]
+        # a group the child is a member of has already been served by the child
+        groups = [group for group in route.groups if self.thread_id not in group.members]
+        for data in items:
+            if isinstance(data, SharedPayload):
+                data.transfer(len(targets) + len(groups))
+
+        deliveries = []
+        if targets:
+            events = [Container.Event(queue_name, data, offset, priority) for data, offset in zip(items, offsets or [None] * len(items))]
+            deliveries.extend((queue, events) for queue in targets)
+        for group in groups:
+            deliveries.extend(Container._group_batches(group, items, offsets, priority).items())
+
+        for i, (queue, events) in enumerate(deliveries):
+            try:
+                await queue.put_many(events, lane=priority.value)
+            except asyncio.QueueFull:
+                log.error(f"[{self.k}][{self.name}] publish name:{queue_name} a queue is full, {len(events)} events dropped")
+                for _, unreached in deliveries[i + 1:]:
+                    _release_items(unreached)
+                return
+
+    async def _unsubscribe_all(self):
+        for queue_name, _ in self.bus.thread_subscriptions(self.thread_id):
+            await Container.unsubscribe(self, queue_name=queue_name, handler=self._forward)
+
+    async def _handover(self, drain_timeout:float):
+        # no new events for the child, the queued ones are forwarded before it stops
+        self._detach()
+        while not self.q_inbound.empty():
+            events = await self.q_inbound.get_many(self.batch_size)
+            self.bridge.send(("events", [(event.queue_name, event.priority, event.data) for event in events]))
+        self.bridge.send(("stop", drain_timeout))
+
+    async def add_service(self, service):
+        raise ValueError(f"[{self.name}][{self.k}] the services of a process pool cannot be changed while running")
+
+    async def remove_service(self, service):
+        raise ValueError(f"[{self.name}][{self.k}] the services of a process pool cannot be changed while running")
+
+    async def terminate(self, drain_timeout:float=None, timeout:float=10.0) -> map:
+        """
+        Stop the child process, draining its inbound queue for drain_timeout
+        seconds when given, then this thread. The report counts the events
+        not yet forwarded to the child, the child logs its own drops.
+        """
+        log.debug(f"[{self.k}][{self.name}] terminate")
+        try:
+            if self.bridge is not None:
+                if self.loop.is_running():
+                    await asyncio.wait_for(self._in_loop(self._handover(drain_timeout)), timeout)
+                else:
+                    self.bridge.send(("stop", drain_timeout))
+
+            if self.process is not None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.process.join, self.join_timeout + (drain_timeout or 0))
+                if self.process.is_alive():
+                    log.error(f"[{self.k}][{self.name}] the child process did not stop, terminate it")
+                    self.process.terminate()
+        except Exception as e:
+            log.error(f"[{self.k}][{self.name}] terminate exception:{e}")
+
+        return await Container.terminate(self, timeout=timeout)
@@ -0,0 +1,155 @@
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__all__ = ('SharedPayload', 'share')
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+DEFAULT_THRESHOLD = 64 * 1024
+
+
+class SharedPayload:
+    """
+    Handle to a large binary payload stored in a memory mapped segment.
+
+    The body is copied once into the segment, only the handle (path and size)
+    travels through the bus and across processes. Every subscriber gets a
+    zero-copy memoryview with view(). The segment carries a reference count:
+    publishing a payload hands the publisher's reference to the subscribers
+    and the bus releases it once every handler has returned, the last release
+    removes the segment.
+    """
+
+    HEADER = struct.Struct("q")
+
+    _lock = threading.Lock()
+
+    def __init__(self, path:str, size:int):
+        self.path = path
+        self.size = size
+        self._fd = None
+        self._mmap = None
+
+    @classmethod
+    def create(cls, data, directory:str=None):
+        body = memoryview(data).cast("B")
+        fd, path = tempfile.mkstemp(prefix="magic_foundation-", dir=directory or DEFAULT_DIRECTORY)
+        try:
+            os.ftruncate(fd, cls.HEADER.size + body.nbytes)
+            payload = cls(path, body.nbytes)
+            payload._fd = fd
+            payload._mmap = mmap.mmap(fd, cls.HEADER.size + body.nbytes)
+            cls.HEADER.pack_into(payload._mmap, 0, 1)
+            payload._mmap[cls.HEADER.size:] = body
+        except Exception:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        return payload
+
+    def __getstate__(self):
+        return {"path": self.path, "size": self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["size"])
+
+    def __repr__(self):
+        return f"SharedPayload(path:{self.path} size:{self.size})"
+
+    def __len__(self):
+        return self.size
+
+    def __del__(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _map(self):
+        if self._mmap is None:
+            with SharedPayload._lock:
+                if self._mmap is None:
+                    self._fd = os.open(self.path, os.O_RDWR)
+                    self._mmap = mmap.mmap(self._fd, SharedPayload.HEADER.size + self.size)
+        return self._mmap
+
+    def view(self) -> memoryview:
+        """
+        Zero-copy view of the body, valid until the handler returns.
+        """
+        return memoryview(self._map())[SharedPayload.HEADER.size:]
+
+    def tobytes(self) -> bytes:
+        return bytes(self.view())
+
+    @property
+    def refcount(self) -> int:
+        return SharedPayload.HEADER.unpack_from(self._map(), 0)[0]
+
+    def _update(self, delta:int) -> int:
+        buffer = self._map()
+        with SharedPayload._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                count = SharedPayload.HEADER.unpack_from(buffer, 0)[0] + delta
+                SharedPayload.HEADER.pack_into(buffer, 0, count)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        if count <= 0:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        return count
+
+    def retain(self, n:int=1) -> int:
+        return self._update(n)
+
+    def release(self) -> int:
+        return self._update(-1)
+
+    def transfer(self, n:int):
+        """
+        Hand the caller's reference to n consumers.
+        """
+        if n == 0:
+            self.release()
+        elif n > 1:
+            self.retain(n - 1)
+
+
+def share(data, threshold:int=DEFAULT_THRESHOLD, directory:str=None):
+    """
+    Return a SharedPayload for a buffer of at least threshold bytes, the data
+    itself otherwise.
+    """
+    try:
+        size = memoryview(data).nbytes
+    except TypeError:
+        return data
+    if size < threshold:
+        return data
+    return SharedPayload.create(data, directory=directory)
+
+
+def release(data):
+    """
+    Release the reference held on data when it is a SharedPayload.
+    """
+    if isinstance(data, SharedPayload):
+        data.release()
@@ -0,0 +1,99 @@
+import collections
+import itertools
+import json
+import os
+import time
+
+
+from magic_foundation import Tracer
+
+
+__all__ = ('SamplingTracer',)
+
+
+class SamplingTracer(Tracer):
+    """
+    Record the life of one published event every sample_every as spans:
+    publish on the origin thread, queue wait and handler execution on the
+    destination thread, linked by flow arrows. The spans are kept in a
+    bounded buffer and dumped in the Chrome trace format (chrome://tracing,
+    Perfetto) with dump().
+    """
+
+    def __init__(self, sample_every:int=100, max_events:int=100000):
+        self.sample_every = max(sample_every, 1)
+        self.events = collections.deque(maxlen=max_events)
+        self._counter = 0
+        self._ids = itertools.count(1)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _now() -> float:
+        return time.perf_counter() * 1e6
+
+    def publish(self, event, thread_id:int):
+        self._counter += 1
+        if self._counter % self.sample_every:
+            return
+
+        now = self._now()
+        event.trace = {"id": next(self._ids), "origin": thread_id, "published": now, "enqueued": {}}
+        self.events.append({
+            "name": f"publish {event.queue_name}", "cat": "publish", "ph": "i", "s": "t",
+            "ts": now, "pid": self._pid, "tid": thread_id,
+        })
+
+    def enqueue(self, event, thread_id:int, target_thread_id:int):
+        trace = event.trace
+        if trace is None:
+            return
+
+        now = self._now()
+        trace["enqueued"][target_thread_id] = now
+        self.events.append({
+            "name": event.queue_name, "cat": "flow", "ph": "s", "id": f"{trace['id']}:{target_thread_id}",
+            "ts": now, "pid": self._pid, "tid": thread_id,
+        })
+
+    def dequeue(self, event, thread_id:int):
+        trace = event.trace
+        if trace is None:
+            return
+
+        now = self._now()
+        enqueued = trace["enqueued"].get(thread_id, trace["published"])
+        self.events.append({
+            "name": event.queue_name, "cat": "flow", "ph": "f", "bp": "e", "id": f"{trace['id']}:{thread_id}",
+            "ts": now, "pid": self._pid, "tid": thread_id,
+        })
+        self.events.append({
+            "name": f"queue {event.queue_name}", "cat": "queue", "ph": "X",
+            "ts": enqueued, "dur": now - enqueued, "pid": self._pid, "tid": thread_id,
+            "args": {"id": trace["id"], "origin_thread": trace["origin"], "destination_thread": thread_id},
+        })
+
+    def dispatch_start(self, event, handler, thread_id:int):
+        if event.trace is None:
+            return None
+        return self._now()
+
+    def dispatch_end(self, event, handler, thread_id:int, token, error:Exception=None):
+        if token is None:
+            return
+
+        now = self._now()
+        args = {"id": event.trace["id"], "handler": getattr(handler, "__qualname__", repr(handler)),
+                "origin_thread": event.trace["origin"], "destination_thread": thread_id}
+        if error is not None:
+            args["error"] = repr(error)
+        self.events.append({
+            "name": f"dispatch {event.queue_name}", "cat": "dispatch", "ph": "X",
+            "ts": token, "dur": now - token, "pid": self._pid, "tid": thread_id, "args": args,
+        })
+
+    def chrome_trace(self) -> map:
+        return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def dump(self, file_path:str):
+        with open(file_path, "w") as f:
+            json.dump(self.chrome_trace(), f)
@@ -1,87 +1,424 @@
 import asyncio
+import collections
+import itertools
+import json
 import logging
+import uuid
 
 from websockets import serve as WSServer
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from websockets.framing import OP_TEXT, prepare_data
 
-from magic_foundation import Service, ServiceStatus, ServiceContext
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-__all__ = ('WebSocketService')
+from magic_foundation import DispatchMode, Service, ServiceContext
+
+
+__all__ = ('Codec', 'WebSocketService', 'WebSocketMessage')
+
+# close code sent to the evicted clients (Try Again Later)
+CLOSE_CODE_EVICTED = 1013
+
+# the queue of a single connection, a request path cannot produce it, the
+# service id keeps apart the connections of the services sharing a bus
+CONNECTION_QUEUE_PREFIX = "ws://conn/"
 
 log = logging.getLogger(__name__)
 
 
+class WebSocketMessage:
+    """
+    Inbound message published to ws://inbound{path}, tagged with the
+    connection that received it. A reply published to reply_to
+    (ws://conn/{service_id}/{conn_id}) is sent only to that connection.
+    """
+
+    __slots__ = ('conn_id', 'path', 'data', 'service_id')
+
+    def __init__(self, conn_id:int, path:str, data, service_id:str):
+        self.conn_id = conn_id
+        self.path = path
+        self.data = data
+        self.service_id = service_id
+
+    def __getstate__(self):
+        return (self.conn_id, self.path, self.data, self.service_id)
+
+    def __setstate__(self, state):
+        self.conn_id, self.path, self.data, self.service_id = state
+
+    def __repr__(self):
+        return f"WebSocketMessage(service_id:{self.service_id} conn_id:{self.conn_id} path:{self.path} data:{self.data})"
+
+    @property
+    def reply_to(self) -> str:
+        return connection_queue_name(self.service_id, self.conn_id)
+
+
+def connection_queue_name(service_id:str, conn_id:int) -> str:
+    return f"{CONNECTION_QUEUE_PREFIX}{service_id}/{conn_id}"
+
+
+class Codec:
+    """
+    Decode the inbound messages before they are published and encode the
+    data published to ws://outbound. The base codec passes the messages
+    through: str as text frames, bytes as binary frames.
+    """
+
+    name = "raw"
+    # the encoded bytes are sent as text frames
+    text = False
+
+    def decode(self, message):
+        return message
+
+    def encode(self, data):
+        return data
+
+    @staticmethod
+    def create(name:str):
+        if name == "raw":
+            return Codec()
+        if name == "json":
+            return JsonCodec()
+        if name == "orjson":
+            # same wire format, the stdlib json when orjson is not installed
+            return JsonCodec() if orjson is None else OrjsonCodec()
+        if name == "msgpack":
+            if msgpack is None:
+                raise ValueError("the msgpack codec requires the msgpack package")
+            return MsgpackCodec()
+        raise ValueError(f"unknown codec:{name}")
+
+
+class JsonCodec(Codec):
+    name = "json"
+    text = True
+
+    def decode(self, message):
+        return json.loads(message)
+
+    def encode(self, data):
+        return json.dumps(data)
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+    text = True
+
+    def decode(self, message):
+        return orjson.loads(message)
+
+    def encode(self, data):
+        return orjson.dumps(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def decode(self, message):
+        return msgpack.unpackb(message, raw=False)
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+
+class _OutboundFrame:
+    """
+    Outbound message shared by every connection it is sent to: the payload
+    is encoded once, on first use, and the encoded bytes are reused. A
+    broadcast frame was published to the path, the others are the direct
+    replies published to the connection queue.
+    """
+
+    __slots__ = ('data', 'codec', 'broadcast', '_opcode', '_payload')
+
+    def __init__(self, data, codec:Codec, broadcast:bool=False):
+        self.data = data
+        self.codec = codec
+        self.broadcast = broadcast
+        self._opcode = None
+        self._payload = None
+
+    def encoded(self) -> tuple:
+        if self._payload is None:
+            opcode, payload = prepare_data(self.codec.encode(self.data))
+            self._opcode = OP_TEXT if self.codec.text else opcode
+            self._payload = payload
+        return self._opcode, self._payload
+
+
+class _Connection:
+    """
+    Outbound side of a client connection: a bounded buffer of frames
+    written by a single sender task.
+
+    When the buffer is full the client is lagging, the oldest frame is
+    dropped or, with conflate, the pending broadcasts are replaced by the
+    newest one and the direct replies are kept (the oldest frame is dropped
+    when no broadcast is left to conflate). A client lagging for more than
+    slow_client_timeout is evicted.
+    """
+
+    def __init__(self, service, websocket, conn_id:int, path:str):
+        self.service = service
+        self.websocket = websocket
+        self.conn_id = conn_id
+        self.path = path
+        self.frames = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.lagging_since = None
+        self.evicted = False
+        self.stopped = False
+        self.dropped = 0
+        self.sender_task = None
+
+    def start(self):
+        self.sender_task = asyncio.ensure_future(self._sender())
+
+    def stop(self):
+        if self.sender_task is not None:
+            self.sender_task.cancel()
+        # an evicted client is stopped again when it disconnects
+        if self.stopped:
+            return
+        self.stopped = True
+        self.dropped += len(self.frames)
+        self.service.dropped += self.dropped
+        self.frames.clear()
+
+    def push(self, frame:_OutboundFrame):
+        if self.stopped:
+            return
+
+        service = self.service
+        frames = self.frames
+        if len(frames) >= service.send_buffer:
+            now = asyncio.get_event_loop().time()
+            if self.lagging_since is None:
+                self.lagging_since = now
+            elif now - self.lagging_since > service.slow_client_timeout:
+                self.evict()
+                return
+
+            conflated = self._conflate(frame) if service.conflate else 0
+            if conflated:
+                self.dropped += conflated
+            else:
+                self.dropped += 1
+                frames.popleft()
+
+        frames.append(frame)
+        self.wakeup.set()
+
+    def _conflate(self, frame:_OutboundFrame) -> int:
+        """
+        Remove the pending broadcasts superseded by frame, the newest one is
+        kept when frame is a direct reply. Return the number removed.
+        """
+        frames = self.frames
+        keep_broadcast = not frame.broadcast
+        kept = []
+        for pending in reversed(frames):
+            if pending.broadcast:
+                if not keep_broadcast:
+                    continue
+                keep_broadcast = False
+            kept.append(pending)
+
+        removed = len(frames) - len(kept)
+        if removed:
+            frames.clear()
+            frames.extend(reversed(kept))
+        return removed
+
+    def evict(self):
+        log.warning(f"[{self.service.name}] evict path:{self.path} conn_id:{self.conn_id} lagging for more than {self.service.slow_client_timeout}s")
+        self.evicted = True
+        self.service.evicted += 1
+        self.stop()
+        asyncio.ensure_future(self.websocket.close(code=CLOSE_CODE_EVICTED, reason="slow client"))
+
+    async def _sender(self):
+        frames = self.frames
+        websocket = self.websocket
+        while True:
+            if not frames:
+                self.lagging_since = None
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            frame = frames.popleft()
+            try:
+                await websocket.ensure_open()
+                await websocket.write_frame(True, *frame.encoded())
+            except ConnectionClosedOK:
+                log.debug(f"[{self.service.name}] send path:{self.path} conn_id:{self.conn_id} ConnectionClosedOK")
+                return
+            except ConnectionClosedError:
+                log.debug(f"[{self.service.name}] send path:{self.path} conn_id:{self.conn_id} ConnectionClosedError")
+                return
+            except Exception as e:
+                log.error(f"[{self.service.name}] send path:{self.path} conn_id:{self.conn_id} ERROR type:{type(e)} error:{e}")
+
+
 class WebSocketService(Service):
+    """
+    Bridge the WebSocket clients to the bus.
+
+    Every connection has a bounded send buffer of send_buffer frames, a
+    broadcast is encoded once and queued to every connection of the path
+    without waiting for the clients. The frames of a lagging client are
+    dropped, oldest first, or the broadcasts are conflated to the newest one,
+    a client lagging for more than slow_client_timeout seconds is
+    disconnected.
+
+    The inbound messages are decoded once by the codec (raw, json, orjson,
+    msgpack or a Codec instance) before being published, the messages of at
+    least decode_threshold bytes are decoded in the default executor. The
+    outbound data is encoded by the same codec.
+    """
 
-    def __init__(self, host="localhost", port=8080):
+    def __init__(self, host="localhost", port=8080, send_buffer:int=256, conflate:bool=False,
+                 slow_client_timeout:float=10.0, codec="raw", decode_threshold:int=None):
         self.name = f"WebSocketService:{host}:{port}"
         self.host = host
         self.port = port
+        self.codec = codec if isinstance(codec, Codec) else Codec.create(codec)
+        self.decode_threshold = decode_threshold
+        self.send_buffer = max(send_buffer, 1)
+        self.conflate = conflate
+        self.slow_client_timeout = slow_client_timeout
         self.wss = None
 
+        # the connection ids are counted per service, the service id makes
+        # their queues unique on the bus
+        self.service_id = uuid.uuid4().hex
+        self.conn_ids = itertools.count(1)
+        # conn_id -> _Connection
+        self.connections = {}
+        # path -> {conn_id: _Connection}
+        self.paths = {}
+        # path -> broadcast handler
+        self.broadcast_handlers = {}
+
+        # frames dropped for lagging clients, evicted clients and undecodable messages
+        self.dropped = 0
+        self.evicted = 0
+        self.decode_errors = 0
+
     async def initialize(self, ctx:ServiceContext):
         log.info(f"[{self.name}] initialize")
 
-    async def run(self, ctx:ServiceContext):
-        log.info(f"[{self.name}] run")
+    async def _decode(self, message):
+        if self.decode_threshold is not None and len(message) >= self.decode_threshold:
+            return await asyncio.get_running_loop().run_in_executor(None, self.codec.decode, message)
+        return self.codec.decode(message)
 
-        async def handler(websocket, path):
-            log.debug(f"[{self.name}] handler path:{path} ws_id:{id(websocket)}")
-        
-            async def inbound_handler():
-                running = True
-                while running:
-                    try:
-                        log.debug(f"[{self.name}] handler inbound_handler path:{path} ws_id:{id(websocket)}")
-                        msg = await websocket.recv()
-                        await ctx.publish(queue_name=f"ws://inbound{path}", data=msg)                    
-                    except ConnectionClosedOK:
-                        log.debug(f"[{self.name}] handler inbound_handler path:{path} ws_id:{id(websocket)} ConnectionClosedOK")
-                        running = False
-                    except ConnectionClosedError:
-                        log.debug(f"[{self.name}] handler inbound_handler path:{path} ws_id:{id(websocket)} ConnectionClosedError")
-                        running = False
-                    except Exception as e:
-                        log.error(f"[{self.name}] handler inbound_handler path:{path} ws_id:{id(websocket)} ERROR type:{type(e)} error:{e}")
-                        running = False
+    async def _join_path(self, ctx:ServiceContext, path:str, connection:_Connection):
+        connections = self.paths.get(path)
+        if connections is None:
+            connections = self.paths[path] = {}
+
+            async def broadcast_handler(data):
+                frame = _OutboundFrame(data, self.codec, broadcast=True)
+                for connection in list(connections.values()):
+                    connection.push(frame)
+
+            self.broadcast_handlers[path] = broadcast_handler
+            await ctx.subscribe(queue_name=f"ws://outbound{path}", handler=broadcast_handler, mode=DispatchMode.inline)
+
+        connections[connection.conn_id] = connection
 
-            async def outbound_handler(data):
+    async def _leave_path(self, ctx:ServiceContext, path:str, conn_id:int):
+        connections = self.paths.get(path)
+        if connections is None:
+            return
+
+        connections.pop(conn_id, None)
+        if not connections:
+            del self.paths[path]
+            broadcast_handler = self.broadcast_handlers.pop(path)
+            await ctx.unsubscribe(queue_name=f"ws://outbound{path}", handler=broadcast_handler)
+
+    async def _serve(self, ctx:ServiceContext, websocket, path:str):
+        conn_id = next(self.conn_ids)
+        log.debug(f"[{self.name}] handler path:{path} conn_id:{conn_id}")
+
+        in_queue_name = f"ws://inbound{path}"
+
+        async def inbound_handler():
+            running = True
+            while running:
                 try:
-                    await websocket.send(data)
+                    msg = await websocket.recv()
+                    try:
+                        data = await self._decode(msg)
+                    except Exception as e:
+                        self.decode_errors += 1
+                        log.error(f"[{self.name}] handler inbound_handler path:{path} conn_id:{conn_id} codec:{self.codec.name} decode ERROR type:{type(e)} error:{e}")
+                        continue
+                    await ctx.publish(queue_name=in_queue_name, data=WebSocketMessage(conn_id, path, data, self.service_id))
                 except ConnectionClosedOK:
-                    log.debug(f"[{self.name}] handler outbound_handler path:{path} ws_id:{id(websocket)} ConnectionClosedOK")                
+                    log.debug(f"[{self.name}] handler inbound_handler path:{path} conn_id:{conn_id} ConnectionClosedOK")
+                    running = False
                 except ConnectionClosedError:
-                    log.debug(f"[{self.name}] handler outbound_handler path:{path} ws_id:{id(websocket)} ConnectionClosedError")
+                    log.debug(f"[{self.name}] handler inbound_handler path:{path} conn_id:{conn_id} ConnectionClosedError")
+                    running = False
                 except Exception as e:
-                    log.error(f"[{self.name}] handler outbound_handler path:{path} ws_id:{id(websocket)} ERROR type:{type(e)} error:{e}")
+                    log.error(f"[{self.name}] handler inbound_handler path:{path} conn_id:{conn_id} ERROR type:{type(e)} error:{e}")
+                    running = False
 
-            try:
-                inbound_task:asyncio.Task = asyncio.ensure_future(inbound_handler())
+        connection = _Connection(self, websocket, conn_id, path)
 
-                #print(f"ws://outbound{path}/{id(websocket)}")
+        async def outbound_handler(data):
+            connection.push(_OutboundFrame(data, self.codec))
 
-                out_queue_name = f"ws://outbound{path}"
+        out_queue_name = connection_queue_name(self.service_id, conn_id)
 
-                await ctx.subscribe(queue_name=out_queue_name, handler=outbound_handler)
+        try:
+            self.connections[conn_id] = connection
+            connection.start()
+            await self._join_path(ctx, path, connection)
+            await ctx.subscribe(queue_name=out_queue_name, handler=outbound_handler, mode=DispatchMode.inline)
 
-                done, pending = await asyncio.wait(
-                    [inbound_task],
-                    return_when=asyncio.FIRST_COMPLETED,
-                )
+            inbound_task:asyncio.Task = asyncio.ensure_future(inbound_handler())
 
-                for task in pending:
-                    task.cancel()
+            done, pending = await asyncio.wait(
+                [inbound_task],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
 
-                log.debug(f"[{self.name}] handler penging handlers has been cancelled")
+            for task in pending:
+                task.cancel()
 
-                await ctx.unsubscribe(queue_name=out_queue_name, handler=outbound_handler)
+            log.debug(f"[{self.name}] handler penging handlers has been cancelled")
+        except Exception as e:
+            log.error(f"[{self.name}] handler path:{path} conn_id:{conn_id} ERROR! type:{type(e)} error:{e}")
+        finally:
+            self.connections.pop(conn_id, None)
+            connection.stop()
+            await ctx.unsubscribe(queue_name=out_queue_name, handler=outbound_handler)
+            await self._leave_path(ctx, path, conn_id)
+
+            log.debug(f"[{self.name}] handler conn_id:{conn_id} has been unsubscribed from queue_name={out_queue_name}")
+
+    async def run(self, ctx:ServiceContext):
+        log.info(f"[{self.name}] run")
+
+        async def handler(websocket, path):
+            await self._serve(ctx, websocket, path)
 
-                log.debug(f"[{self.name}] handler the outbound_handler has been unsubscribed from queue_name={out_queue_name}")
-                
-            except Exception as e:
-                log.error(f"[{self.name}] handler path:{path} ws_id:{id(websocket)} ERROR! type:{type(e)} error:{e}")
-          
         self.wss = await WSServer(ws_handler=handler, host=self.host, port=self.port)
 
         log.info(f"[{self.name}] run wss is serving:{self.wss.is_serving()} on port:{self.port}")
@@ -89,10 +426,10 @@ class WebSocketService(Service):
     async def terminate(self, ctx:ServiceContext):
         log.info(f"[{self.name}] terminate")
 
-        if self.wss.is_serving():
+        if self.wss is not None and self.wss.is_serving():
             log.debug(f"[{self.name}] terminate wss is serving:{self.wss.is_serving()}")
             self.wss.close()
             await self.wss.wait_closed()
             log.debug(f"[{self.name}] terminate wss is serving:{self.wss.is_serving()}")
 
-    
\ No newline at end of file
+
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+
+from time import sleep
+from magic_foundation import Main, Service, ServiceContext
+
+log = logging.getLogger(__name__)
+
+
+class RecordingService(Service):
+  """
+  Subscribe queue_name with the subscribe options and record the received
+  data, converted by record, then wait delay seconds and record it again as
+  completed. Pass received to share the list between services.
+  """
+
+  def __init__(self, name:str, queue_name:str, record=None, delay:float=0, received:list=None, **options):
+      self.name = name
+      self.queue_name = queue_name
+      self.record = record
+      self.delay = delay
+      self.options = options
+      self.received = received if received is not None else []
+      self.completed = []
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    async def handler(data):
+      if self.record is not None:
+        data = self.record(data)
+      self.received.append(data)
+      if self.delay:
+        await asyncio.sleep(self.delay)
+      self.completed.append(data)
+
+    self.handler = handler
+
+    await ctx.subscribe(queue_name=self.queue_name, handler=self.handler, **self.options)
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+    await ctx.unsubscribe(queue_name=self.queue_name, handler=self.handler)
+
+
+def new_main() -> Main:
+    # every test runs its own Main
+    Main.reset()
+    return Main.instance()
+
+
+def wait_until(predicate, timeout:float=5.0) -> bool:
+    for _ in range(int(timeout / 0.05)):
+      if predicate():
+        return True
+      sleep(0.05)
+    return False
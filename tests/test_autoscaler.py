@@ -0,0 +1,116 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+import threading
+
+from magic_foundation import DispatchMode, Main, Service, ServiceContext
+from magic_foundation.autoscaler import AutoscalerService
+from helpers import RecordingService, new_main, wait_until
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class IdleService(Service):
+
+  name = "Idle"
+
+  async def initialize(self, ctx:ServiceContext):
+    pass
+
+  async def run(self, ctx:ServiceContext):
+    pass
+
+  async def terminate(self, ctx:ServiceContext):
+    pass
+
+
+def _members(main:Main) -> list:
+    group = main.bus.snapshot.groups.get("q://jobs", {}).get("workers")
+    return list(group.members) if group is not None else []
+
+
+class TestAutoscaler(TestCase):
+
+    def test_desired_replicas(self):
+        autoscaler = AutoscalerService(None, "workers", min_replicas=1, max_replicas=8, target_depth=100,
+                                       target_latency=0.01, cooldown_sec=10.0)
+
+        # within tolerance
+        self.assertEqual(autoscaler.desired(2, depth=105, now=0.0), 2)
+        # in proportion to the depth or to the latency, bounded
+        self.assertEqual(autoscaler.desired(2, depth=300, now=1.0), 6)
+        self.assertEqual(autoscaler.desired(2, depth=10, latency=0.02, now=2.0), 4)
+        self.assertEqual(autoscaler.desired(4, depth=10000, now=3.0), 8)
+        # shrinks only to the largest size wanted during the cooldown
+        self.assertEqual(autoscaler.desired(8, depth=0, now=4.0), 8)
+        self.assertEqual(autoscaler.desired(8, depth=0, now=20.0), 1)
+
+    def _run(self, main:Main) -> threading.Thread:
+        thread = threading.Thread(target=main.run)
+        thread.start()
+        self.addCleanup(thread.join, 10.0)
+        self.addCleanup(main.stop)
+        return thread
+
+    def test_runtime_pools(self):
+        main = new_main()
+        main.service_pools = {"main": [IdleService()]}
+
+        received = []
+        main.add_worker_pool("workers", lambda: [RecordingService("Job", "q://jobs", received=received, group="workers", mode=DispatchMode.inline)], replicas=1)
+
+        thread = self._run(main)
+        self.assertTrue(wait_until(lambda: main.bus.snapshot.groups.get("q://jobs")))
+        with self.assertRaises(Exception):
+          Main.reset()
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main.scale_pool("workers", 3))
+        self.assertTrue(wait_until(lambda: len(_members(main)) == 3))
+        self.assertEqual([c.k for c in main.pool_containers("workers")], ["workers:0", "workers:1", "workers:2"])
+
+        # a pool added and removed while running
+        extra = main.add_pool("extra", [RecordingService("Extra", "q://jobs", received=received, group="workers", mode=DispatchMode.inline)])
+        self.assertTrue(wait_until(lambda: len(_members(main)) == 4))
+        self.assertTrue(loop.run_until_complete(main.remove_pool("extra")))
+        self.assertFalse(extra.is_alive())
+
+        loop.run_until_complete(main.scale_pool("workers", 1))
+        self.assertEqual(_members(main), [main.container("workers:0").thread_id])
+
+        publisher = main.container("main")
+        for i in range(10):
+          loop.run_until_complete(publisher.publish(queue_name="q://jobs", data=i))
+        self.assertTrue(wait_until(lambda: len(received) == 10))
+
+        main.stop()
+        thread.join(timeout=10.0)
+        loop.close()
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(main.bus.snapshot.table, {})
+
+    def test_scale_down_hands_over(self):
+        main = new_main()
+        main.service_pools = {"main": [IdleService()]}
+
+        received = []
+        main.add_worker_pool("workers", lambda: [RecordingService("Job", "q://jobs", delay=0.002, received=received, group="workers", mode=DispatchMode.inline)], replicas=2)
+
+        self._run(main)
+        self.assertTrue(wait_until(lambda: len(_members(main)) == 2))
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main.container("main").publish_many(queue_name="q://jobs", items=list(range(200))))
+        # the removed replica leaves the group first, then dispatches its queued jobs
+        loop.run_until_complete(main.scale_pool("workers", 1))
+        for i in range(200, 220):
+          loop.run_until_complete(main.container("main").publish(queue_name="q://jobs", data=i))
+        loop.close()
+
+        self.assertTrue(wait_until(lambda: len(received) == 220))
+        self.assertEqual(sorted(received), list(range(220)))
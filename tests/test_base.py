@@ -9,7 +9,7 @@ import threading
 
 
 from time import sleep
-from magic_foundation import Container, Service, ServiceStatus, ServiceContext
+from magic_foundation import Bus, Container, DispatchMode, OverflowPolicy, Priority, Queue, Service, ServiceStatus, ServiceContext, TopicTrie, default_bus
 
 log = logging.getLogger(__name__)
 
@@ -45,8 +45,10 @@ class Main:
 
 class TestService(Service):
 
-  def __init__(self, name:str):
+  def __init__(self, name:str, queue_name:str="q://test", **options):
       self.name = name
+      self.queue_name = queue_name
+      self.options = options
       self.q_inbound = asyncio.Queue()
 
   async def initialize(self, ctx:ServiceContext):
@@ -61,12 +63,12 @@ class TestService(Service):
         
     self.handler = handler
 
-    await ctx.subscribe(queue_name="q://test", handler=self.handler)
+    await ctx.subscribe(queue_name=self.queue_name, handler=self.handler, **self.options)
 
   async def terminate(self, ctx:ServiceContext):
     log.info(f"[{self.name}] terminate")
 
-    await ctx.unsubscribe(queue_name="q://test", handler=self.handler)
+    await ctx.unsubscribe(queue_name=self.queue_name, handler=self.handler)
 
 
 class ProducerService(Service):
@@ -91,6 +93,16 @@ class ProducerService(Service):
     log.info(f"[{self.name}] terminate")
 
 
+class BatchProducerService(ProducerService):
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    await asyncio.sleep(0.5)
+
+    await ctx.publish_many(queue_name="q://test", items=[{"index": i} for i in range(self.num_messages)])
+
+
 class TestBase(TestCase):
 
     def test_service_lifecycle_single_runloop(self):
@@ -202,3 +214,368 @@ class TestBase(TestCase):
         self.assertEqual(consumer.q_inbound.qsize(), 3)
 
         main.stop()
+
+    def test_message_batch_multi_runloop(self):
+        log.info("\n")
+
+        main = Main()
+
+        consumer = TestService(name="Consumer")
+        producer = BatchProducerService(name="Producer", num_messages=1000)
+
+        main.service_pools = {
+          'main': [
+              consumer,
+          ],
+          'second': [
+              producer,
+          ]
+        }
+
+        main.start()
+
+        sleep(1.0)
+
+        self.assertEqual(consumer.q_inbound.qsize(), 1000)
+        self.assertEqual(consumer.q_inbound.get_nowait(), {"index": 0})
+
+        main.stop()
+
+    def test_message_pattern_multi_runloop(self):
+        log.info("\n")
+
+        main = Main()
+
+        consumer = TestService(name="Consumer")
+        wildcard = TestService(name="Wildcard", queue_name="q://*")
+        prefix = TestService(name="Prefix", queue_name="q://**")
+        other = TestService(name="Other", queue_name="other://*")
+        producer = ProducerService(name="Producer", num_messages=3)
+
+        main.service_pools = {
+          'main': [
+              consumer,
+              wildcard,
+          ],
+          'second': [
+              prefix,
+              other,
+              producer,
+          ]
+        }
+
+        main.start()
+
+        sleep(1.0)
+
+        self.assertEqual(consumer.q_inbound.qsize(), 3)
+        self.assertEqual(wildcard.q_inbound.qsize(), 3)
+        self.assertEqual(prefix.q_inbound.qsize(), 3)
+        self.assertEqual(other.q_inbound.qsize(), 0)
+
+        main.stop()
+
+    def test_message_dispatch_modes(self):
+        log.info("\n")
+
+        main = Main()
+
+        inline = TestService(name="Inline", mode=DispatchMode.inline)
+        pool = TestService(name="Pool", mode=DispatchMode.pool, workers=4, maxsize=10)
+        producer = BatchProducerService(name="Producer", num_messages=100)
+
+        main.service_pools = {
+          'main': [
+              inline,
+              pool,
+          ],
+          'second': [
+              producer,
+          ]
+        }
+
+        main.start()
+
+        sleep(1.0)
+
+        self.assertEqual([inline.q_inbound.get_nowait()["index"] for _ in range(100)], list(range(100)))
+        self.assertEqual(sorted(pool.q_inbound.get_nowait()["index"] for _ in range(100)), list(range(100)))
+
+        main.stop()
+
+    def test_pool_queue_full(self):
+        log.info("\n")
+
+        pool = TestService(name="Pool", queue_name="q://a", mode=DispatchMode.pool, workers=1, maxsize=2, policy=OverflowPolicy.error)
+        inline = TestService(name="Inline", queue_name="q://b", mode=DispatchMode.inline)
+        container = Container("main", [pool, inline])
+        container.start()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.addCleanup(container.join, 5.0)
+        self.addCleanup(lambda: loop.run_until_complete(container.terminate(timeout=5.0)))
+        sleep(0.5)
+
+        loop.run_until_complete(container.publish_many(queue_name="q://a", items=list(range(10))))
+        loop.run_until_complete(container.publish(queue_name="q://b", data="b"))
+        sleep(0.5)
+
+        # the full queue of a subscription drops its events, the container keeps dispatching
+        self.assertFalse(container.inbound_task.done())
+        self.assertEqual(inline.q_inbound.get_nowait(), "b")
+        rejected = container.stats()["rejected_by_queue"]["q://a"]
+        self.assertGreater(rejected, 0)
+        self.assertEqual(pool.q_inbound.qsize() + rejected, 10)
+
+    def test_container_stats(self):
+        log.info("\n")
+
+        main = Main()
+
+        consumer = TestService(name="Consumer", mode=DispatchMode.inline)
+        producer = ProducerService(name="Producer", num_messages=3)
+
+        main.service_pools = {
+          'main': [
+              consumer,
+          ],
+          'second': [
+              producer,
+          ]
+        }
+
+        main.start()
+
+        sleep(1.0)
+
+        consumer_stats, producer_stats = [t.stats() for t in main.threads]
+
+        self.assertEqual(producer_stats["published"], {"q://test": 3})
+        self.assertEqual(consumer_stats["delivered"], {"q://test": 3})
+        # the handler time of one event in 16, the first one
+        self.assertEqual(consumer_stats["handlers"]["q://test"]["count"], 1)
+        self.assertEqual(consumer_stats["inbound"]["depth"], 0)
+        self.assertEqual(consumer_stats["inbound"]["dropped_newest"], 0)
+        self.assertIn("max", consumer_stats["loop_lag"])
+
+        main.stop()
+
+    def test_container_loop_factory(self):
+        loops = []
+
+        def loop_factory():
+          loop = asyncio.new_event_loop()
+          loops.append(loop)
+          return loop
+
+        service = TestService(name="Service_1")
+        container = Container("main", [service], loop_factory=loop_factory)
+        container.start()
+
+        while service.status != ServiceStatus.running:
+          sleep(0.1)
+
+        self.assertEqual(loops, [container.loop])
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(container.terminate())
+        loop.close()
+
+    def test_topic_trie(self):
+        trie = TopicTrie()
+        trie.insert("ws://inbound/*", "wildcard")
+        trie.insert("ws://**", "prefix")
+        trie.insert("ws://*/client", "middle")
+
+        self.assertTrue(TopicTrie.is_pattern("ws://inbound/*"))
+        self.assertTrue(TopicTrie.is_pattern("log://**"))
+        self.assertFalse(TopicTrie.is_pattern("ws://inbound/client"))
+
+        self.assertEqual(sorted(trie.match("ws://inbound/client")), ["middle", "prefix", "wildcard"])
+        self.assertEqual(sorted(trie.match("ws://inbound/a/b")), ["prefix"])
+        self.assertEqual(trie.match("log://file.log"), [])
+
+        trie.remove("ws://inbound/*")
+        self.assertEqual(sorted(trie.match("ws://inbound/client")), ["middle", "prefix"])
+
+    def test_bus_snapshot(self):
+        async def handler(data):
+            pass
+
+        bus = Bus()
+        queue_a, queue_b = object(), object()
+        exact = Container.Subscription(handler)
+        pattern = Container.Subscription(handler)
+        self.assertEqual(bus.subscribe("q://a", 1, queue_a, exact), "q://a")
+        bus.subscribe("q://*", 2, queue_b, pattern)
+
+        before = bus.snapshot
+        route = before.route("q://a")
+        self.assertEqual(route.targets, ((1, queue_a), (2, queue_b)))
+        self.assertEqual(route.handlers, {1: (exact,), 2: (pattern,)})
+        self.assertEqual(before.route("q://other").targets, ((2, queue_b),))
+
+        # only the entry of the calling thread is looked up
+        self.assertIsNone(bus.unsubscribe("q://a", 2, handler))
+        self.assertIs(bus.unsubscribe("q://a", 1, handler), exact)
+        self.assertEqual(bus.route("q://a").targets, ((2, queue_b),))
+        # the readers of the previous snapshot are not affected
+        self.assertEqual(before.route("q://a").targets, ((1, queue_a), (2, queue_b)))
+
+        # the buses do not share subscriptions
+        self.assertEqual(Bus().route("q://a").targets, ())
+        self.assertEqual(default_bus.subscribers("q://*"), {})
+
+    def test_bus_incremental_routes(self):
+        bus = Bus()
+        queues = [object() for _ in range(4)]
+        for i in range(3):
+          bus.subscribe(f"q://a/{i}", i, queues[i], Container.Subscription(None))
+        # resolved and cached without exact subscriptions
+        self.assertEqual(bus.route("q://b/0").targets, ())
+
+        before = bus.snapshot
+        bus.subscribe("q://a/1", 3, queues[3], Container.Subscription(None))
+        # the routes not affected are shared, the table shards too
+        self.assertIs(bus.route("q://a/0"), before.route("q://a/0"))
+        self.assertIs(bus.subscribers("q://a/0"), before.table["q://a/0"])
+        self.assertIsNot(bus.subscribers("q://a/1"), before.table["q://a/1"])
+        self.assertEqual(bus.route("q://a/1").targets, ((1, queues[1]), (3, queues[3])))
+
+        # a pattern rebuilds the routes it matches, the cached ones too
+        bus.subscribe("q://*/0", 3, queues[3], Container.Subscription(None))
+        self.assertEqual(bus.route("q://a/0").targets, ((0, queues[0]), (3, queues[3])))
+        self.assertEqual(bus.route("q://b/0").targets, ((3, queues[3]),))
+
+        # many changes: the routes are inherited through the new bases
+        for i in range(100):
+          bus.subscribe(f"q://c/{i}", 0, queues[0], Container.Subscription(None))
+        self.assertEqual(bus.route("q://a/1").targets, ((1, queues[1]), (3, queues[3])))
+        self.assertEqual(bus.route("q://c/50").targets, ((0, queues[0]),))
+        bus.unsubscribe("q://c/50", 0, None)
+        self.assertEqual(bus.route("q://c/50").targets, ())
+        self.assertEqual(len(bus.snapshot.table), 103)
+        self.assertEqual(bus.route("q://b/0").targets, ((3, queues[3]),))
+        self.assertEqual(bus.route("q://a/2").targets, ((2, queues[2]),))
+
+        bus.set_priority("q://*/0", Priority.high)
+        self.assertIs(bus.route("q://b/0").priority, Priority.high)
+        self.assertIs(bus.route("q://a/1").priority, Priority.normal)
+
+        bus.remove_thread(3)
+        self.assertEqual(bus.route("q://a/0").targets, ((0, queues[0]),))
+        self.assertEqual(bus.route("q://b/0").targets, ())
+        self.assertEqual(bus.route("q://a/1").targets, ((1, queues[1]),))
+        self.assertEqual(before.route("q://a/1").targets, ((1, queues[1]),))
+
+    def test_queue_put_from_other_thread_does_not_block(self):
+        log.info("\n")
+
+        loop = asyncio.new_event_loop()
+        queue = Queue(thread_id=threading.get_ident(), loop=loop, label="test")
+
+        def producer():
+          for i in range(100):
+            queue.put_nowait(i)
+
+        t = threading.Thread(target=producer)
+        t.start()
+        t.join(timeout=1.0)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(queue.qsize(), 100)
+
+        async def consume():
+          return [await queue.get() for _ in range(100)]
+
+        self.assertEqual(loop.run_until_complete(consume()), list(range(100)))
+        loop.close()
+
+    def test_queue_overflow_policies(self):
+        loop = asyncio.new_event_loop()
+        thread_id = threading.get_ident()
+
+        queue = Queue(thread_id=thread_id, loop=loop, maxsize=3, policy=OverflowPolicy.drop_newest)
+        queue.put_many_nowait(list(range(5)))
+        self.assertEqual([queue.get_nowait() for _ in range(queue.qsize())], [0, 1, 2])
+        self.assertEqual(queue.dropped_newest, 2)
+
+        queue = Queue(thread_id=thread_id, loop=loop, maxsize=3, policy=OverflowPolicy.drop_oldest)
+        queue.put_many_nowait(list(range(5)))
+        self.assertEqual([queue.get_nowait() for _ in range(queue.qsize())], [2, 3, 4])
+        self.assertEqual(queue.dropped_oldest, 2)
+
+        queue = Queue(thread_id=thread_id, loop=loop, maxsize=3, policy=OverflowPolicy.error)
+        queue.put_many_nowait(list(range(3)))
+        with self.assertRaises(asyncio.QueueFull):
+          queue.put_nowait(3)
+        self.assertEqual(queue.rejected, 1)
+        self.assertEqual(queue.qsize(), 3)
+
+        loop.close()
+
+    def test_queue_priority_lanes(self):
+        loop = asyncio.new_event_loop()
+        thread_id = threading.get_ident()
+
+        queue = Queue(thread_id=thread_id, loop=loop, lanes=3, starvation_limit=2)
+        queue.put_many_nowait([f"bulk{i}" for i in range(6)], lane=2)
+        queue.put_many_nowait(["data0", "data1"], lane=1)
+        queue.put_nowait("control", lane=0)
+        self.assertEqual(queue.stats()["lanes"], [1, 2, 6])
+
+        # strict priority
+        self.assertEqual(loop.run_until_complete(queue.get_many(2)), ["control", "data0"])
+        self.assertEqual(loop.run_until_complete(queue.get_many(2)), ["data1", "bulk0"])
+
+        # a lane passed over starvation_limit times is served first
+        for i in range(2):
+          queue.put_nowait(f"data{i}", lane=1)
+          self.assertEqual(loop.run_until_complete(queue.get_many(1)), [f"data{i}"])
+        queue.put_nowait("late", lane=1)
+        self.assertEqual(loop.run_until_complete(queue.get_many(1)), ["bulk1"])
+
+        # drop_oldest discards the least urgent lane first
+        queue = Queue(thread_id=thread_id, loop=loop, maxsize=3, policy=OverflowPolicy.drop_oldest, lanes=2)
+        queue.put_many_nowait(["bulk0", "bulk1"], lane=1)
+        queue.put_many_nowait(["control0", "control1"], lane=0)
+        self.assertEqual(loop.run_until_complete(queue.get_many(3)), ["control0", "control1", "bulk1"])
+
+        loop.close()
+
+    def test_priority_per_topic(self):
+        bus = Bus()
+        bus.set_priority("ctl://**", Priority.high)
+        bus.set_priority("md://quotes", Priority.low)
+
+        self.assertIs(bus.route("ctl://shutdown").priority, Priority.high)
+        self.assertIs(bus.route("md://quotes").priority, Priority.low)
+        self.assertIs(bus.route("q://test").priority, Priority.normal)
+
+        bus.set_priority("md://quotes", None)
+        self.assertIs(bus.route("md://quotes").priority, Priority.normal)
+
+    def test_queue_block_policy_from_other_thread(self):
+        loop = asyncio.new_event_loop()
+        queue = Queue(thread_id=threading.get_ident(), loop=loop, maxsize=2, policy=OverflowPolicy.block)
+
+        def producer():
+          asyncio.run(queue.put_many(list(range(10))))
+
+        t = threading.Thread(target=producer)
+        t.start()
+
+        async def consume():
+          items = []
+          while len(items) < 10:
+            items.extend(await queue.get_many(10))
+            self.assertLessEqual(len(items), 10)
+          return items
+
+        items = loop.run_until_complete(asyncio.wait_for(consume(), timeout=5.0))
+        t.join(timeout=1.0)
+
+        self.assertEqual(items, list(range(10)))
+        self.assertFalse(t.is_alive())
+        self.assertGreater(queue.blocked, 0)
+        loop.close()
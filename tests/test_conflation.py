@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+
+from time import sleep
+from magic_foundation import ConflatingQueue, Container
+from helpers import RecordingService
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+def symbol(data:map):
+  return data["symbol"]
+
+
+class TestConflation(TestCase):
+
+    def test_conflating_queue(self):
+        loop = asyncio.new_event_loop()
+        queue = ConflatingQueue(lambda event: event.data["symbol"], loop=loop)
+
+        for symbol, price in (("a", 1), ("b", 1), ("a", 2), ("c", 1), ("b", 2), ("a", 3)):
+          queue.put_nowait(Container.Event("q://quotes", {"symbol": symbol, "price": price}))
+
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual(queue.coalesced, 3)
+        # the newest value of every key, in the position of its first pending update
+        events = [loop.run_until_complete(queue.get()) for _ in range(3)]
+        self.assertEqual([event.data for event in events],
+                         [{"symbol": "a", "price": 3}, {"symbol": "b", "price": 2}, {"symbol": "c", "price": 1}])
+        loop.close()
+
+    def test_slow_consumer(self):
+        conflated = RecordingService(name="Conflated", queue_name="q://quotes", delay=0.01, conflate=symbol)
+        latest = RecordingService(name="Latest", queue_name="q://quotes", delay=0.01, conflate=True)
+        threads = [Container("conflated", [conflated]), Container("latest", [latest])]
+        [t.start() for t in threads]
+        sleep(0.3)
+
+        items = [{"symbol": s, "price": price} for price in range(100) for s in ("a", "b", "c")]
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(threads[0].publish_many(queue_name="q://quotes", items=items))
+        sleep(0.5)
+
+        # every key ends with its newest price, most updates are skipped
+        self.assertLess(len(conflated.received), 30)
+        last = {data["symbol"]: data["price"] for data in conflated.received}
+        self.assertEqual(last, {"a": 99, "b": 99, "c": 99})
+        self.assertEqual(latest.received[-1], {"symbol": "c", "price": 99})
+
+        stats = threads[0].stats()
+        self.assertEqual(stats["coalesced"]["q://quotes"] + len(conflated.received), 300)
+
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
+        [t.join(timeout=5.0) for t in threads]
@@ -0,0 +1,89 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+
+from time import sleep
+from magic_foundation import Balance, Bus, Container, DispatchMode, default_bus
+from helpers import RecordingService
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+def job_key(data:map):
+  return data["key"]
+
+
+class TestConsumerGroup(TestCase):
+
+    def _run(self, workers:list, items:list, many:bool=False):
+        threads = [Container(f"w{i}", [worker]) for i, worker in enumerate(workers)]
+        [t.start() for t in threads]
+        sleep(0.3)
+
+        loop = asyncio.new_event_loop()
+        publisher = threads[0]
+        if many:
+          loop.run_until_complete(publisher.publish_many(queue_name="q://jobs", items=items))
+        else:
+          for data in items:
+            loop.run_until_complete(publisher.publish(queue_name="q://jobs", data=data))
+        sleep(0.3)
+
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
+        [t.join(timeout=5.0) for t in threads]
+
+    def test_round_robin(self):
+        workers = [RecordingService(name=f"Worker{i}", queue_name="q://jobs", mode=DispatchMode.inline, group="workers") for i in range(3)]
+        observer = RecordingService(name="Observer", queue_name="q://jobs", mode=DispatchMode.inline)
+
+        self._run(workers + [observer], list(range(30)))
+
+        self.assertEqual([len(worker.received) for worker in workers], [10, 10, 10])
+        self.assertEqual(sorted(sum((worker.received for worker in workers), [])), list(range(30)))
+        # the plain subscribers still get every event
+        self.assertEqual(observer.received, list(range(30)))
+        self.assertEqual(default_bus.snapshot.groups, {})
+
+    def test_least_depth(self):
+        workers = [RecordingService(name=f"Worker{i}", queue_name="q://jobs", mode=DispatchMode.inline, group="workers", balance=Balance.least_depth) for i in range(3)]
+
+        self._run(workers, list(range(30)), many=True)
+
+        self.assertEqual(sorted(sum((worker.received for worker in workers), [])), list(range(30)))
+
+    def test_hash(self):
+        workers = [RecordingService(name=f"Worker{i}", queue_name="q://jobs", mode=DispatchMode.inline, group="workers", balance=Balance.hash, key=job_key) for i in range(3)]
+        items = [{"key": f"k{i % 5}", "index": i} for i in range(50)]
+
+        self._run(workers, items, many=True)
+
+        self.assertEqual(sum(len(worker.received) for worker in workers), 50)
+        for worker in workers:
+          for key in set(job_key(data) for data in worker.received):
+            indexes = [data["index"] for data in worker.received if data["key"] == key]
+            # every key goes to a single member, in order
+            self.assertEqual(indexes, list(range(int(key[1:]), 50, 5)))
+
+    def test_snapshot_keeps_members(self):
+        bus = Bus()
+        queues = [object(), object()]
+        for thread_id, balance, key in ((1, Balance.round_robin, None), (2, Balance.hash, job_key)):
+          bus.subscribe("q://jobs", thread_id, queues[thread_id - 1], Container.Subscription(None),
+                        group=f"g{thread_id}", balance=balance, key=key)
+
+        before = bus.route("q://jobs")
+        bus.remove_thread(1)
+        bus.remove_thread(2)
+
+        # the route read before keeps its members, the new one has no group
+        self.assertEqual([group.select({"key": "k"}) for group in before.groups], queues)
+        self.assertEqual(bus.route("q://jobs").groups, ())
+
+        # an empty group selects nothing
+        for thread_id, group in enumerate(before.groups, 1):
+          self.assertIsNone(group.without_member(thread_id).select({"key": "k"}))
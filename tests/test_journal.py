@@ -0,0 +1,131 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from time import sleep
+from magic_foundation import Container, DispatchMode, set_journal
+from magic_foundation.journal import Journal, SyncPolicy
+from helpers import RecordingService, wait_until
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class TestJournal(TestCase):
+
+    def tearDown(self):
+        set_journal(None)
+
+    def test_segments_and_recovery(self):
+        directory = tempfile.mkdtemp()
+
+        journal = Journal(directory, ["q://journal", "q://events/*"], segment_bytes=1024, index_interval=256)
+        self.assertTrue(journal.journaled("q://events/a"))
+        self.assertFalse(journal.journaled("q://other"))
+
+        offsets = [journal.append("q://journal", {"index": index}) for index in range(100)]
+        self.assertEqual(offsets, list(range(100)))
+        middle = time.time()
+        journal.append("q://journal", {"index": 100})
+        journal.close()
+
+        # a torn write at the end of the last segment
+        log_directory = os.path.join(directory, os.listdir(directory)[0])
+        last = sorted(name for name in os.listdir(log_directory) if name.endswith(".log"))[-1]
+        self.assertGreater(len(os.listdir(log_directory)), 4)
+        with open(os.path.join(log_directory, last), "ab") as f:
+          f.write(b"\x01\x02\x03")
+
+        journal = Journal(directory, ["q://journal"], segment_bytes=1024, index_interval=256)
+        self.assertEqual(journal.end_offset("q://journal"), 101)
+        self.assertEqual(journal.append("q://journal", {"index": 101}), 101)
+
+        reader = journal.reader("q://journal", from_offset=42)
+        records = []
+        while True:
+          batch = reader.read(10)
+          if not batch:
+            break
+          records.extend(batch)
+        reader.close()
+        self.assertEqual([offset for offset, _, _ in records], list(range(42, 102)))
+        self.assertEqual([data["index"] for _, _, data in records], list(range(42, 102)))
+
+        reader = journal.reader("q://journal", from_time=middle)
+        self.assertEqual([data["index"] for _, _, data in reader.read(10)], [100, 101])
+        reader.close()
+        journal.close()
+
+    def test_replay_then_live(self):
+        journal = Journal(tempfile.mkdtemp(), ["q://journal"], segment_bytes=4096)
+        set_journal(journal)
+
+        publisher = Container("publisher", [])
+        publisher.start()
+        sleep(0.2)
+
+        loop = asyncio.new_event_loop()
+        # published with no subscriber
+        loop.run_until_complete(publisher.publish_many(queue_name="q://journal", items=list(range(500))))
+
+        consumer = RecordingService(name="Replay", queue_name="q://journal", mode=DispatchMode.inline, from_offset=100)
+        thread = Container("replay", [consumer])
+        thread.start()
+        for index in range(500, 600):
+          loop.run_until_complete(publisher.publish(queue_name="q://journal", data=index))
+        sleep(0.5)
+        loop.run_until_complete(publisher.publish(queue_name="q://journal", data=600))
+        sleep(0.2)
+
+        # the replayed events then the live ones, once and in order
+        self.assertEqual(consumer.received, list(range(100, 601)))
+
+        loop.run_until_complete(thread.terminate())
+        loop.run_until_complete(publisher.terminate())
+        loop.close()
+        journal.close()
+
+    def test_replay_requires_journal(self):
+        async def subscribe():
+          container = Container("c", [])
+          await container.subscribe(queue_name="q://journal", handler=None, from_offset=0)
+
+        with self.assertRaises(ValueError):
+          asyncio.run(subscribe())
+
+    def test_batches_and_sync(self):
+        directory = tempfile.mkdtemp()
+
+        journal = Journal(directory, ["q://journal"], segment_bytes=1024, index_interval=256, sync=SyncPolicy.always)
+        self.assertEqual(journal.append_many("q://journal", list(range(100))), list(range(100)))
+        self.assertEqual(journal.append("q://journal", 100), 100)
+        journal.close()
+
+        # a batch rolls the segments as the single appends
+        journal = Journal(directory, ["q://journal"], segment_bytes=1024, index_interval=256,
+                          sync=SyncPolicy.interval, sync_interval=0.05)
+        log_directory = os.path.join(directory, os.listdir(directory)[0])
+        self.assertGreater(len(os.listdir(log_directory)), 4)
+        self.assertEqual(journal.append_many("q://journal", [101, 102]), [101, 102])
+
+        # fsynced by the background thread
+        log_ = journal._log("q://journal")
+        self.assertTrue(wait_until(lambda: not log_.dirty))
+
+        reader = journal.reader("q://journal", from_offset=0)
+        records = []
+        while True:
+          batch = reader.read(30)
+          if not batch:
+            break
+          records.extend(batch)
+        reader.close()
+        self.assertEqual([offset for offset, _, _ in records], list(range(103)))
+        self.assertEqual([data for _, _, data in records], list(range(103)))
+        journal.close()
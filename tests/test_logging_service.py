@@ -0,0 +1,172 @@
+from unittest import TestCase
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import tempfile
+
+from time import sleep
+from magic_foundation import Container, Service, ServiceStatus, ServiceContext
+from magic_foundation.logging_service import LoggingService
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class LogProducerService(Service):
+
+    def __init__(self, file_path:str, messages:int, pause_every:int=0):
+        self.name = "LogProducer"
+        self.file_path = file_path
+        self.messages = messages
+        self.pause_every = pause_every
+
+    async def initialize(self, ctx:ServiceContext):
+        pass
+
+    async def run(self, ctx:ServiceContext):
+        # wait for the logging service subscription
+        while not ctx.container.bus.subscribers(f"log://{self.file_path}"):
+            await asyncio.sleep(0.01)
+
+        for index in range(self.messages):
+            await ctx.publish(queue_name=f"log://{self.file_path}", data={"index": index})
+            if self.pause_every and index % self.pause_every == 0:
+                await asyncio.sleep(0.005)
+
+    async def terminate(self, ctx:ServiceContext):
+        pass
+
+
+class FullDisk:
+    """ a file that writes limit bytes, then fails """
+
+    def __init__(self, limit:int=0):
+        self.limit = limit
+        self.written = b""
+        self.closed = False
+
+    def write(self, view):
+        if self.limit <= 0:
+            raise OSError(28, "No space left on device")
+        n = min(self.limit, len(view))
+        self.written += bytes(view[:n])
+        self.limit -= n
+        return n
+
+
+class SubscribeContext:
+
+    async def subscribe(self, **options):
+        pass
+
+
+class TestLoggingService(TestCase):
+
+    def test_batched_writes(self):
+        file_path = os.path.join(tempfile.mkdtemp(), "out.log")
+
+        logging_service = LoggingService(file_path=file_path, flush_interval_sec=10.0, flush_size=1024)
+        logger = Container("logger", [logging_service])
+        producer = Container("producer", [LogProducerService(file_path, 1000)])
+        logger.start()
+        producer.start()
+        sleep(0.5)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(producer.terminate())
+        loop.run_until_complete(logger.terminate())
+        loop.close()
+        logger.join(timeout=5.0)
+
+        with open(file_path) as f:
+            lines = [json.loads(line) for line in f]
+
+        self.assertEqual([line["index"] for line in lines], list(range(1000)))
+        self.assertEqual(logging_service.lines, 1000)
+        # one write per batch, not per line
+        self.assertLess(logging_service.flushes, 100)
+
+    def test_rotation(self):
+        file_path = os.path.join(tempfile.mkdtemp(), "out.log")
+
+        logging_service = LoggingService(file_path=file_path, flush_interval_sec=10.0, flush_size=512,
+                                         max_bytes=2048, backup_count=3)
+        logger = Container("logger", [logging_service])
+        producer = Container("producer", [LogProducerService(file_path, 1000, pause_every=50)])
+        logger.start()
+        producer.start()
+        sleep(1.0)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(producer.terminate())
+        loop.run_until_complete(logger.terminate())
+        loop.close()
+        logger.join(timeout=5.0)
+
+        self.assertGreater(logging_service.rotations, 3)
+
+        rotated = logging_service.rotated_files()
+        self.assertEqual(len(rotated), 3)
+        self.assertTrue(all(path.endswith(".gz") for path in rotated))
+
+        indexes = []
+        for path in rotated:
+            with gzip.open(path, "rt") as f:
+                indexes.extend(json.loads(line)["index"] for line in f)
+        with open(file_path) as f:
+            indexes.extend(json.loads(line)["index"] for line in f)
+
+        # the newest lines, in order and without gaps
+        self.assertEqual(indexes, list(range(1000 - len(indexes), 1000)))
+
+    def test_write_errors(self):
+        file_path = os.path.join(tempfile.mkdtemp(), "out.log")
+
+        async def scenario():
+            logging_service = LoggingService(file_path=file_path, max_buffer=64)
+            await logging_service.initialize(None)
+            await logging_service.run(SubscribeContext())
+            file = logging_service.file
+
+            # the batch is kept, only its part not written is retried
+            logging_service.file = disk = FullDisk(limit=3)
+            for index in range(3):
+                await logging_service.handler({"i": index})
+            with self.assertRaises(OSError):
+                await logging_service.flush()
+            self.assertEqual(logging_service.write_errors, 1)
+
+            # the buffer is bounded while the writes fail
+            for index in range(3, 20):
+                await logging_service.handler({"i": index})
+            self.assertLessEqual(logging_service.buffered, 64)
+            self.assertGreater(logging_service.dropped, 0)
+
+            logging_service.file = file
+            await logging_service.flush()
+            file.close()
+            return disk.written + open(file_path, "rb").read(), logging_service.dropped
+
+        written, dropped = asyncio.run(scenario())
+        indexes = [json.loads(line)["i"] for line in written.decode().splitlines()]
+        self.assertEqual(indexes, list(range(20 - dropped)))
+
+    def test_retention_keeps_other_files(self):
+        directory = tempfile.mkdtemp()
+        file_path = os.path.join(directory, "app.log")
+        names = ["app.log.20200101-000000-000000.gz", "app.log.20200102-000000-000000",
+                 "app.log.err", "app.log.err.20200101-000000-000000.gz", "app.log.20200103-000000-000000.gz.tmp"]
+        for name in names:
+          open(os.path.join(directory, name), "wb").close()
+
+        logging_service = LoggingService(file_path=file_path, backup_count=1)
+        self.assertEqual(logging_service.rotated_files(), [os.path.join(directory, name) for name in names[:2]])
+
+        # another service writing app.log.err keeps its files
+        logging_service._apply_retention()
+        self.assertEqual(sorted(os.listdir(directory)), sorted(names[1:]))
@@ -0,0 +1,67 @@
+from unittest import TestCase
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from time import sleep
+from magic_foundation import Container, Histogram
+from magic_foundation.metrics_service import MetricsService, prometheus_text
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class TestMetricsService(TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for _ in range(99):
+          histogram.observe(0.000010)
+        histogram.observe(0.5)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.quantile(0.5), 16 / 1e6)
+        self.assertGreaterEqual(histogram.quantile(1.0), 0.5)
+        self.assertEqual(histogram.snapshot()["buckets"][-1][1], 100)
+
+    def test_prometheus_text(self):
+        histogram = Histogram()
+        histogram.observe(0.001)
+
+        text = prometheus_text([{
+          "container": "main",
+          "inbound": {"depth": 2, "dropped_newest": 1, "dropped_oldest": 0, "rejected": 0, "dropped_by_queue": {"q://test": 1}},
+          "rejected_by_queue": {"q://test": 2, "q://pool": 1},
+          "published": {"q://test": 3},
+          "delivered": {"q://test": 3},
+          "handlers": {"q://test": histogram.snapshot()},
+          "loop_lag": {"last": 0.002},
+        }])
+
+        self.assertIn('magic_foundation_published_total{container="main",queue="q://test"} 3', text)
+        self.assertIn('magic_foundation_dropped_total{container="main",reason="dropped_newest"} 1', text)
+        self.assertIn('magic_foundation_queue_dropped_total{container="main",queue="q://test"} 3', text)
+        self.assertIn('magic_foundation_queue_dropped_total{container="main",queue="q://pool"} 1', text)
+        self.assertIn('magic_foundation_inbound_depth{container="main"} 2', text)
+        self.assertIn('magic_foundation_handler_seconds_count{container="main",queue="q://test"} 1', text)
+
+    def test_json_dump(self):
+        file_path = os.path.join(tempfile.mkdtemp(), "metrics.json")
+
+        container = Container("metrics", [MetricsService(file_path=file_path, interval_sec=0.1)])
+        container.start()
+        sleep(0.5)
+
+        with open(file_path) as f:
+          stats = json.load(f)
+
+        self.assertIn("metrics", [s["container"] for s in stats])
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(container.terminate())
+        loop.close()
@@ -0,0 +1,109 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from time import sleep
+from magic_foundation import Container, DispatchMode, Offload, Service, ServiceContext
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+def square(data:int) -> int:
+  return data * data
+
+
+def process_id(data) -> int:
+  return os.getpid()
+
+
+class OffloadService(Service):
+
+  def __init__(self, name:str):
+      self.name = name
+      self.blocking_threads = set()
+      self.ticks = 0
+      self.results = None
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    def blocking(data):
+      time.sleep(0.2)
+      self.blocking_threads.add(threading.get_ident())
+
+    async def tick(data):
+      self.ticks += 1
+
+    self.blocking = blocking
+    self.tick = tick
+
+    await ctx.subscribe(queue_name="q://blocking", handler=self.blocking, offload=Offload.thread)
+    await ctx.subscribe(queue_name="q://tick", handler=self.tick, mode=DispatchMode.inline)
+
+    self.results = (
+      await ctx.run_blocking(square, 7),
+      await ctx.run_blocking(process_id, None, offload=Offload.process),
+    )
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+    await ctx.unsubscribe(queue_name="q://blocking", handler=self.blocking)
+    await ctx.unsubscribe(queue_name="q://tick", handler=self.tick)
+
+
+class TestOffload(TestCase):
+
+    def test_offload(self):
+        service = OffloadService(name="Offload")
+        thread = Container("offload", [service], thread_workers=4, process_workers=1)
+        thread.start()
+        sleep(0.2)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(thread.publish_many(queue_name="q://blocking", items=[1, 2, 3, 4]))
+        # the loop of the container is not blocked by the handlers
+        for i in range(10):
+          loop.run_until_complete(thread.publish(queue_name="q://tick", data=i))
+        sleep(0.1)
+        self.assertEqual(service.ticks, 10)
+        self.assertEqual(service.blocking_threads, set())
+
+        deadline = time.time() + 10.0
+        while service.results is None and time.time() < deadline:
+          sleep(0.1)
+        sleep(0.3)
+
+        self.assertEqual(len(service.blocking_threads), 4)
+        self.assertNotIn(thread.ident, service.blocking_threads)
+        self.assertEqual(service.results[0], 49)
+        self.assertNotEqual(service.results[1], os.getpid())
+
+        loop.run_until_complete(thread.terminate())
+        loop.close()
+        thread.join(timeout=5.0)
+        self.assertEqual(thread.executors, {})
+
+    def test_offload_coroutine_function(self):
+        async def handler(data):
+          return data
+
+        async def subscribe():
+          container = Container("c", [])
+          with self.assertRaises(ValueError):
+            await container.subscribe(queue_name="q://blocking", handler=handler, offload=Offload.thread)
+          with self.assertRaises(ValueError):
+            await container.serve(queue_name="q://blocking", handler=handler, offload=Offload.thread)
+          self.assertEqual(container.bus.snapshot.route("q://blocking").targets, ())
+
+        asyncio.run(subscribe())
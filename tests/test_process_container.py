@@ -0,0 +1,145 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+
+from time import sleep
+from magic_foundation import Container, Service, ServiceContext, default_bus
+from magic_foundation.process_container import ProcessContainer
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class EchoService(Service):
+
+  def __init__(self, name:str):
+      self.name = name
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    async def handler(data:map):
+      await ctx.publish(queue_name="q://pong", data=data)
+
+    self.handler = handler
+
+    await ctx.subscribe(queue_name="q://ping", handler=self.handler)
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+    await ctx.unsubscribe(queue_name="q://ping", handler=self.handler)
+
+
+class PingService(Service):
+
+  def __init__(self, name:str, num_messages=0):
+      self.name = name
+      self.num_messages = num_messages
+      self.received = []
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    async def handler(data:map):
+      self.received.append(data["index"])
+
+    self.handler = handler
+
+    await ctx.subscribe(queue_name="q://pong", handler=self.handler)
+
+    # wait for the child process to subscribe
+    while not ctx.container.bus.subscribers("q://ping"):
+      await asyncio.sleep(0.05)
+
+    await ctx.publish_many(queue_name="q://ping", items=[{"index": i} for i in range(self.num_messages)])
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+    await ctx.unsubscribe(queue_name="q://pong", handler=self.handler)
+
+
+class PongWorkerService(Service):
+
+  def __init__(self, name:str):
+      self.name = name
+      self.received = []
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    async def handler(data:map):
+      self.received.append(data["index"])
+
+    self.handler = handler
+
+    await ctx.subscribe(queue_name="q://pong", handler=self.handler, group="workers")
+
+  async def terminate(self, ctx:ServiceContext):
+    await ctx.unsubscribe(queue_name="q://pong", handler=self.handler)
+
+
+class TestProcessContainer(TestCase):
+
+    def test_publish_subscribe_across_processes(self):
+        ping = PingService(name="Ping", num_messages=100)
+
+        threads = [
+          Container("main", [ping]),
+          ProcessContainer("process", [EchoService(name="Echo")]),
+        ]
+        [t.start() for t in threads]
+
+        for _ in range(100):
+          if len(ping.received) == 100:
+            break
+          sleep(0.1)
+
+        self.assertEqual(ping.received, list(range(100)))
+
+        loop = asyncio.new_event_loop()
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
+        [t.join(timeout=5.0) for t in threads]
+
+        self.assertFalse(threads[1].process.is_alive())
+        self.assertEqual(default_bus.subscribers("q://ping"), {})
+
+    def test_publish_to_groups_across_processes(self):
+        ping = PingService(name="Ping", num_messages=100)
+        workers = [PongWorkerService(name=f"Worker{i}") for i in range(2)]
+
+        threads = [
+          Container("main", [ping]),
+          Container("worker0", [workers[0]]),
+          Container("worker1", [workers[1]]),
+          ProcessContainer("process", [EchoService(name="Echo")]),
+        ]
+        [t.start() for t in threads]
+        self.addCleanup(self._stop, threads)
+
+        for _ in range(100):
+          if len(ping.received) == 100 and sum(len(worker.received) for worker in workers) == 100:
+            break
+          sleep(0.1)
+
+        # the events published in the child reach the consumer groups of the parent, once
+        self.assertEqual(sorted(workers[0].received + workers[1].received), list(range(100)))
+        self.assertTrue(all(worker.received for worker in workers))
+
+    def _stop(self, threads:list):
+        loop = asyncio.new_event_loop()
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
+        [t.join(timeout=5.0) for t in threads]
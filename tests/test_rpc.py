@@ -0,0 +1,168 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+
+from time import sleep
+from magic_foundation import Container, DispatchMode, Service, ServiceContext
+from magic_foundation.process_container import ProcessContainer
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class ServerService(Service):
+
+  def __init__(self, name:str):
+      self.name = name
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    async def double(data:int):
+      return data * 2
+
+    async def fail(data):
+      raise ValueError(f"bad request {data}")
+
+    self.double = double
+    self.fail = fail
+
+    await ctx.serve(queue_name="rpc://double", handler=self.double)
+    await ctx.serve(queue_name="rpc://fail", handler=self.fail)
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+    await ctx.unserve(queue_name="rpc://double", handler=self.double)
+    await ctx.unserve(queue_name="rpc://fail", handler=self.fail)
+
+
+class ClientService(Service):
+
+  def __init__(self, name:str):
+      self.name = name
+      self.results = None
+      self.observers = []
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    while not ctx.container.bus.subscribers("rpc://double"):
+      await asyncio.sleep(0.05)
+
+    results = await asyncio.gather(*[ctx.request(queue_name="rpc://double", data=i) for i in range(10)])
+
+    try:
+      await ctx.request(queue_name="rpc://fail", data=1)
+      error = None
+    except ValueError as e:
+      error = str(e)
+
+    try:
+      await ctx.request(queue_name="rpc://nobody", data=1, timeout=0.1)
+      timeout = False
+    except asyncio.TimeoutError:
+      timeout = True
+
+    self.results = (results, error, timeout, len(ctx.container.rpc_pending))
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+
+class InlineCallerService(Service):
+
+  def __init__(self, name:str):
+      self.name = name
+      self.results = []
+
+  async def initialize(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] initialize")
+
+  async def run(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] run")
+
+    # the request blocks the inbound dispatching of this container
+    async def handler(data:int):
+      try:
+        self.results.append(await ctx.request(queue_name="rpc://double", data=data, timeout=1.0))
+      except asyncio.TimeoutError:
+        self.results.append("timeout")
+
+    self.handler = handler
+
+    await ctx.subscribe(queue_name="q://ask", handler=self.handler, mode=DispatchMode.inline)
+
+    while not ctx.container.bus.subscribers("rpc://double"):
+      await asyncio.sleep(0.05)
+
+    await ctx.publish_many(queue_name="q://ask", items=[1, 2, 3])
+
+  async def terminate(self, ctx:ServiceContext):
+    log.info(f"[{self.name}] terminate")
+
+    await ctx.unsubscribe(queue_name="q://ask", handler=self.handler)
+
+
+class TestRpc(TestCase):
+
+    def test_request_reply(self):
+        client = ClientService(name="Client")
+        other = ClientService(name="Other")
+
+        threads = [
+          Container("server", [ServerService(name="Server")]),
+          Container("client", [client]),
+          Container("other", [other]),
+        ]
+        [t.start() for t in threads]
+
+        for _ in range(50):
+          if client.results is not None and other.results is not None:
+            break
+          sleep(0.1)
+
+        for service in (client, other):
+          results, error, timeout, pending = service.results
+          self.assertEqual(results, [i * 2 for i in range(10)])
+          self.assertEqual(error, "bad request 1")
+          self.assertTrue(timeout)
+          self.assertEqual(pending, 0)
+
+        # the replies are handed to the caller, not dispatched by the inbound queues
+        for thread in threads:
+          self.assertNotIn(threads[1].rpc_reply_to, thread.stats()["delivered"])
+
+        loop = asyncio.new_event_loop()
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
+
+    def test_request_from_inline_handler(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        # the server in this process and in a child process
+        for server in (Container("server", [ServerService(name="Server")]),
+                       ProcessContainer("server", [ServerService(name="Server")])):
+          caller = InlineCallerService(name="Caller")
+          threads = [server, Container("caller", [caller])]
+          [t.start() for t in threads]
+
+          for _ in range(100):
+            if len(caller.results) == 3:
+              break
+            sleep(0.1)
+
+          [loop.run_until_complete(t.terminate()) for t in threads]
+          [t.join(timeout=5.0) for t in threads]
+
+          self.assertEqual(caller.results, [2, 4, 6])
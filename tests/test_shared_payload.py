@@ -0,0 +1,102 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+import os
+import pickle
+
+from time import sleep
+from magic_foundation import Bus, Container, DispatchMode, OverflowPolicy, Queue, SharedPayload
+from magic_foundation.shared_payload import share
+from helpers import RecordingService
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class TestSharedPayload(TestCase):
+
+    def test_payload_lifecycle(self):
+        data = os.urandom(1024)
+        payload = SharedPayload.create(data)
+
+        self.assertEqual(len(payload), 1024)
+        self.assertEqual(payload.refcount, 1)
+        self.assertEqual(bytes(payload.view()), data)
+
+        copy = pickle.loads(pickle.dumps(payload))
+        self.assertEqual(copy.tobytes(), data)
+
+        payload.transfer(2)
+        self.assertEqual(payload.refcount, 2)
+
+        copy.release()
+        self.assertTrue(os.path.exists(payload.path))
+
+        payload.release()
+        self.assertFalse(os.path.exists(payload.path))
+
+    def test_share_threshold(self):
+        self.assertEqual(share(b"small", threshold=1024), b"small")
+        self.assertEqual(share({"a": 1}, threshold=0), {"a": 1})
+
+        payload = share(bytearray(2048), threshold=1024)
+        self.assertIsInstance(payload, SharedPayload)
+        payload.release()
+
+    def test_publish_releases_after_every_subscriber(self):
+        consumers = [
+          RecordingService(name="Spawn", queue_name="q://frames", record=SharedPayload.tobytes),
+          RecordingService(name="Inline", queue_name="q://frames", record=SharedPayload.tobytes, mode=DispatchMode.inline),
+          RecordingService(name="Pool", queue_name="q://frames", record=SharedPayload.tobytes, mode=DispatchMode.pool, workers=2),
+        ]
+
+        threads = [Container(f"th{i}", [consumer]) for i, consumer in enumerate(consumers)]
+        [t.start() for t in threads]
+        sleep(0.5)
+
+        frame = os.urandom(256 * 1024)
+        payload = SharedPayload.create(frame)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(threads[0].publish(queue_name="q://frames", data=payload))
+
+        for _ in range(50):
+          if not os.path.exists(payload.path):
+            break
+          sleep(0.1)
+
+        self.assertFalse(os.path.exists(payload.path))
+        for consumer in consumers:
+          self.assertEqual(consumer.received, [frame])
+
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
+
+    def test_rejected_payload_is_released(self):
+        loop = asyncio.new_event_loop()
+        full = Queue(thread_id=1, loop=loop, maxsize=1, policy=OverflowPolicy.error, lanes=3)
+        full.put_nowait(Container.Event("q://frames", b"first"))
+        other = Queue(thread_id=2, loop=loop, lanes=3)
+
+        bus = Bus()
+        bus.subscribe("q://frames", 1, full, Container.Subscription(None))
+        bus.subscribe("q://frames", 2, other, Container.Subscription(None))
+        publisher = Container("publisher", [], bus=bus)
+
+        # the queue not reached and the full queue both give their reference back
+        for publish in (lambda payload: publisher.publish(queue_name="q://frames", data=payload),
+                        lambda payload: publisher.publish_many(queue_name="q://frames", items=[payload])):
+          payload = SharedPayload.create(os.urandom(1024))
+          with self.assertRaises(asyncio.QueueFull):
+            loop.run_until_complete(publish(payload))
+          self.assertTrue(other.empty())
+          self.assertFalse(os.path.exists(payload.path))
+
+        payload = SharedPayload.create(os.urandom(1024))
+        with self.assertRaises(asyncio.QueueFull):
+          full.put_many_nowait([Container.Event("q://frames", payload)])
+        self.assertFalse(os.path.exists(payload.path))
+        loop.close()
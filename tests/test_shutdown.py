@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+import threading
+import time
+
+from time import sleep
+from magic_foundation import Container, DispatchMode, Main
+from helpers import RecordingService, new_main, wait_until
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.ERROR)
+
+
+class TestShutdown(TestCase):
+
+    def _publish(self, loop, container, queue_name:str, count:int):
+        loop.run_until_complete(container.publish_many(queue_name=queue_name, items=list(range(count))))
+
+    def test_terminate_drops(self):
+        slow = RecordingService(name="Slow", queue_name="q://slow", delay=0.02, mode=DispatchMode.inline)
+        container = Container("slow", [slow])
+        container.start()
+        self.assertTrue(wait_until(lambda: container.bus.subscribers("q://slow")))
+
+        loop = asyncio.new_event_loop()
+        self._publish(loop, container, "q://slow", 50)
+        report = loop.run_until_complete(container.terminate(timeout=5.0))
+        loop.close()
+        container.join(timeout=5.0)
+
+        # no drain: the queued events are discarded and counted
+        self.assertFalse(report["timed_out"])
+        self.assertLess(report["seconds"], 0.5)
+        self.assertGreater(report["dropped"], 0)
+        self.assertEqual(report["dropped"] + len(slow.received), 50)
+        self.assertEqual(report["dropped_by_queue"], {"q://slow": report["dropped"]})
+
+    def test_terminate_drains(self):
+        slow = RecordingService(name="Slow", queue_name="q://slow", delay=0.02, mode=DispatchMode.inline)
+        container = Container("slow", [slow])
+        container.start()
+        self.assertTrue(wait_until(lambda: container.bus.subscribers("q://slow")))
+
+        loop = asyncio.new_event_loop()
+        self._publish(loop, container, "q://slow", 20)
+        report = loop.run_until_complete(container.terminate(drain_timeout=5.0))
+        self.assertEqual(report["dropped"], 0)
+        self.assertEqual(len(slow.received), 20)
+
+        # a drain bounded by its timeout
+        slow = RecordingService(name="Slow", queue_name="q://slow", delay=0.02, mode=DispatchMode.inline)
+        container = Container("slow", [slow])
+        container.start()
+        self.assertTrue(wait_until(lambda: container.bus.subscribers("q://slow")))
+
+        self._publish(loop, container, "q://slow", 100)
+        report = loop.run_until_complete(container.terminate(drain_timeout=0.2))
+        loop.close()
+        container.join(timeout=5.0)
+
+        self.assertLess(report["seconds"], 1.0)
+        self.assertGreater(report["dropped"], 0)
+        self.assertEqual(report["dropped"] + len(slow.received), 100)
+
+    def test_main_parallel_shutdown(self):
+        main = new_main()
+        services = [RecordingService(name=f"Slow{i}", queue_name=f"q://slow/{i}", delay=0.02, mode=DispatchMode.inline) for i in range(4)]
+        main.service_pools = {f"slow{i}": [service] for i, service in enumerate(services)}
+        main.drain_timeout = 0.3
+
+        thread = threading.Thread(target=main.run)
+        thread.start()
+        self.addCleanup(thread.join, 10.0)
+        self.addCleanup(main.stop)
+        self.assertTrue(wait_until(lambda: len(main.containers) == 4 and all(main.bus.subscribers(f"q://slow/{i}") for i in range(4))))
+
+        loop = asyncio.new_event_loop()
+        [self._publish(loop, main.container(f"slow{i}"), f"q://slow/{i}", 100) for i in range(4)]
+        loop.close()
+
+        started = time.monotonic()
+        main.stop()
+        thread.join(timeout=5.0)
+        self.assertFalse(thread.is_alive())
+        # the pools drain at the same time, not one after the other
+        self.assertLess(time.monotonic() - started, 1.0)
+
+        reports = main.shutdown_report
+        self.assertEqual(sorted(report["container"] for report in reports), ["slow0", "slow1", "slow2", "slow3"])
+        for service, report in zip(services, reports):
+          self.assertEqual(report["dropped"] + len(service.received), 100)
+
+    def test_drain_subscription_queues_and_handlers(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        def run(service, count:int, drain_timeout:float=None):
+          container = Container("slow", [service])
+          container.start()
+          self.assertTrue(wait_until(lambda: container.bus.subscribers("q://slow")))
+          self._publish(loop, container, "q://slow", count)
+          # the events reach the subscription queues and the spawned handlers
+          sleep(0.05)
+          report = loop.run_until_complete(container.terminate(drain_timeout=drain_timeout))
+          container.join(timeout=5.0)
+          return report
+
+        # pool and conflating queues and spawned handlers are drained
+        for service in (RecordingService(name="Pool", queue_name="q://slow", delay=0.02, mode=DispatchMode.pool, workers=2),
+                        RecordingService(name="Spawn", queue_name="q://slow", delay=0.2, mode=DispatchMode.spawn)):
+          report = run(service, 20, drain_timeout=5.0)
+          self.assertEqual(report["dropped"], 0)
+          self.assertEqual(len(service.completed), 20)
+
+        conflated = RecordingService(name="Conflated", queue_name="q://slow", delay=0.02, conflate=True)
+        report = run(conflated, 20, drain_timeout=5.0)
+        self.assertEqual(report["dropped"], 0)
+        self.assertEqual(conflated.completed[-1], 19)
+
+        # without a drain the events queued or being handled are counted
+        for service in (RecordingService(name="Pool", queue_name="q://slow", delay=0.02, mode=DispatchMode.pool, workers=2),
+                        RecordingService(name="Spawn", queue_name="q://slow", delay=0.2, mode=DispatchMode.spawn)):
+          report = run(service, 20)
+          self.assertEqual(report["dropped"] + len(service.completed), 20)
+          self.assertGreater(report["dropped"], 0)
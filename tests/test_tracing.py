@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from time import sleep
+from magic_foundation import Container, DispatchMode, set_tracer
+from magic_foundation.tracing import SamplingTracer
+from helpers import RecordingService
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.WARNING)
+
+
+class TestTracing(TestCase):
+
+    def tearDown(self):
+        set_tracer(None)
+
+    def test_sampling_tracer_records_spans(self):
+        tracer = SamplingTracer(sample_every=2)
+        set_tracer(tracer)
+
+        consumers = [RecordingService(name="Spawn", queue_name="q://trace"), RecordingService(name="Inline", queue_name="q://trace", mode=DispatchMode.inline)]
+        threads = [Container(f"th{i}", [consumer]) for i, consumer in enumerate(consumers)]
+        [t.start() for t in threads]
+        sleep(0.5)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(threads[0].publish_many(queue_name="q://trace", items=list(range(10))))
+        sleep(0.5)
+
+        for consumer in consumers:
+          self.assertEqual(sorted(consumer.received), list(range(10)))
+
+        publish = [e for e in tracer.events if e["cat"] == "publish"]
+        queue = [e for e in tracer.events if e["cat"] == "queue"]
+        dispatch = [e for e in tracer.events if e["cat"] == "dispatch"]
+
+        self.assertEqual(len(publish), 5)
+        self.assertEqual(len(queue), 10)
+        self.assertEqual(len(dispatch), 10)
+        self.assertEqual({e["tid"] for e in dispatch}, {t.thread_id for t in threads})
+        self.assertEqual({e["args"]["destination_thread"] for e in queue}, {t.thread_id for t in threads})
+
+        file_path = os.path.join(tempfile.mkdtemp(), "trace.json")
+        tracer.dump(file_path)
+        with open(file_path) as f:
+          self.assertEqual(len(json.load(f)["traceEvents"]), len(tracer.events))
+
+        [loop.run_until_complete(t.terminate()) for t in threads]
+        loop.close()
@@ -0,0 +1,232 @@
+from unittest import TestCase
+
+import asyncio
+import logging
+
+from time import sleep
+from websockets.exceptions import ConnectionClosedOK
+from magic_foundation import Container, Service, ServiceContext
+from magic_foundation.websocket_service import Codec, WebSocketMessage, WebSocketService, _Connection, _OutboundFrame
+
+log = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("magic_foundation").setLevel(logging.ERROR)
+
+
+class ClientConnection:
+  """ the server side of a client connection, collecting the written frames """
+
+  def __init__(self):
+    self.frames = []
+    self.closed = None
+
+  async def ensure_open(self):
+    pass
+
+  async def write_frame(self, fin, opcode, data):
+    self.frames.append((opcode, bytes(data)))
+
+  async def close(self, code=1000, reason=""):
+    self.closed = code
+
+
+class ClientSocket(ClientConnection):
+  """ a connected client that sends nothing until it is closed """
+
+  def __init__(self):
+    ClientConnection.__init__(self)
+    self.disconnected = asyncio.Event()
+
+  async def recv(self):
+    await self.disconnected.wait()
+    raise ConnectionClosedOK(1000, "")
+
+
+class ContextService(Service):
+
+  name = "Context"
+
+  async def initialize(self, ctx:ServiceContext):
+    self.ctx = ctx
+
+  async def run(self, ctx:ServiceContext):
+    pass
+
+  async def terminate(self, ctx:ServiceContext):
+    pass
+
+
+class TestWebSocketService(TestCase):
+
+  def test_frame_encoded_once(self):
+    frame = _OutboundFrame("hello", Codec())
+    opcode, payload = frame.encoded()
+    self.assertEqual(payload, b"hello")
+    self.assertIs(frame.encoded()[1], payload)
+
+  def test_codec(self):
+    service = WebSocketService(codec="json")
+    self.assertEqual(asyncio.run(service._decode('{"a": [1, 2]}')), {"a": [1, 2]})
+
+    opcode, payload = _OutboundFrame({"a": 1}, service.codec).encoded()
+    self.assertEqual((opcode, payload), (0x01, b'{"a": 1}'))
+
+    # large messages decoded in the executor
+    service = WebSocketService(codec="orjson", decode_threshold=8)
+    self.assertEqual(asyncio.run(service._decode(b'{"a": "0123456789"}')), {"a": "0123456789"})
+    self.assertEqual(_OutboundFrame([1], service.codec).encoded()[0], 0x01)
+
+    with self.assertRaises(ValueError):
+      WebSocketService(codec="xml")
+
+  def test_send_buffer(self):
+    async def scenario(conflate):
+      service = WebSocketService(send_buffer=2, conflate=conflate)
+      websocket = ClientConnection()
+      connection = _Connection(service, websocket, 1, "/test")
+      for data in ("a", "b", "c", "d", "e"):
+        connection.push(_OutboundFrame(data, service.codec, broadcast=True))
+      connection.start()
+      await asyncio.sleep(0.01)
+      connection.stop()
+      return websocket.frames, connection.dropped
+
+    frames, dropped = asyncio.run(scenario(conflate=False))
+    self.assertEqual([data for _, data in frames], [b"d", b"e"])
+    self.assertEqual(dropped, 3)
+
+    frames, dropped = asyncio.run(scenario(conflate=True))
+    self.assertEqual([data for _, data in frames], [b"e"])
+    self.assertEqual(dropped, 4)
+
+  def test_send_buffer_direct_replies(self):
+    async def scenario(pushes):
+      service = WebSocketService(send_buffer=3, conflate=True)
+      websocket = ClientConnection()
+      connection = _Connection(service, websocket, 1, "/test")
+      for data, broadcast in pushes:
+        connection.push(_OutboundFrame(data, service.codec, broadcast=broadcast))
+      connection.start()
+      await asyncio.sleep(0.01)
+      connection.stop()
+      return [data for _, data in websocket.frames], connection.dropped
+
+    # the broadcasts are conflated, the direct replies kept in order
+    frames, dropped = asyncio.run(scenario([("a", True), ("r1", False), ("b", True), ("c", True), ("r2", False)]))
+    self.assertEqual(frames, [b"r1", b"c", b"r2"])
+    self.assertEqual(dropped, 2)
+
+    # a direct reply keeps the newest broadcast
+    frames, dropped = asyncio.run(scenario([("a", True), ("b", True), ("c", True), ("r1", False)]))
+    self.assertEqual(frames, [b"c", b"r1"])
+    self.assertEqual(dropped, 2)
+
+    # only direct replies pending, the oldest is dropped
+    frames, dropped = asyncio.run(scenario([("r1", False), ("r2", False), ("r3", False), ("d", True)]))
+    self.assertEqual(frames, [b"r2", b"r3", b"d"])
+    self.assertEqual(dropped, 1)
+
+  def test_evict_slow_client(self):
+    async def scenario():
+      service = WebSocketService(send_buffer=1, slow_client_timeout=0.01)
+      websocket = ClientConnection()
+      connection = _Connection(service, websocket, 1, "/test")
+      connection.push(_OutboundFrame("a", service.codec))
+      connection.push(_OutboundFrame("b", service.codec))
+      await asyncio.sleep(0.02)
+      connection.push(_OutboundFrame("c", service.codec))
+      await asyncio.sleep(0.01)
+      return service, websocket, connection
+
+    service, websocket, connection = asyncio.run(scenario())
+    self.assertTrue(connection.evicted)
+    self.assertEqual(service.evicted, 1)
+    self.assertEqual(websocket.closed, 1013)
+
+    # stopped again when the client disconnects, the drops are counted once
+    dropped = service.dropped
+    self.assertGreater(dropped, 0)
+    connection.stop()
+    self.assertEqual(service.dropped, dropped)
+
+  def test_connection_routing(self):
+    service = WebSocketService()
+    holder = ContextService()
+    container = Container("ws", [holder])
+    container.start()
+    self.addCleanup(container.join, 5.0)
+    self.addCleanup(lambda: asyncio.run(container.terminate()))
+    sleep(0.3)
+
+    def in_loop(coro):
+      return asyncio.run_coroutine_threadsafe(coro, container.loop).result(timeout=5.0)
+
+    async def connect(path):
+      websocket = ClientSocket()
+      asyncio.ensure_future(service._serve(holder.ctx, websocket, path))
+      await asyncio.sleep(0.05)
+      return websocket
+
+    # the client of /chat/1 must not see the replies to the connection 1 of /chat
+    victim = in_loop(connect("/chat"))
+    spy = in_loop(connect("/chat/1"))
+    victim_id, spy_id = sorted(service.connections)
+    self.assertEqual(service.connections[victim_id].path, "/chat")
+
+    async def publish():
+      await holder.ctx.publish(queue_name=WebSocketMessage(victim_id, "/chat", None, service.service_id).reply_to, data="private")
+      await holder.ctx.publish(queue_name="ws://outbound/chat", data="broadcast")
+      await holder.ctx.publish(queue_name="ws://outbound/chat/1", data="spy broadcast")
+      await asyncio.sleep(0.05)
+
+    in_loop(publish())
+    self.assertEqual([data for _, data in victim.frames], [b"private", b"broadcast"])
+    self.assertEqual([data for _, data in spy.frames], [b"spy broadcast"])
+
+    async def disconnect():
+      victim.disconnected.set()
+      spy.disconnected.set()
+      await asyncio.sleep(0.05)
+
+    in_loop(disconnect())
+    self.assertEqual(service.connections, {})
+    self.assertEqual(service.paths, {})
+
+  def test_connection_routing_services(self):
+    services = [WebSocketService(port=8080), WebSocketService(port=8081)]
+    holder = ContextService()
+    container = Container("ws", [holder])
+    container.start()
+    self.addCleanup(container.join, 5.0)
+    self.addCleanup(lambda: asyncio.run(container.terminate()))
+    sleep(0.3)
+
+    def in_loop(coro):
+      return asyncio.run_coroutine_threadsafe(coro, container.loop).result(timeout=5.0)
+
+    async def connect(service, path):
+      websocket = ClientSocket()
+      asyncio.ensure_future(service._serve(holder.ctx, websocket, path))
+      await asyncio.sleep(0.05)
+      return websocket
+
+    # the first connection of each service has the same conn_id
+    clients = [in_loop(connect(service, "/chat")) for service in services]
+    self.assertEqual([list(service.connections) for service in services], [[1], [1]])
+
+    async def publish():
+      for service in services:
+        await holder.ctx.publish(queue_name=WebSocketMessage(1, "/chat", None, service.service_id).reply_to, data=f"{service.port}")
+      await asyncio.sleep(0.05)
+
+    in_loop(publish())
+    self.assertEqual([data for _, data in clients[0].frames], [b"8080"])
+    self.assertEqual([data for _, data in clients[1].frames], [b"8081"])
+
+    async def disconnect():
+      for client in clients:
+        client.disconnected.set()
+      await asyncio.sleep(0.05)
+
+    in_loop(disconnect())